@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Сравнение разбора страницы Google Finance: полный BeautifulSoup
+против потокового GoogleRateScanner из main.py.
+
+Запуск:
+    python bench_google_parse.py                # синтетическая страница
+    python bench_google_parse.py page1.html ... # сохранённые страницы
+
+Сохранить страницу для замера:
+    curl -A "Mozilla/5.0" "https://www.google.com/finance/quote/RUB-KRW?hl=en" -o page.html
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+
+import main  # noqa: E402
+
+CHUNK = 16384
+ROUNDS = 20
+
+
+def synthetic_page() -> bytes:
+    """Страница похожего размера: ~1 МБ разметки, курс примерно в середине."""
+    filler = "".join(
+        f'<div class="c{i % 97}"><span data-i="{i}">item {i}</span></div>'
+        for i in range(8000)
+    )
+    return (
+        "<!doctype html><html><head><title>RUB / KRW</title></head><body>"
+        + filler
+        + f'<div class="{main.GOOGLE_RATE_CLASS}">17.4523</div>'
+        + filler
+        + "</body></html>"
+    ).encode()
+
+
+def run_scanner(data: bytes):
+    scanner = main.GoogleRateScanner()
+    for i in range(0, len(data), CHUNK):
+        if scanner.feed(data[i:i + CHUNK]):
+            break
+    return scanner.result()
+
+
+def run_soup(data: bytes):
+    return main._parse_google_html(data.decode("utf-8", errors="replace"))
+
+
+def measure(fn, data: bytes):
+    t0 = time.perf_counter()
+    for _ in range(ROUNDS):
+        value = fn(data)
+    per_call = (time.perf_counter() - t0) / ROUNDS
+
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, per_call, peak
+
+
+def main_bench(paths):
+    pages = [(p, open(p, "rb").read()) for p in paths]
+    if not pages:
+        pages = [("synthetic", synthetic_page())]
+
+    for name, data in pages:
+        print(f"{name}: {len(data) / 1024:.0f} КБ")
+        results = {}
+        for label, fn in (("soup", run_soup), ("scanner", run_scanner)):
+            value, per_call, peak = measure(fn, data)
+            results[label] = per_call
+            print(
+                f"  {label:8} {per_call * 1000:8.2f} мс  "
+                f"пик памяти {peak / 1024:8.0f} КБ  значение {value}"
+            )
+        if results["scanner"]:
+            print(f"  ускорение x{results['soup'] / results['scanner']:.0f}")
+
+
+if __name__ == "__main__":
+    main_bench(sys.argv[1:])
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный прогон main.py без сети: настоящие хендлеры и рассылка
+автообновлений против локального фейкового Bot API и заглушек бирж.
+
+Запуск:
+    python bench_load.py                          # 100 пользователей
+    python bench_load.py --users 10000 --requests 20000 --workers 64
+    python bench_load.py --tg-latency 0.05 --tg-errors 0.02 --json out.json
+    python bench_load.py --recordings recorded/   # свои ответы бирж
+
+В папке --recordings можно положить upbit.json, bithumb.json,
+google.html, er_api.json, abcex.json — иначе берутся встроенные образцы.
+
+Отчёт: пропускная способность, p50/p95/p99 по хендлерам, число вызовов
+Bot API по методам, время доставки автообновлений и память процесса.
+--json сохраняет тот же отчёт для сравнения прогонов.
+
+Фейковый сервер живёт в том же процессе, поэтому при большом --workers
+в задержки входит и борьба за GIL — сравнивайте прогоны с одинаковыми
+параметрами.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+TOKEN = "0:bench"
+SUBSCRIBER_BASE = 10**9
+
+SAMPLES = {
+    "upbit": json.dumps([{"market": "KRW-USDT", "trade_price": 1452.0}]),
+    "bithumb": json.dumps({"status": "0000", "data": {"closing_price": "1450"}}),
+    "google": (
+        '<html><body><div class="YMlKec fxKbKc">15.50</div></body></html>'
+    ),
+    "er_api": json.dumps({"result": "success", "rates": {"KRW": 15.5}}),
+    "abcex": json.dumps({
+        "ask": [{"price": str(95.5 + i / 100), "volume": "800"} for i in range(200)],
+        "bid": [{"price": str(95.4 - i / 100), "volume": "800"} for i in range(200)],
+    }),
+}
+
+ROUTES = {
+    "/v1/ticker": "upbit",
+    "/public/ticker/USDT_KRW": "bithumb",
+    "/finance/quote/RUB-KRW": "google",
+    "/v6/latest/RUB": "er_api",
+    "/api/v2/exchange/public/orderbook/depth": "abcex",
+}
+
+
+class FakeServer(BaseHTTPRequestHandler):
+    """Один сервер на всё: /bot<token>/<method> — Bot API, остальное — биржи."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+    disable_nagle_algorithm = True
+    opts = None
+    responses = {}
+    calls = Counter()
+    lock = threading.Lock()
+    message_id = 0
+    auto_delivered = 0  # sendMessage в чаты подписчиков (id >= SUBSCRIBER_BASE)
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body: str, ctype="application/json"):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        if path.startswith("/bot"):
+            self._telegram(path.rsplit("/", 1)[-1], self.path.partition("?")[2])
+        else:
+            self._exchange(path)
+
+    def _telegram(self, method: str, query: str):
+        opts = self.opts
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        # pyTelegramBotAPI шлёт параметры в строке запроса
+        params = parse_qs(query)
+        if not params and body and not self.headers.get(
+            "Content-Type", ""
+        ).startswith("multipart"):
+            params = parse_qs(body.decode(errors="replace"))
+        chat_id = int((params.get("chat_id") or ["0"])[0])
+        with self.lock:
+            self.calls[method] += 1
+            FakeServer.message_id += 1
+            message_id = FakeServer.message_id
+        time.sleep(opts.tg_latency)
+
+        if random.random() < opts.tg_errors:
+            with self.lock:
+                self.calls[f"{method}:429"] += 1
+            self._reply(429, json.dumps({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }))
+            return
+
+        result = {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"}, "text": "ok",
+        }
+        if method in ("answerCallbackQuery", "setMyCommands"):
+            result = True
+        if method == "sendMessage" and chat_id >= SUBSCRIBER_BASE:
+            with self.lock:
+                FakeServer.auto_delivered += 1
+        self._reply(200, json.dumps({"ok": True, "result": result}))
+
+    def _exchange(self, path: str):
+        opts = self.opts
+        source = ROUTES.get(path)
+        with self.lock:
+            self.calls[f"exchange:{source or path}"] += 1
+        time.sleep(opts.exchange_latency)
+        if source is None or random.random() < opts.exchange_errors:
+            self._reply(503, "{}")
+            return
+        ctype = "text/html" if source == "google" else "application/json"
+        self._reply(200, self.responses[source], ctype)
+
+
+def load_responses(directory: str) -> dict:
+    responses = dict(SAMPLES)
+    if directory:
+        for source in SAMPLES:
+            for ext in ("json", "html"):
+                path = os.path.join(directory, f"{source}.{ext}")
+                if os.path.exists(path):
+                    with open(path, encoding="utf-8") as fh:
+                        responses[source] = fh.read()
+    return responses
+
+
+def start_fake_server(opts) -> str:
+    FakeServer.opts = opts
+    FakeServer.responses = load_responses(opts.recordings)
+    # иначе очередь accept на 5 соединений и хвост в 1 с из-за повтора SYN
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServer)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def make_update(main, update_id: int, uid: int, action: str):
+    from telebot import types
+
+    user = {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+    chat = {"id": uid, "type": "private"}
+    if action.startswith("auto_"):
+        return types.Update.de_json({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id), "from": user, "chat_instance": "1",
+                "data": action,
+                "message": {
+                    "message_id": 1, "date": 0, "chat": chat, "text": "menu",
+                },
+            },
+        })
+    return types.Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": chat, "from": user, "text": action,
+        },
+    })
+
+
+def run(opts) -> dict:
+    base = start_fake_server(opts)
+    os.environ.update({
+        "TELEGRAM_TOKEN": TOKEN,
+        "STORE_BACKEND": "none",
+        "HISTORY_DIR": "",
+        "UPBIT_API": base,
+        "BITHUMB_API": base,
+        "GOOGLE_FINANCE_API": base,
+        "ER_API": base,
+        "ABCEX_API": base,
+        "SEND_GLOBAL_RATE": str(opts.send_rate),
+    })
+    from telebot import apihelper
+
+    apihelper.API_URL = base + "/bot{0}/{1}"
+    import main
+
+    # тихие часы не должны зависеть от времени запуска прогона
+    main.is_quiet_hours = lambda now: False
+    main.skip_quiet_hours = lambda due: due
+    main.bot.threaded = False
+    main.instrument_telegram_api()
+    main.instrument_handlers(main.bot)
+    main.OUTBOX.start()
+    for target in (main.LOG_SINK.run, main.rate_refresh_loop,
+                   main.auto_update_loop, main.PROGRESS.run):
+        threading.Thread(target=target, daemon=True).start()
+    main.wait_rate_snapshot(timeout=30)
+
+    actions = [
+        (main.BTN_SHOW, opts.mix_show),
+        (main.BTN_AUTO, opts.mix_auto),
+        ("auto_1h", opts.mix_callback),
+        (main.BTN_PROFILE, opts.mix_profile),
+    ]
+    names = {
+        main.BTN_SHOW: "show_rate", main.BTN_AUTO: "toggle_auto",
+        "auto_1h": "auto_callback", main.BTN_PROFILE: "profile",
+    }
+    population = [a for a, _ in actions]
+    weights = [w for _, w in actions]
+    rnd = random.Random(opts.seed)
+    plan = [
+        (i + 1, rnd.randint(1, opts.users), rnd.choices(population, weights)[0])
+        for i in range(opts.requests)
+    ]
+
+    latencies = defaultdict(list)
+    errors = Counter()
+    lat_lock = threading.Lock()
+
+    def handle(item):
+        update_id, uid, action = item
+        upd = make_update(main, update_id, uid, action)
+        t0 = time.perf_counter()
+        try:
+            main.bot.process_new_updates([upd])
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        dt = time.perf_counter() - t0
+        with lat_lock:
+            latencies[names[action]].append(dt)
+
+    FakeServer.calls.clear()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=opts.workers) as ex:
+        list(ex.map(handle, plan))
+    handlers_time = time.perf_counter() - t0
+    handler_calls = dict(FakeServer.calls)
+
+    # рассылка: все подписчики «просрочены» и уходят одним проходом
+    main.AUTO_USERS.clear()
+    now = main.now_msk()
+    t0 = time.perf_counter()
+    for cid in range(SUBSCRIBER_BASE, SUBSCRIBER_BASE + opts.subscribers):
+        main.set_auto_user(
+            cid, main.AUTO_INTERVAL_1H,
+            now - timedelta(seconds=main.AUTO_INTERVAL_1H + 1),
+        )
+    deadline = t0 + opts.timeout
+    while time.perf_counter() < deadline:
+        if FakeServer.auto_delivered >= opts.subscribers:
+            break
+        time.sleep(0.05)
+    auto_time = time.perf_counter() - t0
+    delivered = FakeServer.auto_delivered
+
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report = {
+        "users": opts.users,
+        "requests": opts.requests,
+        "workers": opts.workers,
+        "throughput_rps": round(opts.requests / handlers_time, 1),
+        "handlers": {
+            name: {
+                "count": len(v),
+                "p50_ms": round(percentile(v, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(v, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(v, 0.99) * 1000, 2),
+            }
+            for name, v in sorted(latencies.items())
+        },
+        "handler_errors": dict(errors),
+        "outbound_calls": handler_calls,
+        "auto_update": {
+            "subscribers": opts.subscribers,
+            "delivered": delivered,
+            "seconds": round(auto_time, 2),
+        },
+        "outbox": dict(main.OUTBOX.stats),
+        "max_rss_mb": round(rss_kb / 1024, 1),
+    }
+    return report
+
+
+def print_report(r: dict) -> None:
+    print(
+        f"{r['requests']} запросов от {r['users']} пользователей, "
+        f"{r['workers']} потоков: {r['throughput_rps']} запр/с"
+    )
+    print(f"{'хендлер':16}{'число':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for name, h in r["handlers"].items():
+        print(
+            f"{name:16}{h['count']:>8}{h['p50_ms']:>10}"
+            f"{h['p95_ms']:>10}{h['p99_ms']:>10}"
+        )
+    if r["handler_errors"]:
+        print("ошибки:", r["handler_errors"])
+    print("вызовы наружу:")
+    for method, n in sorted(r["outbound_calls"].items()):
+        print(f"  {method:32}{n:>8}")
+    a = r["auto_update"]
+    print(
+        f"автообновление: {a['delivered']}/{a['subscribers']} "
+        f"за {a['seconds']} с"
+    )
+    print(f"память (max RSS): {r['max_rss_mb']} МБ")
+
+
+def main_bench(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--requests", type=int, default=1000)
+    p.add_argument("--workers", type=int, default=16)
+    p.add_argument("--subscribers", type=int, default=200)
+    p.add_argument("--send-rate", type=float, default=30)
+    p.add_argument("--timeout", type=float, default=120)
+    p.add_argument("--tg-latency", type=float, default=0.0)
+    p.add_argument("--tg-errors", type=float, default=0.0)
+    p.add_argument("--exchange-latency", type=float, default=0.0)
+    p.add_argument("--exchange-errors", type=float, default=0.0)
+    p.add_argument("--recordings", default="")
+    p.add_argument("--mix-show", type=float, default=6)
+    p.add_argument("--mix-auto", type=float, default=1)
+    p.add_argument("--mix-callback", type=float, default=1)
+    p.add_argument("--mix-profile", type=float, default=2)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", default="")
+    opts = p.parse_args(argv)
+
+    report = run(opts)
+    print_report(report)
+    if opts.json:
+        with open(opts.json, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2)
+    sys.stdout.flush()
+    os._exit(0)  # фоновые потоки бота бесконечны
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Память на пользователя: прежнее представление (dict + aware datetime
+на запись) против компактного реестра из main.py (__slots__, epoch int).
+
+Запуск:
+    python bench_memory.py                  # 100 000 пользователей
+    python bench_memory.py 500000 --subs 0.3
+"""
+import argparse
+import gc
+import os
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+
+import main  # noqa: E402
+
+
+def build_old(n: int, subs: int):
+    stats = defaultdict(lambda: {"requests": 0, "last": None})
+    auto = {}
+    now = time.time()
+    for i in range(n):
+        uid = 10**9 + i
+        s = stats[uid]
+        s["requests"] = i % 50
+        s["last"] = datetime.fromtimestamp(now - i, main.MOSCOW_TZ)
+        if i < subs:
+            auto[int(str(uid))] = {
+                "interval": main.AUTO_INTERVAL_1H,
+                "last": datetime.fromtimestamp(now - i, main.MOSCOW_TZ),
+            }
+    return stats, auto
+
+
+def build_new(n: int, subs: int):
+    stats = main.StatsRegistry()
+    auto = {}
+    now = int(time.time())
+    for i in range(n):
+        uid = 10**9 + i
+        stats.restore(uid, i % 50, now - i)
+        if i < subs:
+            auto[uid] = main.AutoSub(main.AUTO_INTERVAL_1H, now - i)
+    return stats, auto
+
+
+def measure(fn, n: int, subs: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    data = fn(n, subs)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size
+
+
+def main_bench():
+    p = argparse.ArgumentParser()
+    p.add_argument("users", type=int, nargs="?", default=100_000)
+    p.add_argument("--subs", type=float, default=0.2,
+                   help="доля пользователей с автообновлением")
+    args = p.parse_args()
+    subs = int(args.users * args.subs)
+
+    old = measure(build_old, args.users, subs)
+    new = measure(build_new, args.users, subs)
+    print(f"{args.users} пользователей, {subs} подписок")
+    print(f"  было  {old / 2**20:8.1f} МБ  {old / args.users:6.0f} байт/польз.")
+    print(f"  стало {new / 2**20:8.1f} МБ  {new / args.users:6.0f} байт/польз.")
+    print(f"  в {old / new:.1f} раза меньше")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Холодный старт main.py: время импорта и время от запуска процесса
+до ответа на первый апдейт (против локального фейкового Bot API).
+
+Запуск:
+    python bench_startup.py                 # 5 прогонов, бюджет 1 с
+    python bench_startup.py --runs 10 --budget 0.8
+    python bench_startup.py --store bot_state.db   # со своим хранилищем
+
+Код выхода 1, если медиана первого ответа вышла за --budget, — можно
+ставить в CI, чтобы старт не расползался. Ниже отчёта — самые тяжёлые
+импорты (python -X importtime), чтобы было видно, что именно выросло.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKEN = "0:bench"
+CHAT_ID = 42
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeTelegram(BaseHTTPRequestHandler):
+    """
+    getUpdates отдаёт один /start, дальше пусто; первый sendMessage в
+    CHAT_ID отмечает момент ответа. Биржи отвечают 503 — для первого
+    ответа они не нужны.
+    """
+
+    protocol_version = "HTTP/1.1"
+    answered = threading.Event()
+    answered_at = 0.0
+    delivered = False
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, payload) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        path, _, query = self.path.partition("?")
+        if not path.startswith("/bot"):
+            self._reply(503, {})
+            return
+        method = path.rsplit("/", 1)[-1]
+        cls = FakeTelegram
+        result = True
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench",
+                      "username": "bench_bot"}
+        elif method == "getUpdates":
+            if cls.delivered:
+                time.sleep(0.2)
+                result = []
+            else:
+                cls.delivered = True
+                result = [{
+                    "update_id": 1,
+                    "message": {
+                        "message_id": 1, "date": int(time.time()),
+                        "chat": {"id": CHAT_ID, "type": "private"},
+                        "from": {"id": CHAT_ID, "is_bot": False,
+                                 "first_name": "bench"},
+                        "text": "/start",
+                    },
+                }]
+        elif method == "sendMessage":
+            if f"chat_id={CHAT_ID}" in query and not cls.answered.is_set():
+                cls.answered_at = time.perf_counter()
+                cls.answered.set()
+            result = {
+                "message_id": 1, "date": int(time.time()),
+                "chat": {"id": CHAT_ID, "type": "private"}, "text": "ok",
+            }
+        self._reply(200, {"ok": True, "result": result})
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # обрывы от убитых процессов бота — норма
+
+
+def start_fake_server() -> str:
+    server = Server(("127.0.0.1", 0), FakeTelegram)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def bench_env(base: str, store: str) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": TOKEN,
+        "STORE_BACKEND": "sqlite" if store else "none",
+        "STORE_PATH": store,
+        "HISTORY_DIR": "",
+        "UPBIT_API": base,
+        "BITHUMB_API": base,
+        "GOOGLE_FINANCE_API": base,
+        "ER_API": base,
+        "ABCEX_API": base,
+        "PORT": "0",
+    })
+    return env
+
+
+def import_time(env: dict) -> float:
+    code = (
+        "import sys, time; t = time.perf_counter(); import main; "
+        "print(time.perf_counter() - t)"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], env=env, cwd=HERE,
+        capture_output=True, text=True, check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def first_update_time(base: str, env: dict, timeout: float) -> float:
+    """От запуска интерпретатора до ответа на /start; как python -m main."""
+    code = (
+        "from telebot import apihelper; "
+        f"apihelper.API_URL = {base!r} + '/bot{{0}}/{{1}}'; "
+        "import runpy; runpy.run_module('main', run_name='__main__')"
+    )
+    FakeTelegram.answered.clear()
+    FakeTelegram.delivered = False
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-c", code], env=env, cwd=HERE,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not FakeTelegram.answered.wait(timeout):
+            raise RuntimeError(f"нет ответа за {timeout} с")
+        return FakeTelegram.answered_at - t0
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def heaviest_imports(env: dict, top: int) -> list:
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        env=env, cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # заголовок
+        # только прямые импорты main: вложенные уже входят в них
+        if name.startswith("   ") and not name.startswith("     "):
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main_bench(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--budget", type=float, default=1.0,
+                   help="допустимая медиана до первого ответа, с")
+    p.add_argument("--timeout", type=float, default=15)
+    p.add_argument("--store", default="",
+                   help="SQLite-хранилище для load_state (по умолчанию без него)")
+    p.add_argument("--top", type=int, default=10)
+    args = p.parse_args(argv)
+
+    base = start_fake_server()
+    env = bench_env(base, args.store)
+    # первый прогон прогревает __pycache__, его не считаем
+    import_time(env)
+    imports = [import_time(env) for _ in range(args.runs)]
+    starts = [
+        first_update_time(base, env, args.timeout) for _ in range(args.runs)
+    ]
+
+    print(f"{args.runs} прогонов")
+    print(f"  импорт main         медиана {statistics.median(imports):.3f} с"
+          f"  (мин {min(imports):.3f})")
+    first = statistics.median(starts)
+    print(f"  до первого ответа   медиана {first:.3f} с"
+          f"  (мин {min(starts):.3f}, бюджет {args.budget} с)")
+    print("самые тяжёлые импорты:")
+    for seconds, name in heaviest_imports(env, args.top):
+        print(f"  {seconds * 1000:7.1f} мс  {name}")
+    return 0 if first <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -1,19 +1,39 @@
 # -*- coding: utf-8 -*-
 import os
+import asyncio
+import atexit
+import bisect
+import mmap
+import json
 import logging
+import math
 import threading
 import time
 import concurrent.futures
+import contextlib
+import heapq
+import hmac
+import queue
+import random
+import re
+import signal
+import socket
+import sqlite3
 from datetime import datetime, timedelta, timezone
+from array import array
 from collections import defaultdict
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import telebot
 from telebot import types
 from telebot.apihelper import ApiTelegramException
-from bs4 import BeautifulSoup
-from flask import Flask
 
 # ============== НАСТРОЙКИ ==============
 load_dotenv()
@@ -23,6 +43,21 @@ if not TELEGRAM_TOKEN:
 
 bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
 
+# режим работы: threads — TeleBot и потоки, async — AsyncTeleBot на asyncio
+BOT_MODE = os.getenv("BOT_MODE", "threads")
+
+# приём обновлений: polling — long polling, webhook — POST от Telegram на Flask
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.getenv(
+    "WEBHOOK_URL", "https://telegram-rate-bot-ooc6.onrender.com"
+)
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_LIMIT = int(os.getenv("WEBHOOK_QUEUE_LIMIT", "1000"))
+if UPDATE_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise RuntimeError("Для UPDATE_MODE=webhook нужен WEBHOOK_SECRET")
+
 # чат для логов (канал/чат, главное — ID)
 ADMIN_LOG_CHAT_ID = -1003264764082
 MOSCOW_TZ = timezone(timedelta(hours=3))
@@ -32,15 +67,154 @@ BTN_SHOW = "📊 Показать курс"
 BTN_AUTO = "🔔 Автообновление"
 BTN_PROFILE = "👤 Профиль"
 BTN_DISABLE = "🚫 Отключить уведомления"
+BTN_ARB = "💹 Арбитраж"
 
 # Интервалы автообновления
 AUTO_INTERVAL_1H = 60 * 60
 AUTO_INTERVAL_5H = 5 * 60 * 60
 AUTO_INTERVAL_24H = 24 * 60 * 60
 
-# Память о пользователях
-AUTO_USERS = {}  # chat_id -> {"interval": int, "last": datetime}
-USER_STATS = defaultdict(lambda: {"requests": 0, "last": None})
+# Память о пользователях. Время везде — целые секунды epoch (0 — не было):
+# aware datetime на запись стоит в разы больше, чем сама запись.
+
+# сколько записей статистики держать в памяти (0 — все); вытесненные
+# подгружаются из хранилища (только sqlite) при следующем обращении
+STATS_LIMIT = int(os.getenv("STATS_LIMIT", "0"))
+
+
+class AutoSub:
+    """Подписка на автообновление: интервал и время последней отправки."""
+
+    __slots__ = ("interval", "last")
+
+    def __init__(self, interval: int, last: int = 0):
+        self.interval = interval
+        self.last = last
+
+
+class UserStats:
+    """Счётчик запросов курса и время последнего (значение, не ссылка)."""
+
+    __slots__ = ("requests", "last")
+
+    def __init__(self, count: int = 0, last: int = 0):
+        self.requests = count
+        self.last = last
+
+
+class StatsRegistry:
+    """
+    user_id -> (число запросов, время последнего) в трёх плоских массивах
+    с открытой адресацией: ~20-40 байт на пользователя вместо ~370 у
+    dict + datetime. Ключ 0 — пустая ячейка (id в Telegram всегда > 0).
+    Чтение не создаёт записей. При STATS_LIMIT в памяти остаются самые
+    недавно активные, остальные подгружаются из хранилища с load_stats.
+    """
+
+    MAX_LOAD = 0.7
+
+    def __init__(self, limit: int = 0, capacity: int = 1024):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._n = 0
+        self._alloc(capacity)
+
+    def _alloc(self, capacity: int) -> None:
+        self._keys = array("q", bytes(8 * capacity))
+        self._requests = array("I", bytes(4 * capacity))
+        self._last = array("I", bytes(4 * capacity))
+        self._mask = capacity - 1
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _slot(self, uid: int) -> int:
+        """Ячейка с этим uid или первая пустая на его пути."""
+        keys, mask = self._keys, self._mask
+        i = (uid * 0x9E3779B1 >> 8) & mask
+        while True:
+            k = keys[i]
+            if k == uid or k == 0:
+                return i
+            i = (i + 1) & mask
+
+    def _items(self):
+        keys, counts, last = self._keys, self._requests, self._last
+        for i, k in enumerate(keys):
+            if k:
+                yield k, counts[i], last[i]
+
+    def _rebuild(self, capacity: int, items) -> None:
+        self._alloc(capacity)
+        self._n = 0
+        for uid, count, last in items:
+            self._put(uid, count, last)
+
+    def _put(self, uid: int, count: int, last: int) -> None:
+        if (self._n + 1) > self.MAX_LOAD * (self._mask + 1):
+            self._rebuild(2 * (self._mask + 1), list(self._items()))
+        i = self._slot(uid)
+        if not self._keys[i]:
+            self._keys[i] = uid
+            self._n += 1
+        self._requests[i] = count
+        self._last[i] = last
+
+    def get(self, uid):
+        with self._lock:
+            i = self._slot(uid)
+            if self._keys[i]:
+                return UserStats(self._requests[i], self._last[i])
+        return self._reload(uid) if self.limit else None
+
+    def restore(self, uid, count: int, last: int) -> None:
+        with self._lock:
+            self._put(uid, count, last)
+
+    def touch(self, uid, now: int) -> UserStats:
+        """+1 запрос. Возвращает новые значения."""
+        with self._lock:
+            i = self._slot(uid)
+            known = bool(self._keys[i])
+        s = None if known else self._reload(uid)
+        with self._lock:
+            i = self._slot(uid)
+            if self._keys[i]:
+                count = self._requests[i] + 1
+            else:
+                count = (s.requests if s else 0) + 1
+            self._put(uid, count, now)
+            if (
+                self.limit
+                and self._n > self.limit * 1.1
+                and hasattr(STORE.backend, "load_stats")
+            ):
+                self._evict()
+        return UserStats(count, now)
+
+    def _evict(self) -> None:
+        """Оставить limit самых недавно активных (пачкой, раз в 10% роста)."""
+        items = list(self._items())
+        cutoff = heapq.nlargest(self.limit, (r[2] for r in items))[-1]
+        keep = [r for r in items if r[2] >= cutoff]
+        capacity = 1024
+        while capacity * self.MAX_LOAD < len(keep) * 2:
+            capacity *= 2
+        self._rebuild(capacity, keep)
+
+    def _reload(self, uid):
+        """Вытесненная запись: сначала из ещё не сброшенных, потом с диска."""
+        backend = STORE.backend
+        if not hasattr(backend, "load_stats"):
+            return None
+        row = STORE.pending(KIND_STATS, uid) or backend.load_stats(uid)
+        if not row:
+            return None
+        return UserStats(row["requests"], int(row["last"] or 0))
+
+
+AUTO_USERS = {}  # chat_id -> AutoSub
+USER_STATS = StatsRegistry(STATS_LIMIT)
 ALL_USERS = set()  # user_id
 
 logging.basicConfig(level=logging.INFO)
@@ -56,19 +230,19 @@ def fmt_num(v, d: int = 2) -> str:
 
 
 def log_to_channel(text: str) -> None:
-    try:
-        bot.send_message(ADMIN_LOG_CHAT_ID, text)
-    except Exception:
-        pass
+    """Не блокирует: событие уходит в канал пачкой через LOG_SINK."""
+    LOG_SINK.emit(text)
 
 
 def update_user_stats(user) -> None:
-    USER_STATS[user.id]["requests"] += 1
-    USER_STATS[user.id]["last"] = now_msk()
+    s = USER_STATS.touch(user.id, int(time.time()))
+    STORE.add(KIND_STATS, user.id, {"requests": s.requests, "last": s.last}, 1)
 
 
 def remember_user(user) -> None:
-    ALL_USERS.add(user.id)
+    if user.id not in ALL_USERS:
+        ALL_USERS.add(user.id)
+        STORE.put(KIND_USER, user.id, True)
 
 
 def pretty_name(user) -> str:
@@ -84,12 +258,16 @@ def pretty_name(user) -> str:
     return full or "пользователь без имени"
 
 
+def user_action_text(user, action: str) -> str:
+    return (
+        f"👤 {pretty_name(user)} (ID {user.id})\n"
+        f"🕒 {now_msk().strftime('%d.%m.%Y %H:%M:%S')} МСК\n➡️ {action}"
+    )
+
+
 def log_user_action(user, action: str) -> None:
     try:
-        log_to_channel(
-            f"👤 {pretty_name(user)} (ID {user.id})\n"
-            f"🕒 {now_msk().strftime('%d.%m.%Y %H:%M:%S')} МСК\n➡️ {action}"
-        )
+        log_to_channel(user_action_text(user, action))
     except Exception:
         pass
 
@@ -104,493 +282,4095 @@ def human_interval(s: int) -> str:
     return f"каждые {s // 3600} ч."
 
 
-# ============== API ==============
+# ============== ХРАНИЛИЩЕ ==============
 
-def get_upbit_usdt_krw():
-    """
-    Курс USDT/KRW на Upbit (через пару KRW-USDT).
-    """
-    cache = getattr(get_upbit_usdt_krw, "_cache", None)
-    try:
-        r = requests.get(
-            "https://api.upbit.com/v1/ticker",
-            params={"markets": "KRW-USDT"},
-            headers={"User-Agent": "Mozilla/5.0"},
-            timeout=4,
-        )
-        r.raise_for_status()
-        data = r.json()
-        price = float(data[0]["trade_price"])
-        get_upbit_usdt_krw._cache = price
-        return price
-    except Exception as e:
-        logger.warning(f"Upbit error: {e}")
-        return cache
+# sqlite (по умолчанию), log — журнал JSON-строк, none — только память
+STORE_BACKEND = os.getenv("STORE_BACKEND", "sqlite")
+STORE_PATH = os.getenv("STORE_PATH", "")
+STORE_FLUSH_INTERVAL = float(os.getenv("STORE_FLUSH_INTERVAL", "2"))
 
+# виды записей: подписка на автообновление, статистика, известный пользователь,
+# оповещение, версия reply-клавиатуры в чате
+KIND_AUTO = "auto"
+KIND_STATS = "stats"
+KIND_USER = "user"
+KIND_ALERT = "alert"
+KIND_KEYBOARD = "keyboard"
 
-def get_bithumb_usdt_krw():
-    """
-    Курс USDT/KRW на Bithumb.
-    """
-    cache = getattr(get_bithumb_usdt_krw, "_cache", None)
-    try:
-        r = requests.get(
-            "https://api.bithumb.com/public/ticker/USDT_KRW",
-            headers={"User-Agent": "Mozilla/5.0"},
-            timeout=4,
-        )
-        data = r.json()
-        price = float(data["data"]["closing_price"])
-        get_bithumb_usdt_krw._cache = price
-        return price
-    except Exception as e:
-        logger.warning(f"Bithumb error: {e}")
-        return cache
 
+def _dt(ts):
+    return datetime.fromtimestamp(ts, MOSCOW_TZ) if ts else None
 
-def get_krw_rub_from_google():
-    """
-    Возвращает, сколько РУБЛЕЙ за 1 000 000 KRW.
-    Сначала Google Finance RUB/KRW, потом резервный open.er-api.
-    """
-    cache = getattr(get_krw_rub_from_google, "_cache", None)
-    last = getattr(get_krw_rub_from_google, "_last", 0)
 
-    # кэш 30 минут
-    if cache is not None and time.time() - last < 1800:
-        return cache
+class SqliteStore:
+    """SQLite в режиме WAL. Пишет пачками в одной транзакции."""
 
-    # Google Finance
-    try:
-        r = requests.get(
-            "https://www.google.com/finance/quote/RUB-KRW?hl=en",
-            headers={"User-Agent": "Mozilla/5.0"},
-            timeout=5,
-        )
-        soup = BeautifulSoup(r.text, "html.parser")
-        div = soup.find("div", class_="YMlKec fxKbKc")
-        if div:
-            # значение KRW за 1 RUB
-            v = float(div.text.replace(",", "").replace("₩", ""))
-            # 1 RUB = v KRW => 1 KRW = 1/v RUB => 1e6 KRW = 1e6 * (1/v)
-            million_rub = 1_000_000 / v
-            get_krw_rub_from_google._cache = million_rub
-            get_krw_rub_from_google._last = time.time()
-            return million_rub
-    except Exception as e:
-        logger.warning(f"Google Finance error: {e}")
+    def __init__(self, path: str):
+        self.path = path
+        # timeout — ожидание блокировки, если файл делят несколько процессов
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.track_changes = False  # журнал изменений подписок для реплик
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS auto_users (
+                    chat_id INTEGER PRIMARY KEY,
+                    interval INTEGER NOT NULL,
+                    last REAL,
+                    next_due REAL
+                );
+                CREATE INDEX IF NOT EXISTS auto_users_next_due
+                    ON auto_users (next_due);
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id INTEGER PRIMARY KEY,
+                    requests INTEGER NOT NULL,
+                    last REAL
+                );
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY
+                );
+                CREATE TABLE IF NOT EXISTS auto_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    ts REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS alerts (
+                    alert_id TEXT PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    metric TEXT NOT NULL,
+                    op TEXT NOT NULL,
+                    threshold REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS alert_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    alert_id TEXT NOT NULL,
+                    ts REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS keyboards (
+                    chat_id INTEGER PRIMARY KEY,
+                    version INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS rate_snapshot (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    fetched REAL NOT NULL
+                );
+                """
+            )
 
-    # Резервный API
-    try:
-        r = requests.get("https://open.er-api.com/v6/latest/RUB", timeout=5)
-        data = r.json()
-        if data.get("result") == "success" and "KRW" in data.get("rates", {}):
-            krw_per_rub = data["rates"]["KRW"]  # KRW за 1 RUB
-            # 1 RUB = krw_per_rub KRW => 1 KRW = 1/krw_per_rub RUB
-            million_rub = 1_000_000 / krw_per_rub
-            get_krw_rub_from_google._cache = million_rub
-            get_krw_rub_from_google._last = time.time()
-            return million_rub
-    except Exception as e:
-        logger.warning(f"open.er-api error: {e}")
+    def load(self) -> dict:
+        with self._lock:
+            return {
+                KIND_AUTO: {
+                    cid: {"interval": interval, "last": last, "next_due": due}
+                    for cid, interval, last, due in self._db.execute(
+                        "SELECT chat_id, interval, last, next_due"
+                        " FROM auto_users"
+                    )
+                },
+                KIND_STATS: {
+                    uid: {"requests": requests, "last": last}
+                    for uid, requests, last in self._db.execute(
+                        "SELECT user_id, requests, last FROM user_stats"
+                    )
+                },
+                KIND_USER: {
+                    uid: True
+                    for (uid,) in self._db.execute("SELECT user_id FROM users")
+                },
+                KIND_ALERT: {
+                    aid: {"chat_id": cid, "metric": metric, "op": op,
+                          "threshold": threshold}
+                    for aid, cid, metric, op, threshold in self._db.execute(
+                        "SELECT alert_id, chat_id, metric, op, threshold"
+                        " FROM alerts"
+                    )
+                },
+                KIND_KEYBOARD: dict(self._db.execute(
+                    "SELECT chat_id, version FROM keyboards"
+                )),
+            }
+
+    def load_stats(self, uid):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT requests, last FROM user_stats WHERE user_id = ?",
+                (uid,),
+            ).fetchone()
+        return {"requests": row[0], "last": row[1]} if row else None
 
-    return cache
+    def write(self, ops: dict) -> None:
+        """ops: (вид, ключ) -> значение или None для удаления."""
+        sql_put = {
+            KIND_AUTO: (
+                "INSERT OR REPLACE INTO auto_users VALUES (?, ?, ?, ?)",
+                lambda k, v: (k, v["interval"], v["last"], v.get("next_due")),
+            ),
+            # приращение, а не перезапись: таблицу делят реплики
+            KIND_STATS: (
+                "INSERT INTO user_stats VALUES (?, ?, ?)"
+                " ON CONFLICT(user_id) DO UPDATE SET"
+                " requests = requests + excluded.requests,"
+                " last = MAX(COALESCE(last, 0), excluded.last)",
+                lambda k, v: (k, v["added"], v["last"]),
+            ),
+            KIND_USER: (
+                "INSERT OR IGNORE INTO users VALUES (?)",
+                lambda k, v: (k,),
+            ),
+            KIND_ALERT: (
+                "INSERT OR REPLACE INTO alerts VALUES (?, ?, ?, ?, ?)",
+                lambda k, v: (
+                    k, v["chat_id"], v["metric"], v["op"], v["threshold"]
+                ),
+            ),
+            KIND_KEYBOARD: (
+                "INSERT OR REPLACE INTO keyboards VALUES (?, ?)",
+                lambda k, v: (k, v),
+            ),
+        }
+        sql_del = {
+            KIND_AUTO: "DELETE FROM auto_users WHERE chat_id = ?",
+            KIND_STATS: "DELETE FROM user_stats WHERE user_id = ?",
+            KIND_USER: "DELETE FROM users WHERE user_id = ?",
+            KIND_ALERT: "DELETE FROM alerts WHERE alert_id = ?",
+            KIND_KEYBOARD: "DELETE FROM keyboards WHERE chat_id = ?",
+        }
+        now = time.time()
+        with self._lock, self._db:
+            for (kind, key), value in ops.items():
+                if value is None:
+                    self._db.execute(sql_del[kind], (key,))
+                else:
+                    sql, row = sql_put[kind]
+                    self._db.execute(sql, row(key, value))
+                if kind == KIND_AUTO and self.track_changes:
+                    self._db.execute(
+                        "INSERT INTO auto_changes (chat_id, ts) VALUES (?, ?)",
+                        (key, now),
+                    )
+                if kind == KIND_ALERT and self.track_changes:
+                    self._db.execute(
+                        "INSERT INTO alert_changes (alert_id, ts) VALUES (?, ?)",
+                        (key, now),
+                    )
 
+    # --- общие данные для нескольких реплик ---
 
-def get_abcex_usdt_rub():
+    def last_change_seq(self) -> int:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MAX(seq) FROM auto_changes"
+            ).fetchone()
+            return row[0] or 0
+
+    def changes_since(self, seq: int):
+        """(новый seq, [(chat_id, interval или None, last, next_due)])."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT c.seq, c.chat_id, a.interval, a.last, a.next_due"
+                " FROM auto_changes c"
+                " LEFT JOIN auto_users a ON a.chat_id = c.chat_id"
+                " WHERE c.seq > ? ORDER BY c.seq",
+                (seq,),
+            ).fetchall()
+        if not rows:
+            return seq, []
+        latest = {
+            cid: (cid, interval, last, due)
+            for _, cid, interval, last, due in rows
+        }
+        return rows[-1][0], list(latest.values())
+
+    def last_alert_change_seq(self) -> int:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MAX(seq) FROM alert_changes"
+            ).fetchone()
+            return row[0] or 0
+
+    def alert_changes_since(self, seq: int):
+        """(новый seq, [(alert_id, поля оповещения или None)])."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT c.seq, c.alert_id, a.chat_id, a.metric, a.op,"
+                " a.threshold FROM alert_changes c"
+                " LEFT JOIN alerts a ON a.alert_id = c.alert_id"
+                " WHERE c.seq > ? ORDER BY c.seq",
+                (seq,),
+            ).fetchall()
+        if not rows:
+            return seq, []
+        latest = {
+            aid: (aid, None if cid is None else {
+                "chat_id": cid, "metric": metric, "op": op,
+                "threshold": threshold,
+            })
+            for _, aid, cid, metric, op, threshold in rows
+        }
+        return rows[-1][0], list(latest.values())
+
+    def prune_changes(self, older_than: float) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM auto_changes WHERE ts < ?", (older_than,)
+            )
+            self._db.execute(
+                "DELETE FROM alert_changes WHERE ts < ?", (older_than,)
+            )
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Взять или продлить аренду; True — аренда наша."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO leases VALUES (?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET"
+                " owner = excluded.owner, expires = excluded.expires"
+                " WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (name, owner, now + ttl, now),
+            )
+            row = self._db.execute(
+                "SELECT owner FROM leases WHERE name = ?", (name,)
+            ).fetchone()
+        return row is not None and row[0] == owner
+
+    def save_snapshot(self, updates: dict) -> None:
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rate_snapshot VALUES (?, ?, ?)",
+                [(k, json.dumps(v), ts) for k, (v, ts) in updates.items()],
+            )
+
+    def load_snapshot(self) -> dict:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, value, fetched FROM rate_snapshot"
+            ).fetchall()
+        return {name: (json.loads(value), ts) for name, value, ts in rows}
+
+
+class LogStore:
     """
-    Возвращает (best_buy, best_sell) для USDT/RUB на ABCEX.
+    Журнал только на дозапись: одна JSON-строка на изменение.
+    При загрузке журнал проигрывается и, если в нём накопилось много
+    перезаписанных строк, переписывается компактно.
     """
-    cache = getattr(get_abcex_usdt_rub, "_cache", None)
-    last = getattr(get_abcex_usdt_rub, "_last", 0)
 
-    if cache is not None and time.time() - last < 15:
-        return cache
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fh = None
 
-    try:
-        r = requests.get(
-            "https://hub.abcex.io/api/v2/exchange/public/orderbook/depth",
-            params={"instrumentCode": "USDTRUB", "lang": "ru"},
-            headers={"User-Agent": "Mozilla/5.0"},
-            timeout=4,
+    def load(self) -> dict:
+        state = {
+            KIND_AUTO: {}, KIND_STATS: {}, KIND_USER: {}, KIND_ALERT: {},
+            KIND_KEYBOARD: {},
+        }
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as fh:
+                for line in fh:
+                    lines += 1
+                    try:
+                        kind, key, value = json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка после падения
+                    if value is None:
+                        state[kind].pop(key, None)
+                    else:
+                        state[kind][key] = value
+
+        if lines > 2 * sum(map(len, state.values())) + 1000:
+            self._compact(state)
+        self._fh = open(self.path, "a", encoding="utf-8")
+        return state
+
+    def _compact(self, state: dict) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            for kind, items in state.items():
+                for key, value in items.items():
+                    fh.write(json.dumps([kind, key, value]) + "\n")
+        os.replace(tmp, self.path)
+
+    def write(self, ops: dict) -> None:
+        # журнал у процесса один — пишем итог, прибавка ему не нужна
+        data = "".join(
+            json.dumps([kind, key, _without_added(value)]) + "\n"
+            for (kind, key), value in ops.items()
         )
-        data = r.json()
-        asks = data.get("ask") or []
-        bids = data.get("bid") or []
-        if not asks or not bids:
-            raise ValueError("Empty orderbook")
-
-        best_sell = float(asks[0]["price"])  # по чём продают USDT
-        best_buy = float(bids[0]["price"])   # по чём покупают USDT
-        result = (best_buy, best_sell)
-        get_abcex_usdt_rub._cache = result
-        get_abcex_usdt_rub._last = time.time()
-        return result
-    except Exception as e:
-        logger.warning(f"ABCEX error: {e}")
-        return cache or (None, None)
+        with self._lock:
+            self._fh.write(data)
+            self._fh.flush()
 
 
-# ============== ТЕКСТ КУРСА ==============
+def _without_added(value):
+    if isinstance(value, dict) and "added" in value:
+        return {k: v for k, v in value.items() if k != "added"}
+    return value
 
-def build_rate_text(upbit, bithumb, rub_mln, ab_buy=None, ab_sell=None) -> str:
-    upbit_txt = f"{fmt_num(upbit, 0)} ₩" if upbit else "—"
-    bithumb_txt = f"{fmt_num(bithumb, 0)} ₩" if bithumb else "—"
-    rub_txt = f"{fmt_num(rub_mln, 2)} ₽" if rub_mln else "—"
 
-    ab_buy_txt = f"{fmt_num(ab_buy, 2)} ₽" if ab_buy else "—"
-    ab_sell_txt = f"{fmt_num(ab_sell, 2)} ₽" if ab_sell else "—"
+class WriteBehind:
+    """
+    Отложенная запись: хендлеры только кладут изменения в словарь
+    (повторные изменения одного ключа схлопываются), фоновый поток
+    сбрасывает их в хранилище раз в STORE_FLUSH_INTERVAL секунд.
+    Счётчики (add) несут ещё и прибавку "added": она суммируется, чтобы
+    реплики с общей базой не затирали друг другу значения.
+    """
 
-    timestamp = now_msk().strftime("%d.%m.%Y, %H:%M")
+    def __init__(self, backend):
+        self.backend = backend
+        self._pending = {}
+        self._lock = threading.Lock()
 
-    text = (
-        "💱 <b>АКТУАЛЬНЫЕ КУРСЫ</b>\n\n"
-        "🇰🇷 <b>USDT → KRW</b>\n"
-        f"◾ UPBIT:   <b>{upbit_txt}</b>\n"
-        f"◾ BITHUMB: <b>{bithumb_txt}</b>\n"
-        "━━━━━━━━━━━━━━\n\n"
-        "🇷🇺 <b>USDT → RUB (ABCEX)</b>\n"
-        f"◾ Покупка: <b>{ab_buy_txt}</b>\n"
-        f"◾ Продажа: <b>{ab_sell_txt}</b>\n"
-        "━━━━━━━━━━━━━━\n\n"
-        "🇰🇷➡️🇷🇺 <b>KRW → RUB</b>\n"
-        f"◾ 1 000 000 ₩ → <b>{rub_txt}</b>\n"
-        "━━━━━━━━━━━━━━\n"
-        f"⏱ Обновлено: <b>{timestamp} (МСК)</b>\n\n"
-        "💰 Обмен любых сумм и валют — по договоренности.\n"
-        "📞 Контакт: @Abdulkhaiii"
-    )
-    return text
+    def put(self, kind: str, key, value) -> None:
+        if self.backend is None:
+            return
+        with self._lock:
+            self._pending[(kind, key)] = value
 
+    def add(self, kind: str, key, value: dict, added: int) -> None:
+        """Как put, но value — текущие значения счётчика, added — прибавка."""
+        if self.backend is None:
+            return
+        with self._lock:
+            self._merge((kind, key), dict(value, added=added))
 
-# ============== АВТО-ОБНОВЛЕНИЕ ==============
+    def _merge(self, k, value) -> None:
+        """value новее уже ожидающего: итог берём из него, прибавки складываем."""
+        old = self._pending.get(k)
+        if old and value and "added" in old and "added" in value:
+            value["added"] += old["added"]
+        self._pending[k] = value
 
-def auto_update_loop():
-    while True:
-        time.sleep(60)
-        if not AUTO_USERS:
-            continue
+    def delete(self, kind: str, key) -> None:
+        self.put(kind, key, None)
+
+    def pending(self, kind: str, key):
+        """Ещё не записанное значение ключа или None."""
+        with self._lock:
+            return self._pending.get((kind, key))
 
+    def flush(self) -> None:
+        with self._lock:
+            ops, self._pending = self._pending, {}
+        if not ops:
+            return
         try:
-            now = now_msk()
-            # не спамим ночью
-            if now.hour < 8 or now.hour >= 23:
-                continue
+            self.backend.write(ops)
+        except Exception:
+            logger.exception("Ошибка записи в хранилище")
+            with self._lock:
+                for k, v in ops.items():
+                    # несохранённое возвращаем под более новые изменения
+                    newer = self._pending.pop(k, None)
+                    self._pending[k] = v
+                    if newer is not None:
+                        self._merge(k, newer)
 
-            with concurrent.futures.ThreadPoolExecutor() as ex:
-                fu_u = ex.submit(get_upbit_usdt_krw)
-                fu_b = ex.submit(get_bithumb_usdt_krw)
-                fu_r = ex.submit(get_krw_rub_from_google)
-                fu_ab = ex.submit(get_abcex_usdt_rub)
+    def run(self) -> None:
+        while True:
+            time.sleep(STORE_FLUSH_INTERVAL)
+            self.flush()
 
-                u = fu_u.result()
-                b = fu_b.result()
-                r = fu_r.result()
-                ab_buy, ab_sell = fu_ab.result()
 
-            if not any([u, b, r, ab_buy, ab_sell]):
-                continue
+def open_store():
+    if STORE_BACKEND == "sqlite":
+        return SqliteStore(STORE_PATH or "bot_state.db")
+    if STORE_BACKEND == "log":
+        return LogStore(STORE_PATH or "bot_state.log")
+    return None
 
-            txt = build_rate_text(u, b, r, ab_buy, ab_sell)
 
-            for chat_id, cfg in list(AUTO_USERS.items()):
-                interval = cfg["interval"]
-                last = cfg["last"]
+STORE = WriteBehind(None)
 
-                if last and (now - last).total_seconds() < interval:
-                    continue
 
-                try:
-                    bot.send_message(chat_id, txt)
-                    AUTO_USERS[chat_id]["last"] = now
-                except Exception as e:
-                    if "blocked" in str(e).lower():
-                        AUTO_USERS.pop(chat_id, None)
-
-            log_to_channel(
-                f"⏱ Автообновление ({len(AUTO_USERS)} пользователей) – "
-                f"{now.strftime('%H:%M:%S')}"
-            )
-        except Exception:
-            logger.exception("Ошибка автообновления")
+def save_auto_user(cid) -> None:
+    cfg = AUTO_USERS.get(cid)
+    if cfg is None:
+        STORE.delete(KIND_AUTO, cid)
+        return
+    due = AUTO_SCHEDULER.due_at(cid)
+    STORE.put(KIND_AUTO, cid, {
+        "interval": cfg.interval,
+        "last": cfg.last or None,
+        "next_due": due,
+    })
 
 
-# ============== КЛАВИАТУРА ==============
+def _exit_on_sigterm(signum, frame) -> None:
+    """
+    Render останавливает сервис SIGTERM, а по умолчанию Python на нём
+    выходит без atexit — последние изменения терялись бы.
+    """
+    STORE.flush()
+    raise SystemExit(0)
 
-def main_keyboard():
-    m = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    m.row(BTN_SHOW, BTN_AUTO)
-    m.row(BTN_PROFILE, BTN_DISABLE)
-    return m
 
+def load_state() -> None:
+    """Поднимает подписчиков и статистику из хранилища при запуске."""
+    backend = open_store()
+    if backend is None:
+        if CLUSTER_MODE:
+            raise RuntimeError("CLUSTER_MODE требует общего хранилища")
+        return
+    t0 = time.perf_counter()
+    if CLUSTER_MODE:
+        CLUSTER.attach(backend)
+    state = backend.load()
 
-def ensure_keyboard(m):
-    try:
-        bot.send_message(m.chat.id, " ", reply_markup=main_keyboard())
-    except Exception:
-        pass
+    # один объект int на id во всех таблицах, а не по копии на каждую
+    ids = {}
 
+    def intern(uid):
+        uid = int(uid)
+        return ids.setdefault(uid, uid)
 
-# ============== ХЕНдлеры ==============
+    ALL_USERS.update(intern(uid) for uid in state[KIND_USER])
+    stats = state[KIND_STATS]
+    if STATS_LIMIT and hasattr(backend, "load_stats"):
+        # в память — только самые свежие, остальные подгрузятся по запросу
+        keep = heapq.nlargest(
+            STATS_LIMIT, stats, key=lambda uid: stats[uid]["last"] or 0
+        )
+        stats = {uid: stats[uid] for uid in keep}
+    for uid, s in stats.items():
+        USER_STATS.restore(int(uid), s["requests"], int(s["last"] or 0))
+    due = {}
+    for cid, cfg in state[KIND_AUTO].items():
+        cid = intern(cid)
+        AUTO_USERS[cid] = AutoSub(cfg["interval"], int(cfg["last"] or 0))
+        # сохранённый срок уже учитывает тихие часы
+        due[cid] = (
+            cfg.get("next_due")
+            or next_auto_due(AUTO_USERS[cid]).timestamp()
+        )
+    # старые версии клавиатуры не держим: таким чатам её пришлют заново
+    KEYBOARD_CHATS.update(
+        intern(cid) for cid, version in state[KIND_KEYBOARD].items()
+        if version == KEYBOARD_VERSION
+    )
+    AUTO_SCHEDULER.schedule_many(due.items())
+    ALERTS.restore_many(state[KIND_ALERT].items())
 
-@bot.message_handler(commands=["start", "help"])
-def start_handler(m):
-    remember_user(m.from_user)
-    ensure_keyboard(m)
-    bot.send_message(
-        m.chat.id,
-        "👋 Привет!\n\nВыбери нужный раздел ниже 👇",
-        reply_markup=main_keyboard()
+    STORE.backend = backend
+    threading.Thread(target=STORE.run, daemon=True).start()
+    atexit.register(STORE.flush)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    logger.info(
+        f"Хранилище {STORE_BACKEND}: {len(ALL_USERS)} пользователей, "
+        f"{len(AUTO_USERS)} подписок, {len(ALERTS)} оповещений "
+        f"за {time.perf_counter() - t0:.3f} с"
     )
-    log_user_action(m.from_user, "нажал /start")
 
 
-@bot.message_handler(func=lambda m: m.text == BTN_DISABLE)
-def disable_notifications(m):
-    remember_user(m.from_user)
-    cid = m.chat.id
-    if cid in AUTO_USERS:
-        AUTO_USERS.pop(cid, None)
-        bot.send_message(cid, "🔕 Уведомления отключены.")
-        log_user_action(m.from_user, "отключил уведомления")
-    else:
-        bot.send_message(cid, "Уведомления уже выключены.")
+# ============== НЕСКОЛЬКО РЕПЛИК ==============
 
+# CLUSTER_MODE=1: подписки и снимок курсов общие (SQLite-файл STORE_PATH),
+# планировщик автообновлений и опрос бирж — только у реплики-лидера
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0") == "1"
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = float(os.getenv("LEASE_TTL", "15"))
+CLUSTER_SYNC_INTERVAL = float(os.getenv("CLUSTER_SYNC_INTERVAL", "2"))
+LEADER_LEASE = "scheduler"
 
-@bot.message_handler(func=lambda m: m.text == BTN_SHOW)
-def show_rate(m):
-    remember_user(m.from_user)
-    ensure_keyboard(m)
-    log_user_action(m.from_user, "нажал «Показать курс»")
-    cid = m.chat.id
 
-    msg = bot.send_message(cid, "⏳ Загрузка курса, ожидайте...")
+class Cluster:
+    """
+    Выбор лидера через аренду в общем хранилище и синхронизация
+    подписок по журналу изменений. Без CLUSTER_MODE каждая реплика
+    считает себя лидером.
+    """
+
+    def __init__(self):
+        self.store = None
+        self.leader = threading.Event()
+        self._seq = 0
+        self._alert_seq = 0
+
+    def is_leader(self) -> bool:
+        return not CLUSTER_MODE or self.leader.is_set()
 
-    stop = {"run": True}
+    def attach(self, store) -> None:
+        if not isinstance(store, SqliteStore):
+            raise RuntimeError(
+                "CLUSTER_MODE работает только с STORE_BACKEND=sqlite"
+            )
+        store.track_changes = True
+        # журнал читаем с текущего места: всё, что раньше, даст load()
+        self._seq = store.last_change_seq()
+        self._alert_seq = store.last_alert_change_seq()
+        self.store = store
 
-    def anim():
-        dots = [".", "..", "..."]
-        i = 0
-        while stop["run"]:
+    def run(self) -> None:
+        last_renew = 0.0
+        while True:
             try:
-                bot.edit_message_text(
-                    f"⏳ Загрузка курса{dots[i % 3]}...",
-                    cid,
-                    msg.message_id
-                )
+                if time.time() - last_renew >= LEASE_TTL / 3:
+                    self._renew()
+                    last_renew = time.time()
+                self._sync_subscriptions()
+                if not self.leader.is_set():
+                    self._follow_snapshot()
             except Exception:
-                break
-            i += 1
-            time.sleep(0.6)
-
-    threading.Thread(target=anim, daemon=True).start()
-
-    with concurrent.futures.ThreadPoolExecutor() as ex:
-        fu_u = ex.submit(get_upbit_usdt_krw)
-        fu_b = ex.submit(get_bithumb_usdt_krw)
-        fu_r = ex.submit(get_krw_rub_from_google)
-        fu_ab = ex.submit(get_abcex_usdt_rub)
-
-        u = fu_u.result()
-        b = fu_b.result()
-        r = fu_r.result()
-        ab_buy, ab_sell = fu_ab.result()
-
-    stop["run"] = False
-    time.sleep(0.4)
-
-    if not any([u, b, r, ab_buy, ab_sell]):
-        bot.edit_message_text(
-            "⚠️ Не удалось получить курс.\nПопробуйте позже.",
-            cid,
-            msg.message_id
-        )
-        return
+                logger.exception("Ошибка синхронизации реплик")
+            time.sleep(CLUSTER_SYNC_INTERVAL)
 
-    txt = build_rate_text(u, b, r, ab_buy, ab_sell)
+    def _renew(self) -> None:
+        try:
+            ok = self.store.acquire_lease(LEADER_LEASE, REPLICA_ID, LEASE_TTL)
+        except Exception:
+            logger.exception("Не удалось продлить аренду лидера")
+            ok = False
 
-    bot.edit_message_text(txt, cid, msg.message_id, parse_mode="HTML")
-    update_user_stats(m.from_user)
+        if ok and not self.leader.is_set():
+            # всё, что не успели разослать прошлые лидеры, — в расписание
+            AUTO_SCHEDULER.schedule_many(
+                (cid, next_auto_due(cfg).timestamp())
+                for cid, cfg in list(AUTO_USERS.items())
+            )
+            self.leader.set()
+            logger.info(f"Реплика {REPLICA_ID} стала лидером")
+            log_to_channel(f"👑 Реплика {REPLICA_ID} стала лидером")
+        elif not ok and self.leader.is_set():
+            self.leader.clear()
+            logger.warning(f"Реплика {REPLICA_ID} потеряла лидерство")
+            if UPDATE_MODE != "webhook":
+                # getUpdates опрашивает только лидер, иначе 409
+                bot.stop_polling()
 
-    try:
-        log_to_channel(
-            f"📊 Курс {pretty_name(m.from_user)} (ID {m.from_user.id})\n"
-            f"🕒 {now_msk().strftime('%H:%M:%S')} МСК\n"
-            f"Upbit: {fmt_num(u, 0) if u else '—'} | "
-            f"Bithumb: {fmt_num(b, 0) if b else '—'} | "
-            f"KRW→RUB (1M): {fmt_num(r, 2) if r else '—'} ₽ | "
-            f"ABCEX buy/sell: "
-            f"{fmt_num(ab_buy, 2) if ab_buy else '—'} / {fmt_num(ab_sell, 2) if ab_sell else '—'} ₽"
-        )
-    except Exception:
-        pass
+        if ok:
+            self.store.prune_changes(time.time() - 3600)
 
+    def _sync_subscriptions(self) -> None:
+        self._seq, rows = self.store.changes_since(self._seq)
+        for cid, interval, last, due in rows:
+            if interval is None:
+                AUTO_USERS.pop(cid, None)
+                AUTO_SCHEDULER.cancel(cid)
+                continue
+            AUTO_USERS[cid] = AutoSub(interval, int(last or 0))
+            if due:
+                AUTO_SCHEDULER.schedule(cid, _dt(due))
 
-@bot.message_handler(func=lambda m: m.text == BTN_AUTO)
-def toggle_auto(m):
-    remember_user(m.from_user)
-    ensure_keyboard(m)
-    cid = m.chat.id
+        self._alert_seq, rows = self.store.alert_changes_since(self._alert_seq)
+        for aid, alert in rows:
+            if alert is None:
+                ALERTS.discard(aid)
+            else:
+                ALERTS.restore(aid, alert)
 
-    kb = types.InlineKeyboardMarkup()
-    kb.row(
-        types.InlineKeyboardButton("⏱ Каждый 1 час", callback_data="auto_1h"),
-        types.InlineKeyboardButton("⏱ Каждые 5 часов", callback_data="auto_5h"),
-    )
-    kb.row(
-        types.InlineKeyboardButton(
-            "🕛 Раз в 24 часа (с 08:00 МСК)",
-            callback_data="auto_24h"
-        ),
-    )
-    if cid in AUTO_USERS:
-        kb.row(
-            types.InlineKeyboardButton(
-                "🔕 Выключить автообновление",
-                callback_data="auto_off"
-            )
-        )
+    def _follow_snapshot(self) -> None:
+        current = get_rate_snapshot().fetched
+        updates = {}
+        for name, (value, ts) in self.store.load_snapshot().items():
+            if ts > current.get(name, 0):
+                if isinstance(value, list):
+                    value = tuple(value)
+                updates[name] = (value, ts)
+        if updates:
+            _publish_snapshot(updates)
+            _SNAPSHOT_READY.set()
 
-    text = "Выбери частоту автообновления курса:"
-    if cid in AUTO_USERS:
-        cur_int = AUTO_USERS[cid].get("interval", AUTO_INTERVAL_24H)
-        text += f"\nСейчас: {human_interval(cur_int)}."
+    def share_snapshot(self, updates: dict) -> None:
+        if CLUSTER_MODE and self.store is not None:
+            try:
+                self.store.save_snapshot(updates)
+            except Exception:
+                logger.exception("Не удалось сохранить снимок курсов")
 
-    bot.send_message(cid, text, reply_markup=kb)
-    log_user_action(m.from_user, "открыл настройки автообновления")
 
+CLUSTER = Cluster()
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("auto_"))
-def auto_callback(c):
-    cid = c.message.chat.id
 
-    if c.data == "auto_off":
-        AUTO_USERS.pop(cid, None)
-        bot.answer_callback_query(c.id, "Автообновление выключено")
-        bot.send_message(cid, "🔕 Автообновление выключено.")
-        log_user_action(c.from_user, "выключил автообновление")
-        return
+# ============== МЕТРИКИ ==============
 
-    now = now_msk()
+# границы корзин гистограмм задержек, сек
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# если задан — /metrics отдаётся только с ?token=... или Bearer-заголовком
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
-    if c.data == "auto_1h":
-        interval = AUTO_INTERVAL_1H
-        label = "каждый 1 час"
-        last = now
-    elif c.data == "auto_5h":
-        interval = AUTO_INTERVAL_5H
-        label = "каждые 5 часов"
-        last = now
-    else:
-        interval = AUTO_INTERVAL_24H
-        label = "каждые 24 часа"
-        next_run = now.replace(hour=8, minute=0, second=0, microsecond=0)
-        if now.hour >= 8:
-            next_run += timedelta(days=1)
-        last = next_run - timedelta(seconds=interval)
-
-    AUTO_USERS[cid] = {"interval": interval, "last": last}
-    bot.answer_callback_query(c.id, "Настройки сохранены")
-    bot.send_message(cid, f"🔔 Автообновление включено: {label}.")
-    log_user_action(c.from_user, f"включил автообновление ({label})")
 
+class Metrics:
+    """
+    Счётчики и гистограммы в памяти, отдаются текстом в формате
+    Prometheus. Метка — обычные keyword-аргументы. Значения, которые
+    и так хранятся где-то ещё (глубина очередей), снимаются функциями
+    в момент запроса /metrics.
+    """
 
-@bot.message_handler(func=lambda m: m.text == BTN_PROFILE)
-def profile(m):
-    remember_user(m.from_user)
-    ensure_keyboard(m)
-    s = USER_STATS[m.from_user.id]
-    last = s["last"].strftime("%d.%m.%Y %H:%M:%S") if s["last"] else "—"
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)  # (имя, метки) -> значение
+        self._hists = {}  # (имя, метки) -> [корзины..., сумма, число]
+        self._collectors = []  # fn() -> [(имя, тип, метки, значение)]
 
-    nick = pretty_name(m.from_user)
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
 
-    txt = (
-        f"👤 <b>Профиль</b>\n\n"
-        f"Имя: {nick}\n"
-        f"ID: <code>{m.from_user.id}</code>\n\n"
-        f"Запросов курса: {s['requests']}\n"
-        f"Последний запрос: {last} (МСК)"
-    )
-    bot.send_message(m.chat.id, txt)
-    log_user_action(m.from_user, "открыл профиль")
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] += value
 
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self._key(name, labels)
+        i = bisect.bisect_left(METRIC_BUCKETS, seconds)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [0] * (len(METRIC_BUCKETS) + 3)
+            h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
 
-@bot.message_handler(
-    func=lambda m: m.text not in [
-        BTN_SHOW,
-        BTN_AUTO,
-        BTN_PROFILE,
-        BTN_DISABLE,
-        "/start",
-        "/help",
-    ]
-)
-def update_keyboard_global(m):
-    """
-    Любое другое сообщение — просто обновляем клавиатуру,
-    чтобы старые пользователи получили новые кнопки.
-    """
-    remember_user(m.from_user)
-    ensure_keyboard(m)
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels)
 
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
 
-# ============== АНТИ-СОН ДЛЯ RENDER ==============
+    def render(self) -> str:
+        def fmt(labels) -> str:
+            if not labels:
+                return ""
+            inner = ",".join(
+                f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in labels
+            )
+            return "{" + inner + "}"
 
-def keep_awake():
-    url = "https://telegram-rate-bot-ooc6.onrender.com"
-    while True:
-        try:
-            requests.get(url, timeout=5)
-            print(f"[keep_alive] Pinged {url}")
-        except Exception as e:
-            print(f"[keep_alive] Ошибка пинга: {e}")
-        time.sleep(600)
+        with self._lock:
+            counters = list(self._counters.items())
+            hists = [(k, list(v)) for k, v in self._hists.items()]
 
+        lines = []
+        typed = set()
 
-# ============== FAKE WEB SERVER ДЛЯ RENDER ==============
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
 
-app = Flask(__name__)
+        for (name, labels), value in sorted(counters):
+            header(name, "counter")
+            lines.append(f"{name}{fmt(labels)} {value:g}")
+        for (name, labels), h in sorted(hists):
+            header(name, "histogram")
+            total = 0
+            for bound, n in zip(METRIC_BUCKETS + ("+Inf",), h):
+                total += n
+                le = labels + (("le", bound),)
+                lines.append(f"{name}_bucket{fmt(le)} {total}")
+            lines.append(f"{name}_sum{fmt(labels)} {h[-2]:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {h[-1]}")
+        for fn in self._collectors:
+            try:
+                samples = fn()
+            except Exception:
+                logger.exception("Ошибка сбора метрик")
+                continue
+            for name, kind, labels, value in samples:
+                header(name, kind)
+                lines.append(f"{name}{fmt(sorted(labels.items()))} {value:g}")
+        return "\n".join(lines) + "\n"
 
 
-@app.route("/")
-def home():
-    return "Bot is running OK", 200
+class _Timer:
+    """with METRICS.timer(...): — длительность блока и исход (ok/error)."""
 
+    __slots__ = ("metrics", "name", "labels", "t0")
 
-def run_web():
-    port = int(os.environ.get("PORT", 10000))
-    print(f"[web] Using PORT={port}")
-    app.run(host="0.0.0.0", port=port)
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.t0 = 0.0
 
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
 
-# ============== ЗАПУСК БОТА ==============
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(
+            f"{self.name}_seconds", time.perf_counter() - self.t0, **self.labels
+        )
+        result = "ok" if exc_type is None else exc_type.__name__
+        self.metrics.inc(f"{self.name}_total", result=result, **self.labels)
+        return False
 
-def main():
-    # фоновые потоки
-    threading.Thread(target=auto_update_loop, daemon=True).start()
-    threading.Thread(target=keep_awake, daemon=True).start()
-    threading.Thread(target=run_web, daemon=True).start()
 
-    # при старте — мягко обновим клавиатуру у всех, кого помним
-    def broadcast_new_keyboard():
-        for uid in list(ALL_USERS):
+METRICS = Metrics()
+
+
+def instrument_telegram_api() -> None:
+    """Время и исход каждого вызова Bot API по имени метода."""
+    from telebot import apihelper
+
+    original = apihelper._make_request
+    if getattr(original, "_instrumented", False):
+        return
+
+    def _make_request(token, method_name, *args, **kwargs):
+        with METRICS.timer("telegram_api", method=method_name):
+            return original(token, method_name, *args, **kwargs)
+
+    _make_request._instrumented = True
+    apihelper._make_request = _make_request
+
+
+def instrument_async_telegram_api() -> None:
+    """То же для AsyncTeleBot: там все методы идут через _process_request."""
+    from telebot import asyncio_helper
+
+    original = asyncio_helper._process_request
+    if getattr(original, "_instrumented", False):
+        return
+
+    async def _process_request(token, url, *args, **kwargs):
+        with METRICS.timer("telegram_api", method=url):
+            return await original(token, url, *args, **kwargs)
+
+    _process_request._instrumented = True
+    asyncio_helper._process_request = _process_request
+
+
+def instrument_handlers(tb) -> None:
+    """
+    Оборачивает уже зарегистрированные хендлеры бота замером времени.
+    Для AsyncTeleBot — корутинной обёрткой.
+    """
+    groups = (tb.message_handlers, tb.callback_query_handlers,
+              tb.inline_handlers)
+    for handlers in groups:
+        for h in handlers:
+            fn = h["function"]
+            if getattr(fn, "_instrumented", False):
+                continue
+            if asyncio.iscoroutinefunction(fn):
+                async def wrapper(*args, _fn=fn, **kwargs):
+                    with METRICS.timer("handler", handler=_fn.__name__):
+                        return await _fn(*args, **kwargs)
+            else:
+                def wrapper(*args, _fn=fn, **kwargs):
+                    with METRICS.timer("handler", handler=_fn.__name__):
+                        return _fn(*args, **kwargs)
+            wrapper._instrumented = True
+            wrapper.__name__ = fn.__name__
+            h["function"] = wrapper
+
+
+# ============== HTTP ==============
+
+# таймауты и пулы соединений к биржам (можно переопределить через env)
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "4"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "4"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.3"))
+
+# базовые адреса источников (для локальных заглушек в тестах)
+UPBIT_API = os.getenv("UPBIT_API", "https://api.upbit.com")
+BITHUMB_API = os.getenv("BITHUMB_API", "https://api.bithumb.com")
+GOOGLE_FINANCE_API = os.getenv("GOOGLE_FINANCE_API", "https://www.google.com")
+ER_API = os.getenv("ER_API", "https://open.er-api.com")
+ABCEX_API = os.getenv("ABCEX_API", "https://hub.abcex.io")
+
+_SESSIONS = {}  # host -> requests.Session
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _make_session() -> requests.Session:
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        backoff_jitter=HTTP_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=HTTP_POOL_SIZE,
+        pool_block=True,
+        max_retries=retry,
+    )
+    s = requests.Session()
+    s.headers["User-Agent"] = "Mozilla/5.0"
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def http_session(url: str) -> requests.Session:
+    """Отдельная keep-alive сессия на каждый хост, создаётся один раз."""
+    host = urlsplit(url).netloc
+    s = _SESSIONS.get(host)
+    if s is None:
+        with _SESSIONS_LOCK:
+            s = _SESSIONS.get(host)
+            if s is None:
+                s = _SESSIONS[host] = _make_session()
+    return s
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return http_session(url).get(url, **kwargs)
+
+
+# ============== ПРЕДОХРАНИТЕЛИ И ХЕДЖИРОВАНИЕ ==============
+
+# после BREAKER_FAILURES ошибок подряд источник отдыхает BREAKER_COOLDOWN сек,
+# затем пропускается один пробный запрос
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+# сколько ждать основной источник, прежде чем параллельно спросить резервный
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "1.5"))
+# предел ожидания одного обновления источника целиком
+FETCH_BUDGET = float(os.getenv("FETCH_BUDGET", "5"))
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Предохранитель источника: closed — запросы идут, open — сразу
+    CircuitOpen, half-open — после паузы пропускается один пробный
+    запрос, его успех закрывает предохранитель. Используется как
+    контекстный менеджер вокруг запроса.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.failures < BREAKER_FAILURES:
+            return "closed"
+        if time.time() - self.opened_at < BREAKER_COOLDOWN:
+            return "open"
+        return "half-open"
+
+    def __enter__(self):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._probing):
+                raise CircuitOpen(f"{self.name}: предохранитель разомкнут")
+            if state == "half-open":
+                self._probing = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._lock:
+            was_open = self.failures >= BREAKER_FAILURES
+            self._probing = False
+            if exc_type is None:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= BREAKER_FAILURES:
+                    self.opened_at = time.time()
+        if exc_type is None and was_open:
+            logger.info(f"{self.name}: источник снова отвечает")
+        elif exc_type is not None and self.failures == BREAKER_FAILURES:
+            logger.warning(f"{self.name}: предохранитель разомкнут")
+        return False
+
+
+BREAKERS = {
+    name: CircuitBreaker(name)
+    for name in ("upbit", "bithumb", "google", "er_api", "abcex")
+}
+
+
+@contextlib.contextmanager
+def upstream(name: str):
+    """Запрос к источнику: через его предохранитель и с замером времени."""
+    with METRICS.timer("upstream", source=name), BREAKERS[name]:
+        yield
+
+
+@METRICS.collector
+def _breaker_metrics():
+    states = {"closed": 0, "half-open": 1, "open": 2}
+    return [
+        ("upstream_breaker_state", "gauge", {"source": name}, states[b.state])
+        for name, b in BREAKERS.items()
+    ]
+
+_HEDGE_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="hedge"
+)
+
+
+def hedged(primary, fallback, delay: float = HEDGE_DELAY,
+           budget: float = FETCH_BUDGET):
+    """
+    Запускает primary; если за delay сек он не ответил (или уже упал),
+    параллельно запускает fallback. Возвращает первый успешный ответ,
+    но не позже budget сек от начала. Проигравший запрос дорабатывает
+    в фоне до своего таймаута.
+    """
+    deadline = time.monotonic() + budget
+    futures = [_HEDGE_POOL.submit(primary)]
+    done, _ = concurrent.futures.wait(futures, timeout=delay)
+    if done and futures[0].exception() is None:
+        return futures[0].result()
+    futures.append(_HEDGE_POOL.submit(fallback))
+
+    error = None
+    pending = set(futures)
+    while pending:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        done, pending = concurrent.futures.wait(
+            pending, timeout=timeout,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        # при одновременном ответе основной источник в приоритете
+        for fu in sorted(done, key=futures.index):
+            if fu.exception() is None:
+                return fu.result()
+            error = fu.exception()
+    raise error or TimeoutError(f"нет ответа за {budget:g} с")
+
+
+async def async_hedged(primary, fallback, delay: float = HEDGE_DELAY,
+                       budget: float = FETCH_BUDGET):
+    """hedged() для корутин: primary и fallback — фабрики корутин."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget
+    tasks = [asyncio.ensure_future(primary())]
+    done, _ = await asyncio.wait(tasks, timeout=delay)
+    if done and tasks[0].exception() is None:
+        return tasks[0].result()
+    tasks.append(asyncio.ensure_future(fallback()))
+
+    error = None
+    pending = set(tasks)
+    try:
+        while pending:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for t in sorted(done, key=tasks.index):
+                if t.exception() is None:
+                    return t.result()
+                error = t.exception()
+    finally:
+        for t in pending:
+            t.cancel()
+    raise error or TimeoutError(f"нет ответа за {budget:g} с")
+
+
+# ============== КЭШ ЗАПРОСОВ ==============
+
+# источник -> (ttl, окно stale-while-revalidate, негативный кэш), сек
+CACHE_POLICY = {
+    "upbit": (5, 30, 10),
+    "bithumb": (5, 30, 10),
+    "rub": (1800, 1800, 60),
+    "abcex": (15, 30, 10),
+}
+
+
+class _CacheEntry:
+    __slots__ = ("value", "fetched_at", "error_at", "inflight")
+
+    def __init__(self):
+        self.value = None
+        self.fetched_at = 0.0
+        self.error_at = 0.0
+        self.inflight = None  # threading.Event, пока идёт запрос
+
+
+class SingleFlightCache:
+    """
+    TTL-кэш с объединением запросов: одновременные вызовы для одного
+    источника ждут один и тот же запрос и получают его результат.
+    После ttl значение ещё stale секунд отдаётся сразу, а обновление
+    идёт в фоне. После ошибки источник не дёргается error_ttl секунд.
+    force=True (фоновое обновление) минует ttl и stale: вызов ждёт
+    свежий ответ, иначе снимок отставал бы на период опроса.
+    """
+
+    def __init__(self, policy: dict):
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key: str, loader, default=None, force: bool = False):
+        ttl, stale, error_ttl = self.policy[key]
+        now = time.time()
+        background = False
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None:
+                e = self._entries[key] = _CacheEntry()
+            has_value = e.fetched_at > 0
+            age = now - e.fetched_at
+
+            if force:
+                has_value = False  # ни hit, ни stale: только свежий ответ
+            if has_value and age < ttl:
+                result = "hit"
+            elif e.error_at and now - e.error_at < error_ttl:
+                result = "negative"
+            else:
+                wait = e.inflight
+                if wait is None:
+                    e.inflight = threading.Event()
+                    if has_value and age < ttl + stale:
+                        background = True
+                    result = "stale" if background else "miss"
+                elif has_value and age < ttl + stale:
+                    result = "stale"
+                else:
+                    result = "coalesced"
+        METRICS.inc("rate_cache_requests_total", source=key, result=result)
+
+        if result == "hit":
+            return e.value
+        if result == "negative":
+            return e.value if e.fetched_at > 0 else default
+        if background:
+            threading.Thread(
+                target=self._load, args=(key, e, loader), daemon=True
+            ).start()
+            return e.value
+        if result == "stale":
+            return e.value
+        if wait is None:
+            self._load(key, e, loader)
+        else:
+            wait.wait()
+
+        with self._lock:
+            return e.value if e.fetched_at > 0 else default
+
+    def peek(self, key: str):
+        """(значение, время последнего успешного запроса) без обращения к сети."""
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None or e.fetched_at == 0:
+                return None, 0.0
+            return e.value, e.fetched_at
+
+    def _load(self, key: str, e: _CacheEntry, loader) -> None:
+        try:
+            v = loader()
+        except Exception as ex:
+            logger.warning(f"{key} error: {ex}")
+            with self._lock:
+                e.error_at = time.time()
+        else:
+            with self._lock:
+                e.value = v
+                e.fetched_at = time.time()
+                e.error_at = 0.0
+        finally:
+            with self._lock:
+                done, e.inflight = e.inflight, None
+            done.set()
+
+
+RATE_CACHE = SingleFlightCache(CACHE_POLICY)
+
+
+# ============== API ==============
+
+def _parse_upbit(data) -> float:
+    return float(data[0]["trade_price"])
+
+
+def _parse_bithumb(data) -> float:
+    return float(data["data"]["closing_price"])
+
+
+GOOGLE_RATE_CLASS = "YMlKec fxKbKc"
+GOOGLE_RATE_MARKER = f'class="{GOOGLE_RATE_CLASS}"'.encode()
+GOOGLE_PARSE_FAILURES = 0
+
+
+def _google_million_rub(text: str) -> float:
+    # значение KRW за 1 RUB
+    v = float(text.replace(",", "").replace("₩", ""))
+    # 1 RUB = v KRW => 1 KRW = 1/v RUB => 1e6 KRW = 1e6 * (1/v)
+    return 1_000_000 / v
+
+
+def _parse_google_html(html: str):
+    """Полный разбор страницы через BeautifulSoup — запасной путь."""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    div = soup.find("div", class_=GOOGLE_RATE_CLASS)
+    if not div:
+        return None
+    return _google_million_rub(div.text)
+
+
+class GoogleRateScanner:
+    """
+    Потоковый поиск курса на странице Google Finance: куски ответа
+    просматриваются по мере загрузки, чтение прекращается на первом
+    div с нужным классом. DOM не строится; если разметка поменялась,
+    result() пробует полный разбор и громко сообщает о неудаче.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0  # откуда продолжать поиск
+        self.value = None  # текст внутри найденного div
+
+    def feed(self, chunk: bytes) -> bool:
+        """Добавить кусок ответа. True — значение найдено, дальше не читать."""
+        self._buf += chunk
+        start = self._buf.find(GOOGLE_RATE_MARKER, self._pos)
+        if start < 0:
+            self._pos = max(0, len(self._buf) - len(GOOGLE_RATE_MARKER) + 1)
+            return False
+        self._pos = start
+        gt = self._buf.find(b">", start + len(GOOGLE_RATE_MARKER))
+        lt = self._buf.find(b"<", gt) if gt >= 0 else -1
+        if lt < 0:
+            return False
+        self.value = self._buf[gt + 1:lt].decode("utf-8", errors="replace")
+        return True
+
+    def result(self):
+        if self.value is not None:
+            return _google_million_rub(self.value)
+
+        html = self._buf.decode("utf-8", errors="replace")
+        million_rub = _parse_google_html(html)
+        if million_rub is None:
+            _google_markup_changed()
+        else:
+            logger.warning(
+                "Google Finance: точечный поиск не сработал, помог полный разбор"
+            )
+        return million_rub
+
+
+def _google_markup_changed() -> None:
+    global GOOGLE_PARSE_FAILURES
+    GOOGLE_PARSE_FAILURES += 1
+    logger.error(f"Google Finance: не найден div с классом «{GOOGLE_RATE_CLASS}»")
+    # в админ-канал — только первый раз, дальше хватает счётчика
+    if GOOGLE_PARSE_FAILURES == 1:
+        log_to_channel(
+            "⚠️ Google Finance изменил разметку: курс KRW→RUB не найден, "
+            "работаем на резервном open.er-api"
+        )
+
+
+def _parse_er_api(data) -> float:
+    if data.get("result") != "success" or "KRW" not in data.get("rates", {}):
+        raise ValueError("open.er-api: нет курса KRW")
+    krw_per_rub = data["rates"]["KRW"]  # KRW за 1 RUB
+    # 1 RUB = krw_per_rub KRW => 1 KRW = 1/krw_per_rub RUB
+    return 1_000_000 / krw_per_rub
+
+
+# объёмы для строк «средняя цена на сумму», USDT
+ABCEX_DEPTH_SIZES = tuple(
+    float(x) for x in os.getenv("ABCEX_DEPTH_SIZES", "1000,10000,100000").split(",")
+)
+# как биржа может назвать объём уровня (по документации не сверено)
+ABCEX_QTY_FIELDS = ("volume", "quantity", "amount", "qty")
+# наборы полей уровня без объёма, о которых уже предупредили
+_ABCEX_UNKNOWN_LEVELS = set()
+
+
+class BookSide:
+    """
+    Одна сторона стакана: цены от лучшей к худшей и префиксные суммы
+    объёма и стоимости. Средняя цена на любой объём — бинарный поиск
+    по накопленному объёму, O(log n).
+    """
+
+    __slots__ = ("prices", "cum_qty", "cum_cost")
+
+    def __init__(self, levels):
+        self.prices = array("d")
+        self.cum_qty = array("d", [0.0])
+        self.cum_cost = array("d", [0.0])
+        for price, qty in levels:
+            self.prices.append(price)
+            self.cum_qty.append(self.cum_qty[-1] + qty)
+            self.cum_cost.append(self.cum_cost[-1] + price * qty)
+
+    def depth(self) -> float:
+        return self.cum_qty[-1]
+
+    def vwap(self, qty: float):
+        """Средняя цена исполнения qty или None, если стакана не хватает."""
+        if qty <= 0 or qty > self.depth():
+            return None
+        i = bisect.bisect_left(self.cum_qty, qty)  # cum_qty[i - 1] < qty
+        filled = self.cum_qty[i - 1]
+        cost = self.cum_cost[i - 1] + (qty - filled) * self.prices[i - 1]
+        return cost / qty
+
+
+def _abcex_levels(levels: list, reverse: bool) -> list:
+    """(цена, объём) по уровням; KeyError, если объёма нет ни в одном поле."""
+    out = []
+    for level in levels:
+        for f in ABCEX_QTY_FIELDS:
+            if level.get(f) is not None:
+                out.append((float(level["price"]), float(level[f])))
+                break
+        else:
+            raise KeyError(tuple(sorted(level)))
+    out.sort(reverse=reverse)
+    return out
+
+
+def _parse_abcex(data):
+    """
+    (best_buy, best_sell, depth): depth — строки (объём, средняя цена
+    продажи бирже, средняя цена покупки у биржи) для ABCEX_DEPTH_SIZES.
+    """
+    asks = data.get("ask") or []
+    bids = data.get("bid") or []
+    if not asks or not bids:
+        raise ValueError("Empty orderbook")
+
+    best_sell = min(float(a["price"]) for a in asks)  # по чём продают USDT
+    best_buy = max(float(b["price"]) for b in bids)   # по чём покупают USDT
+    try:
+        ask_side = BookSide(_abcex_levels(asks, reverse=False))
+        bid_side = BookSide(_abcex_levels(bids, reverse=True))
+    except KeyError as e:
+        # без объёмов глубину не посчитать: лучшие цены отдаём, VWAP — нет
+        fields = e.args[0]
+        if fields not in _ABCEX_UNKNOWN_LEVELS:
+            _ABCEX_UNKNOWN_LEVELS.add(fields)
+            logger.warning(f"ABCEX: нет объёма уровня, поля: {fields}")
+        return (best_buy, best_sell, tuple(
+            (size, None, None) for size in ABCEX_DEPTH_SIZES
+        ))
+    depth = tuple(
+        (size, bid_side.vwap(size), ask_side.vwap(size))
+        for size in ABCEX_DEPTH_SIZES
+    )
+    return (best_buy, best_sell, depth)
+
+
+def _fetch_upbit():
+    with upstream("upbit"):
+        r = http_get(f"{UPBIT_API}/v1/ticker", params={"markets": "KRW-USDT"})
+        r.raise_for_status()
+        return _parse_upbit(r.json())
+
+
+def _fetch_bithumb():
+    with upstream("bithumb"):
+        r = http_get(f"{BITHUMB_API}/public/ticker/USDT_KRW")
+        return _parse_bithumb(r.json())
+
+
+def _fetch_google_rub():
+    with upstream("google"):
+        scanner = GoogleRateScanner()
+        with http_get(
+            f"{GOOGLE_FINANCE_API}/finance/quote/RUB-KRW",
+            params={"hl": "en"},
+            stream=True,
+        ) as r:
+            for chunk in r.iter_content(chunk_size=16384):
+                if scanner.feed(chunk):
+                    break
+        million_rub = scanner.result()
+        if not million_rub:
+            raise ValueError("курс не найден на странице")
+        return million_rub
+
+
+def _fetch_er_api_rub():
+    with upstream("er_api"):
+        r = http_get(f"{ER_API}/v6/latest/RUB")
+        return _parse_er_api(r.json())
+
+
+def _fetch_krw_rub():
+    # Google Finance, а если он не уложился в HEDGE_DELAY — ещё и резервный API
+    return hedged(_fetch_google_rub, _fetch_er_api_rub)
+
+
+def _fetch_abcex():
+    with upstream("abcex"):
+        r = http_get(
+            f"{ABCEX_API}/api/v2/exchange/public/orderbook/depth",
+            params={"instrumentCode": "USDTRUB", "lang": "ru"},
+        )
+        return _parse_abcex(r.json())
+
+
+def get_upbit_usdt_krw(force: bool = False):
+    """
+    Курс USDT/KRW на Upbit (через пару KRW-USDT).
+    """
+    return RATE_CACHE.get("upbit", _fetch_upbit, force=force)
+
+
+def get_bithumb_usdt_krw(force: bool = False):
+    """
+    Курс USDT/KRW на Bithumb.
+    """
+    return RATE_CACHE.get("bithumb", _fetch_bithumb, force=force)
+
+
+def get_krw_rub_from_google(force: bool = False):
+    """
+    Возвращает, сколько РУБЛЕЙ за 1 000 000 KRW.
+    Сначала Google Finance RUB/KRW, потом резервный open.er-api.
+    """
+    return RATE_CACHE.get("rub", _fetch_krw_rub, force=force)
+
+
+def get_abcex_usdt_rub(force: bool = False):
+    """
+    Возвращает (best_buy, best_sell, depth) для USDT/RUB на ABCEX.
+    """
+    return RATE_CACHE.get(
+        "abcex", _fetch_abcex, default=(None, None), force=force
+    )
+
+
+# ============== СНИМОК КУРСОВ ==============
+
+# источник -> (функция, период обновления в сек, максимальный возраст в сек)
+# период не меньше ttl в CACHE_POLICY: фоновое обновление идёт мимо кэша
+RATE_SOURCES = {
+    "upbit": (get_upbit_usdt_krw, 10, 120),
+    "bithumb": (get_bithumb_usdt_krw, 10, 120),
+    "rub": (get_krw_rub_from_google, 1800, 6 * 60 * 60),
+    "abcex": (get_abcex_usdt_rub, 15, 120),
+}
+
+# сколько ждать первый снимок сразу после запуска
+SNAPSHOT_COLD_WAIT = 6
+
+
+@dataclass(frozen=True)
+class RateSnapshot:
+    """
+    Неизменяемый снимок курсов. Хендлеры читают его без блокировок,
+    фоновый поток только подменяет ссылку на новый снимок.
+    """
+    version: int = 0
+    values: Mapping = field(default_factory=lambda: MappingProxyType({}))
+    fetched: Mapping = field(default_factory=lambda: MappingProxyType({}))
+
+    def value(self, name: str, now: float = None):
+        """Значение источника или None, если его нет или оно устарело."""
+        ts = self.fetched.get(name)
+        if ts is None:
+            return None
+        now = time.time() if now is None else now
+        if now - ts > RATE_SOURCES[name][2]:
+            return None
+        return self.values.get(name)
+
+    def rates(self):
+        """(upbit, bithumb, rub_mln, ab_buy, ab_sell) без устаревших значений."""
+        now = time.time()
+        ab_buy, ab_sell = (self.value("abcex", now) or (None, None))[:2]
+        return (
+            self.value("upbit", now),
+            self.value("bithumb", now),
+            self.value("rub", now),
+            ab_buy,
+            ab_sell,
+        )
+
+    def depth(self) -> tuple:
+        """Строки средней цены ABCEX на объём; пусто, если курс устарел."""
+        quote = self.value("abcex")
+        if not quote or len(quote) < 3:
+            return ()
+        return tuple(tuple(row) for row in quote[2])
+
+    def updated_at(self):
+        """Время самого свежего значения в снимке (МСК)."""
+        if not self.fetched:
+            return None
+        return datetime.fromtimestamp(max(self.fetched.values()), MOSCOW_TZ)
+
+
+_SNAPSHOT = RateSnapshot()
+_SNAPSHOT_LOCK = threading.Lock()
+_SNAPSHOT_READY = threading.Event()
+
+
+def get_rate_snapshot() -> RateSnapshot:
+    return _SNAPSHOT
+
+
+def wait_rate_snapshot(timeout: float = SNAPSHOT_COLD_WAIT) -> RateSnapshot:
+    """На холодном старте ждём первый проход обновления, дальше — мгновенно."""
+    _SNAPSHOT_READY.wait(timeout)
+    return _SNAPSHOT
+
+
+def _publish_snapshot(updates: dict) -> None:
+    """updates: источник -> (значение, время получения)."""
+    global _SNAPSHOT
+    with _SNAPSHOT_LOCK:
+        old = _SNAPSHOT
+        values = dict(old.values)
+        fetched = dict(old.fetched)
+        for name, (v, ts) in updates.items():
+            values[name] = v
+            fetched[name] = ts
+        _SNAPSHOT = RateSnapshot(
+            version=old.version + 1,
+            values=MappingProxyType(values),
+            fetched=MappingProxyType(fetched),
+        )
+        new = _SNAPSHOT
+    if HISTORY is not None:
+        HISTORY.record(updates)
+    if CLUSTER.is_leader():
+        deliver_alerts(old, new)
+
+
+def _valid_rate(v) -> bool:
+    if isinstance(v, tuple):
+        return any(v)
+    return bool(v)
+
+
+def rate_refresh_loop(stop: threading.Event = None):
+    """
+    Единственный поток, который ходит на биржи. Каждый источник
+    обновляется со своим периодом, независимо от числа нажатий.
+    stop — чтобы остановить цикл в тестах.
+    """
+    next_due = {name: 0.0 for name in RATE_SOURCES}
+    inflight = {}  # источник -> запрос, который ещё идёт
+    first_pass_until = None  # холодный старт ждёт не дольше FETCH_BUDGET
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(RATE_SOURCES), thread_name_prefix="rates"
+    ) as ex:
+        while stop is None or not stop.is_set():
+            if not CLUSTER.is_leader():
+                # курсы приходят от лидера через общее хранилище
+                time.sleep(1)
+                continue
+
+            now = time.time()
+            for name, t in next_due.items():
+                if t > now or name in inflight:
+                    continue
+                if stream_is_fresh(name):
+                    next_due[name] = now + RATE_SOURCES[name][1]
+                else:
+                    # мимо stale-while-revalidate: нужен свежий ответ
+                    inflight[name] = ex.submit(
+                        RATE_SOURCES[name][0], force=True
+                    )
+            if first_pass_until is None:
+                first_pass_until = now + FETCH_BUDGET
+
+            # ждём первый готовый ответ, но не дольше ближайшего срока:
+            # зависший источник не задерживает ни публикацию, ни опрос
+            # остальных
+            waiting = [t for name, t in next_due.items() if name not in inflight]
+            until = min(waiting, default=now + 1)
+            if not _SNAPSHOT_READY.is_set():
+                until = min(until, first_pass_until)
+            timeout = max(0.05, until - time.time())
+            if inflight:
+                concurrent.futures.wait(
+                    inflight.values(), timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+            else:
+                time.sleep(timeout)
+
+            updates = {}
+            for name, fu in list(inflight.items()):
+                if not fu.done():
+                    continue
+                del inflight[name]
+                next_due[name] = time.time() + RATE_SOURCES[name][1]
+                try:
+                    v = fu.result()
+                except Exception:
+                    logger.exception(f"Ошибка обновления {name}")
+                    continue
+                # фетчеры отдают старое значение при ошибке, поэтому
+                # возраст берём из кэша, а не из времени вызова
+                _, ts = RATE_CACHE.peek(name)
+                if _valid_rate(v) and ts:
+                    updates[name] = (v, ts)
+
+            if updates:
+                _publish_snapshot(updates)
+                CLUSTER.share_snapshot(updates)
+            if not inflight or time.time() >= first_pass_until:
+                _SNAPSHOT_READY.set()
+
+
+# ============== ПОТОКОВЫЕ КОТИРОВКИ ==============
+
+# RATE_STREAM=1: Upbit и Bithumb приходят по WebSocket (нужен websocket-client),
+# REST остаётся запасным путём, пока поток молчит дольше STREAM_STALE.
+# У ABCEX публичного потока нет — он всегда опрашивается по REST.
+RATE_STREAM = os.getenv("RATE_STREAM", "0") == "1"
+STREAM_STALE = float(os.getenv("STREAM_STALE", "15"))
+STREAM_BACKOFF_MAX = float(os.getenv("STREAM_BACKOFF_MAX", "60"))
+# неизменную цену переиздаём не реже этого, иначе снимок её «состарит»,
+# а REST-опрос при живом потоке пропускается
+STREAM_REPUBLISH = float(os.getenv("STREAM_REPUBLISH", "30"))
+UPBIT_WS = os.getenv("UPBIT_WS", "wss://api.upbit.com/websocket/v1")
+BITHUMB_WS = os.getenv("BITHUMB_WS", "wss://pubwss.bithumb.com/pub/ws")
+
+
+def _upbit_subscribe() -> str:
+    return json.dumps([
+        {"ticket": f"rates-{REPLICA_ID}"},
+        {"type": "ticker", "codes": ["KRW-USDT"]},
+    ])
+
+
+def _parse_upbit_tick(msg):
+    data = json.loads(msg)
+    if data.get("code") != "KRW-USDT":
+        return None
+    return float(data["trade_price"])
+
+
+def _bithumb_subscribe() -> str:
+    return json.dumps(
+        {"type": "ticker", "symbols": ["USDT_KRW"], "tickTypes": ["MID"]}
+    )
+
+
+def _parse_bithumb_tick(msg):
+    data = json.loads(msg)
+    if data.get("type") != "ticker":
+        return None  # подтверждения подписки и прочие служебные сообщения
+    return float(data["content"]["closePrice"])
+
+
+class PriceStream:
+    """
+    Одно WebSocket-подключение к бирже: держит последнюю цену и
+    публикует её в снимок при изменении, а неизменную — раз в
+    STREAM_REPUBLISH секунд, чтобы не устарела. Обрыв или тишина дольше
+    STREAM_STALE — переподключение с экспоненциальной задержкой.
+    """
+
+    def __init__(self, name: str, url: str, subscribe, parse):
+        self.name = name
+        self.url = url
+        self.subscribe = subscribe
+        self.parse = parse
+        self.value = None
+        self.last_tick = 0.0
+        self.published_at = 0.0
+
+    def is_fresh(self, now: float = None) -> bool:
+        now = time.time() if now is None else now
+        return now - self.last_tick <= STREAM_STALE
+
+    def _on_message(self, msg) -> None:
+        value = self.parse(msg)
+        if not value:
+            return
+        now = time.time()
+        self.last_tick = now
+        if not CLUSTER.is_leader():
+            return
+        if value == self.value and now - self.published_at < STREAM_REPUBLISH:
+            return
+        self.value = value
+        self.published_at = now
+        updates = {self.name: (value, now)}
+        _publish_snapshot(updates)
+        CLUSTER.share_snapshot(updates)
+        _SNAPSHOT_READY.set()
+
+    def run(self) -> None:
+        try:
+            import websocket
+        except ImportError:
+            logger.warning("RATE_STREAM: нет websocket-client, остаёмся на REST")
+            return
+
+        failures = 0
+        while True:
+            try:
+                ws = websocket.create_connection(self.url, timeout=STREAM_STALE)
+                try:
+                    ws.send(self.subscribe())
+                    logger.info(f"Поток {self.name}: подключено к {self.url}")
+                    while True:
+                        self._on_message(ws.recv())
+                        failures = 0
+                finally:
+                    ws.close()
+            except Exception as e:
+                logger.warning(f"Поток {self.name}: {e}")
+            failures += 1
+            delay = min(STREAM_BACKOFF_MAX, 2 ** failures)
+            time.sleep(delay * random.uniform(0.5, 1))
+
+
+STREAMS = {
+    "upbit": PriceStream("upbit", UPBIT_WS, _upbit_subscribe, _parse_upbit_tick),
+    "bithumb": PriceStream(
+        "bithumb", BITHUMB_WS, _bithumb_subscribe, _parse_bithumb_tick
+    ),
+}
+
+
+def stream_is_fresh(name: str) -> bool:
+    """True — источник сейчас идёт по WebSocket и REST-опрос не нужен."""
+    stream = STREAMS.get(name) if RATE_STREAM else None
+    return stream is not None and stream.is_fresh()
+
+
+def start_streams() -> None:
+    if not RATE_STREAM:
+        return
+    for stream in STREAMS.values():
+        threading.Thread(
+            target=stream.run, daemon=True, name=f"stream-{stream.name}"
+        ).start()
+
+
+# ============== ИСТОРИЯ КУРСОВ ==============
+
+# пусто — хранить историю только в памяти
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+HISTORY_RAW_POINTS = int(os.getenv("HISTORY_RAW_POINTS", "50000"))
+HISTORY_MINUTES = 7 * 24 * 60
+HISTORY_HOURS = 365 * 24
+
+# ряд истории -> (источник в снимке, индекс в кортеже или None)
+HISTORY_SERIES = {
+    "upbit": ("upbit", None),
+    "bithumb": ("bithumb", None),
+    "abcex_buy": ("abcex", 0),
+    "abcex_sell": ("abcex", 1),
+    "rub": ("rub", None),
+}
+
+
+class RingSeries:
+    """
+    Кольцевой буфер строк фиксированной ширины из float64. Первое поле
+    строки — время. Лежит в памяти или в mmap-файле: [голова, число
+    строк, строки...]. Добавление O(1), поиск по времени — бинарный.
+    """
+
+    def __init__(self, capacity: int, width: int, path: str = None):
+        self.capacity = capacity
+        self.width = width
+        size = (2 + capacity * width) * 8
+        if path:
+            fresh = not os.path.exists(path) or os.path.getsize(path) != size
+            self._fh = open(path, "w+b" if fresh else "r+b")
+            if fresh:
+                self._fh.truncate(size)
+            self._mm = mmap.mmap(self._fh.fileno(), size)
+            self._data = memoryview(self._mm).cast("d")
+        else:
+            self._data = array("d", bytes(size))
+
+    def __len__(self) -> int:
+        return int(self._data[1])
+
+    def _offset(self, i: int) -> int:
+        """Смещение i-й по старшинству строки (0 — самая старая)."""
+        head, n = int(self._data[0]), int(self._data[1])
+        return 2 + ((head - n + i) % self.capacity) * self.width
+
+    def row(self, i: int) -> tuple:
+        if i < 0:
+            i += len(self)
+        o = self._offset(i)
+        return tuple(self._data[o:o + self.width])
+
+    def append(self, row) -> None:
+        head, n = int(self._data[0]), int(self._data[1])
+        o = 2 + head * self.width
+        self._data[o:o + self.width] = array("d", row)
+        self._data[0] = (head + 1) % self.capacity
+        self._data[1] = min(n + 1, self.capacity)
+
+    def replace_last(self, row) -> None:
+        o = self._offset(len(self) - 1)
+        self._data[o:o + self.width] = array("d", row)
+
+    def _ts(self, i: int) -> float:
+        return self._data[self._offset(i)]
+
+    def index_at(self, ts: float) -> int:
+        """Индекс первой строки со временем >= ts."""
+        return bisect.bisect_left(range(len(self)), ts, key=self._ts)
+
+    def range(self, t0: float, t1: float = float("inf")) -> list:
+        start = self.index_at(t0)
+        end = bisect.bisect_right(range(len(self)), t1, key=self._ts)
+        return [self.row(i) for i in range(start, end)]
+
+
+class OhlcSeries(RingSeries):
+    """Свечи (начало, open, high, low, close) с шагом step секунд."""
+
+    def __init__(self, capacity: int, step: int, path: str = None):
+        super().__init__(capacity, 5, path)
+        self.step = step
+
+    def add(self, ts: float, value: float) -> None:
+        bucket = ts - ts % self.step
+        if len(self) and self.row(-1)[0] == bucket:
+            _, o, h, lo, _ = self.row(-1)
+            self.replace_last((bucket, o, max(h, value), min(lo, value), value))
+        elif not len(self) or self.row(-1)[0] < bucket:
+            self.append((bucket, value, value, value, value))
+
+
+class RateHistory:
+    """
+    История каждого ряда: сырые точки (время, значение) и свечи
+    по 1 минуте и 1 часу, которые досчитываются при каждом добавлении.
+    """
+
+    def __init__(self, directory: str = ""):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        def path(name):
+            return os.path.join(directory, f"{name}.bin") if directory else None
+
+        self._lock = threading.Lock()
+        self.raw = {}
+        self.m1 = {}
+        self.h1 = {}
+        for name in HISTORY_SERIES:
+            self.raw[name] = RingSeries(
+                HISTORY_RAW_POINTS, 2, path(f"{name}.raw")
+            )
+            self.m1[name] = OhlcSeries(HISTORY_MINUTES, 60, path(f"{name}.1m"))
+            self.h1[name] = OhlcSeries(HISTORY_HOURS, 3600, path(f"{name}.1h"))
+
+    def record(self, updates: dict) -> None:
+        """updates: источник снимка -> (значение, время получения)."""
+        with self._lock:
+            for name, (source, idx) in HISTORY_SERIES.items():
+                if source not in updates:
+                    continue
+                value, ts = updates[source]
+                if idx is not None:
+                    value = value[idx] if value else None
+                raw = self.raw[name]
+                if not value or (len(raw) and raw.row(-1)[0] >= ts):
+                    continue
+                raw.append((ts, value))
+                self.m1[name].add(ts, value)
+                self.h1[name].add(ts, value)
+
+    def value_at(self, name: str, ts: float):
+        """Последнее известное значение на момент ts."""
+        with self._lock:
+            raw = self.raw[name]
+            i = raw.index_at(ts)
+            if i < len(raw) and raw.row(i)[0] == ts:
+                return raw.row(i)[1]
+            if i > 0:
+                return raw.row(i - 1)[1]
+            # сырые точки уже вытеснены — берём закрытие свечи
+            for series in (self.m1[name], self.h1[name]):
+                j = series.index_at(ts)
+                if j > 0:
+                    return series.row(j - 1)[4]
+            return None
+
+    def candles(self, name: str, t0: float, t1: float = float("inf")) -> list:
+        """Свечи за период: минутные, если их хватает, иначе часовые."""
+        with self._lock:
+            m1 = self.m1[name]
+            if len(m1) and m1.row(0)[0] <= t0:
+                return m1.range(t0, t1)
+            return self.h1[name].range(t0, t1)
+
+
+def open_history():
+    directory = HISTORY_DIR
+    if directory and CLUSTER_MODE:
+        # у каждой реплики свои файлы: mmap не делится между процессами.
+        # Имя по умолчанию (хост-pid) меняется с каждым запуском — история
+        # терялась бы, а старые каталоги копились бы на диске
+        if not os.getenv("REPLICA_ID"):
+            raise RuntimeError(
+                "CLUSTER_MODE с HISTORY_DIR требует постоянного REPLICA_ID"
+            )
+        directory = os.path.join(directory, REPLICA_ID)
+    try:
+        return RateHistory(directory)
+    except OSError:
+        logger.exception("История курсов: файлы недоступны, храним в памяти")
+        return RateHistory()
+
+
+HISTORY = None  # открывается в main(), чтобы импорт не создавал файлов
+
+
+def history_change_text(hours: int = 24) -> str:
+    now = time.time()
+    labels = {
+        "upbit": ("UPBIT", "₩", 0),
+        "bithumb": ("BITHUMB", "₩", 0),
+        "abcex_buy": ("ABCEX покупка", "₽", 2),
+        "abcex_sell": ("ABCEX продажа", "₽", 2),
+        "rub": ("1 000 000 ₩ →", "₽", 2),
+    }
+    lines = [f"📈 <b>Изменение за {hours} ч</b>\n"]
+    for name, (label, unit, d) in labels.items():
+        cur = HISTORY.value_at(name, now) if HISTORY else None
+        old = HISTORY.value_at(name, now - hours * 3600) if HISTORY else None
+        if not cur:
+            lines.append(f"◾ {label}: —")
+            continue
+        candles = HISTORY.candles(name, now - hours * 3600)
+        row = f"◾ {label}: <b>{fmt_num(cur, d)} {unit}</b>"
+        if old:
+            row += f" ({(cur / old - 1) * 100:+.2f}%)"
+        if candles:
+            hi = max(c[2] for c in candles)
+            lo = min(c[3] for c in candles)
+            row += f"\n    мин {fmt_num(lo, d)} / макс {fmt_num(hi, d)}"
+        lines.append(row)
+    return "\n".join(lines)
+
+
+# ============== АРБИТРАЖ И КОНВЕРТАЦИЯ ==============
+
+# комиссии площадок, доля от суммы
+CONVERT_FEES = {
+    "UPBIT": float(os.getenv("FEE_UPBIT", "0.0005")),
+    "BITHUMB": float(os.getenv("FEE_BITHUMB", "0.0004")),
+    "ABCEX": float(os.getenv("FEE_ABCEX", "0.001")),
+    "Банк": float(os.getenv("FEE_BANK", "0")),
+}
+CURRENCY_SIGNS = {"USDT": "USDT", "KRW": "₩", "RUB": "₽"}
+CURRENCY_DIGITS = {"USDT": 2, "KRW": 0, "RUB": 2}
+CURRENCY_ALIASES = {
+    "usdt": "USDT", "tether": "USDT", "usd": "USDT", "$": "USDT",
+    "krw": "KRW", "won": "KRW", "вон": "KRW", "₩": "KRW",
+    "rub": "RUB", "руб": "RUB", "рубль": "RUB", "рублей": "RUB", "₽": "RUB",
+}
+ARB_AMOUNTS = (("KRW", "RUB", 1_000_000), ("RUB", "KRW", 100_000))
+
+
+def rate_edges(snap: RateSnapshot) -> list:
+    """
+    Прямые обмены из снимка: (из, в, сколько «в» за 1 «из», площадка).
+    Комиссия уже вычтена.
+    """
+    upbit = snap.value("upbit")
+    bithumb = snap.value("bithumb")
+    rub_mln = snap.value("rub")
+    ab_buy, ab_sell = (snap.value("abcex") or (None, None))[:2]
+
+    edges = []
+
+    def add(src, dst, rate, venue):
+        if rate:
+            edges.append((src, dst, rate * (1 - CONVERT_FEES[venue]), venue))
+
+    for venue, price in (("UPBIT", upbit), ("BITHUMB", bithumb)):
+        if price:
+            add("USDT", "KRW", price, venue)
+            add("KRW", "USDT", 1 / price, venue)
+    if ab_buy:
+        add("USDT", "RUB", ab_buy, "ABCEX")    # продаём USDT по биду
+    if ab_sell:
+        add("RUB", "USDT", 1 / ab_sell, "ABCEX")  # покупаем по аску
+    if rub_mln:
+        add("KRW", "RUB", rub_mln / 1_000_000, "Банк")
+        add("RUB", "KRW", 1_000_000 / rub_mln, "Банк")
+    return edges
+
+
+def convert_routes(edges: list) -> dict:
+    """
+    Все простые маршруты между валютами (их три, так что перебор —
+    это несколько десятков произведений): (из, в) -> [(курс, шаги)],
+    лучший маршрут первым.
+    """
+    out = defaultdict(list)
+    by_src = defaultdict(list)
+    for e in edges:
+        by_src[e[0]].append(e)
+
+    def walk(start, cur, rate, hops):
+        for e in by_src[cur]:
+            dst = e[1]
+            if dst == start or any(h[0] == dst for h in hops):
+                continue
+            path = hops + [e]
+            out[(start, dst)].append((rate * e[2], path))
+            walk(start, dst, rate * e[2], path)
+
+    for cur in CURRENCY_SIGNS:
+        walk(cur, cur, 1.0, [])
+    for routes in out.values():
+        routes.sort(key=lambda r: -r[0])
+    return dict(out)
+
+
+_ROUTES = (-1, {})  # (версия снимка, маршруты)
+_PREMIUM_RANGES = {}  # (площадка, минута истории) -> (min, max) или None
+
+
+def snapshot_routes(snap: RateSnapshot) -> dict:
+    """Маршруты считаются один раз на версию снимка."""
+    global _ROUTES
+    version, routes = _ROUTES
+    if version != snap.version:
+        routes = convert_routes(rate_edges(snap))
+        _ROUTES = (snap.version, routes)
+    return routes
+
+
+def route_label(hops: list) -> str:
+    parts = [hops[0][0]]
+    for src, dst, _, venue in hops:
+        parts.append(f"→({venue}) {dst}")
+    return " ".join(parts)
+
+
+def implied_usdt_krw(ab_mid, rub_mln):
+    """Сколько вон стоит USDT, если идти через рубли."""
+    if not ab_mid or not rub_mln:
+        return None
+    return ab_mid * 1_000_000 / rub_mln
+
+
+def premium_series(name: str, hours: int = 24) -> list:
+    """
+    Премия площадки к рублёвому маршруту по минутным свечам:
+    ряды выравниваются по началу минуты и считаются одним проходом.
+    """
+    if HISTORY is None:
+        return []
+    t0 = time.time() - hours * 3600
+    closes = {}
+    for series in (name, "abcex_buy", "abcex_sell", "rub"):
+        closes[series] = {c[0]: c[4] for c in HISTORY.candles(series, t0)}
+    common = set(closes[name])
+    for series in ("abcex_buy", "abcex_sell", "rub"):
+        common &= closes[series].keys()
+    ts = sorted(common)
+    price = [closes[name][t] for t in ts]
+    mid = [
+        (closes["abcex_buy"][t] + closes["abcex_sell"][t]) / 2 for t in ts
+    ]
+    rub = [closes["rub"][t] for t in ts]
+    return [
+        (t, p / (m * 1_000_000 / r) - 1)
+        for t, p, m, r in zip(ts, price, mid, rub)
+    ]
+
+
+def premium_range(name: str):
+    """
+    (min, max) премии за 24 ч. Свечи минутные, поэтому диапазон
+    считается раз в минуту, а не на каждое нажатие.
+    """
+    key = (name, int(time.time() // 60))
+    span = _PREMIUM_RANGES.get(key, False)
+    if span is not False:
+        return span
+    series = [p for _, p in premium_series(name)]
+    span = (min(series), max(series)) if series else None
+    if len(_PREMIUM_RANGES) > 16:
+        _PREMIUM_RANGES.clear()
+    _PREMIUM_RANGES[key] = span
+    return span
+
+
+def arbitrage_text(snap: RateSnapshot) -> str:
+    ab_buy, ab_sell = (snap.value("abcex") or (None, None))[:2]
+    rub_mln = snap.value("rub")
+    ab_mid = (ab_buy + ab_sell) / 2 if ab_buy and ab_sell else None
+    implied = implied_usdt_krw(ab_mid, rub_mln)
+
+    lines = ["💹 <b>АРБИТРАЖ</b>\n"]
+    if implied:
+        lines.append(
+            f"🔁 USDT через рубли: <b>{fmt_num(implied, 0)} ₩</b>\n"
+            f"◾ 1 ₩ = {fmt_num(rub_mln / 1_000_000, 5)} ₽"
+        )
+        lines.append("\n🇰🇷 <b>Премия к рублёвому маршруту</b>")
+        for name, label in (("upbit", "UPBIT"), ("bithumb", "BITHUMB")):
+            price = snap.value(name)
+            if not price:
+                lines.append(f"◾ {label}: —")
+                continue
+            row = f"◾ {label}: <b>{(price / implied - 1) * 100:+.2f}%</b>"
+            span = premium_range(name)
+            if span:
+                row += (
+                    f" (24 ч: {span[0] * 100:+.2f}% … "
+                    f"{span[1] * 100:+.2f}%)"
+                )
+            lines.append(row)
+
+    routes = snapshot_routes(snap)
+    if not implied and not routes:
+        return RATE_ERROR_TEXT
+    lines.append("\n🧭 <b>Лучшие маршруты (с комиссиями)</b>")
+    for src, dst, amount in ARB_AMOUNTS:
+        options = routes.get((src, dst))
+        head = f"{fmt_num(amount, CURRENCY_DIGITS[src])} {CURRENCY_SIGNS[src]}"
+        if not options:
+            lines.append(f"◾ {head} → —")
+            continue
+        rate, hops = options[0]
+        lines.append(
+            f"◾ {head} → <b>{fmt_num(amount * rate, CURRENCY_DIGITS[dst])} "
+            f"{CURRENCY_SIGNS[dst]}</b>\n    {route_label(hops)}"
+        )
+    return "\n".join(lines)
+
+
+CONVERT_USAGE = (
+    "Использование: <code>/convert 1000000 krw rub</code>\n"
+    "Валюты: USDT, KRW, RUB."
+)
+
+
+def parse_convert_args(text: str):
+    """'/convert 1 000 000 krw rub' -> (1000000.0, 'KRW', 'RUB') или None."""
+    args = (text or "").split()[1:]
+    if len(args) < 3:
+        return None
+    src = CURRENCY_ALIASES.get(args[-2].lower())
+    dst = CURRENCY_ALIASES.get(args[-1].lower())
+    try:
+        amount = float("".join(args[:-2]).replace(",", "."))
+    except ValueError:
+        return None
+    # float() принимает и «nan», и «inf»
+    if not src or not dst or not math.isfinite(amount) or amount <= 0:
+        return None
+    return amount, src, dst
+
+
+def convert_text(text: str, snap: RateSnapshot) -> str:
+    parsed = parse_convert_args(text)
+    if parsed is None:
+        return CONVERT_USAGE
+    amount, src, dst = parsed
+    head = f"{fmt_num(amount, CURRENCY_DIGITS[src])} {CURRENCY_SIGNS[src]}"
+    if src == dst:
+        return f"{head} = {head}"
+
+    options = snapshot_routes(snap).get((src, dst))
+    if not options:
+        return RATE_ERROR_TEXT
+    lines = []
+    for i, (rate, hops) in enumerate(options[:3]):
+        total = fmt_num(amount * rate, CURRENCY_DIGITS[dst])
+        if i == 0:
+            lines.append(f"💱 {head} → <b>{total} {CURRENCY_SIGNS[dst]}</b>")
+            lines.append(f"🧭 {route_label(hops)}\n")
+            if len(options) > 1:
+                lines.append("Другие маршруты:")
+        else:
+            lines.append(f"◾ {total} {CURRENCY_SIGNS[dst]} — {route_label(hops)}")
+    lines.append("\nКомиссии площадок учтены.")
+    return "\n".join(lines)
+
+
+# ============== ТЕКСТ КУРСА ==============
+
+def build_depth_text(depth) -> str:
+    rows = []
+    for size, buy, sell in depth:
+        if not buy and not sell:
+            continue
+        buy_txt = fmt_num(buy, 2) if buy else "—"
+        sell_txt = fmt_num(sell, 2) if sell else "—"
+        rows.append(f"◾ {fmt_num(size, 0)} USDT: {buy_txt} / {sell_txt} ₽\n")
+    if not rows:
+        return ""
+    return "\n📚 <b>Средняя цена на объём</b> (покупка / продажа)\n" + "".join(rows)
+
+
+def build_rate_text(
+    upbit, bithumb, rub_mln, ab_buy=None, ab_sell=None, updated=None, depth=()
+) -> str:
+    upbit_txt = f"{fmt_num(upbit, 0)} ₩" if upbit else "—"
+    bithumb_txt = f"{fmt_num(bithumb, 0)} ₩" if bithumb else "—"
+    rub_txt = f"{fmt_num(rub_mln, 2)} ₽" if rub_mln else "—"
+
+    ab_buy_txt = f"{fmt_num(ab_buy, 2)} ₽" if ab_buy else "—"
+    ab_sell_txt = f"{fmt_num(ab_sell, 2)} ₽" if ab_sell else "—"
+
+    timestamp = (updated or now_msk()).strftime("%d.%m.%Y, %H:%M")
+
+    text = (
+        "💱 <b>АКТУАЛЬНЫЕ КУРСЫ</b>\n\n"
+        "🇰🇷 <b>USDT → KRW</b>\n"
+        f"◾ UPBIT:   <b>{upbit_txt}</b>\n"
+        f"◾ BITHUMB: <b>{bithumb_txt}</b>\n"
+        "━━━━━━━━━━━━━━\n\n"
+        "🇷🇺 <b>USDT → RUB (ABCEX)</b>\n"
+        f"◾ Покупка: <b>{ab_buy_txt}</b>\n"
+        f"◾ Продажа: <b>{ab_sell_txt}</b>\n"
+        f"{build_depth_text(depth)}"
+        "━━━━━━━━━━━━━━\n\n"
+        "🇰🇷➡️🇷🇺 <b>KRW → RUB</b>\n"
+        f"◾ 1 000 000 ₩ → <b>{rub_txt}</b>\n"
+        "━━━━━━━━━━━━━━\n"
+        f"⏱ Обновлено: <b>{timestamp} (МСК)</b>\n\n"
+        "💰 Обмен любых сумм и валют — по договоренности.\n"
+        "📞 Контакт: @Abdulkhaiii"
+    )
+    return text
+
+
+def build_rate_log_line(upbit, bithumb, rub_mln, ab_buy, ab_sell) -> str:
+    return (
+        f"Upbit: {fmt_num(upbit, 0) if upbit else '—'} | "
+        f"Bithumb: {fmt_num(bithumb, 0) if bithumb else '—'} | "
+        f"KRW→RUB (1M): {fmt_num(rub_mln, 2) if rub_mln else '—'} ₽ | "
+        f"ABCEX buy/sell: "
+        f"{fmt_num(ab_buy, 2) if ab_buy else '—'} / "
+        f"{fmt_num(ab_sell, 2) if ab_sell else '—'} ₽"
+    )
+
+
+# шаблон -> функция (курсы, время обновления) -> текст
+RATE_TEMPLATES = {
+    "rates": lambda rates, updated, depth: build_rate_text(
+        *rates, updated=updated, depth=depth
+    ),
+    "log": lambda rates, updated, depth: build_rate_log_line(*rates),
+}
+
+_RENDERED = {}  # (версия снимка, шаблон, курсы) -> текст
+
+
+def render_snapshot(snap: RateSnapshot, template: str = "rates"):
+    """
+    Текст курса для снимка. Форматируется один раз на версию снимка
+    и шаблон, дальше все пользователи получают готовую строку.
+    None — если в снимке нет ни одного актуального курса.
+    """
+    rates = snap.rates()
+    # в ключе и сами курсы: значение может устареть без смены версии
+    key = (snap.version, template, rates)
+    text = _RENDERED.get(key)
+    METRICS.inc(
+        "render_cache_requests_total", template=template,
+        result="miss" if text is None else "hit",
+    )
+    if text is None:
+        if not any(rates):
+            return None
+        if len(_RENDERED) > 64:
+            _RENDERED.clear()
+        render = RATE_TEMPLATES[template]
+        with METRICS.timer("render", template=template):
+            text = render(rates, snap.updated_at(), snap.depth())
+        _RENDERED[key] = text
+    return text
+
+
+# ============== РАССЫЛКА ==============
+
+# лимиты Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек в один чат
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_INTERVAL = float(os.getenv("SEND_CHAT_INTERVAL", "1"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+SEND_MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """Ведро токенов с резервированием: acquire() ждёт ровно до своего слота."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._ts) * self.rate
+            )
+            self._ts = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def _retry_after(e: Exception):
+    if isinstance(e, ApiTelegramException) and e.error_code == 429:
+        params = (e.result_json or {}).get("parameters") or {}
+        return params.get("retry_after", 1)
+    return None
+
+
+def _is_permanent_error(e: Exception) -> bool:
+    # пользователь заблокировал бота / удалил чат — повторять бессмысленно
+    return isinstance(e, ApiTelegramException) and e.error_code in (400, 403)
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих сообщений для рассылок. Пул воркеров отправляет
+    сообщения не быстрее глобального лимита, между сообщениями в один
+    чат держит паузу. На 429 ждёт retry_after только этот чат: его
+    сообщения откладываются, остальные чаты идут без задержки.
+    """
+
+    def __init__(self, send, workers: int = SEND_WORKERS):
+        self._send = send
+        self._workers = workers
+        self._bucket = TokenBucket(SEND_GLOBAL_RATE, capacity=SEND_GLOBAL_RATE)
+        self._heap = []  # (не раньше, seq, задание)
+        self._seq = 0
+        self._chat_next = {}  # chat_id -> ближайшее свободное время
+        self._chat_hold = {}  # chat_id -> до какого времени чат на 429
+        self._prune_at = 10_000
+        self._cond = threading.Condition()
+        self._started = False
+        self._stats_lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def start(self) -> None:
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self._workers):
+            threading.Thread(
+                target=self._worker, name=f"outbox-{i}", daemon=True
+            ).start()
+
+    def send(self, chat_id, text: str, on_error=None, on_sent=None,
+             **kwargs) -> None:
+        """
+        Поставить сообщение в очередь. on_error(chat_id, e) — при отказе,
+        on_sent(chat_id) — после доставки.
+        """
+        job = {
+            "chat_id": chat_id,
+            "text": text,
+            "kwargs": kwargs,
+            "on_error": on_error,
+            "on_sent": on_sent,
+            "attempts": 0,
+        }
+        with self._cond:
+            now = time.monotonic()
+            at = max(now, self._chat_next.get(chat_id, 0))
+            self._chat_next[chat_id] = at + SEND_CHAT_INTERVAL
+            if len(self._chat_next) > self._prune_at:
+                self._chat_next = {
+                    k: v for k, v in self._chat_next.items() if v > now
+                }
+                self._prune_at = max(10_000, 2 * len(self._chat_next))
+            self._push(at, job)
+        self._count("queued")
+
+    def depth(self) -> int:
+        return len(self._heap)
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _push(self, at: float, job: dict) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (at, self._seq, job))
+        self._cond.notify()
+
+    def _next_job(self) -> dict:
+        with self._cond:
+            while True:
+                if self._heap:
+                    now = time.monotonic()
+                    wait = self._heap[0][0] - now
+                    if wait <= 0:
+                        job = heapq.heappop(self._heap)[2]
+                        until = self._chat_hold.get(job["chat_id"])
+                        if until is None:
+                            return job
+                        if until <= now:
+                            del self._chat_hold[job["chat_id"]]
+                            return job
+                        # поставлено до 429 — ждёт вместе с чатом
+                        self._push(until, job)
+                        continue
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            self._bucket.acquire()
+            job["attempts"] += 1
+            try:
+                self._send(job["chat_id"], job["text"], **job["kwargs"])
+                self._count("sent")
+            except Exception as e:
+                self._failed(job, e)
+                continue
+            if job["on_sent"]:
+                try:
+                    job["on_sent"](job["chat_id"])
+                except Exception:
+                    logger.exception("Ошибка в on_sent рассылки")
+
+    def _failed(self, job: dict, e: Exception) -> None:
+        retry_after = _retry_after(e)
+        if retry_after is not None:
+            self._count("rate_limited")
+        if _is_permanent_error(e) or job["attempts"] >= SEND_MAX_ATTEMPTS:
+            self._count("failed")
+            logger.warning(f"Не доставлено в {job['chat_id']}: {e}")
+            if job["on_error"]:
+                try:
+                    job["on_error"](job["chat_id"], e)
+                except Exception:
+                    logger.exception("Ошибка в on_error рассылки")
+            return
+
+        self._count("retried")
+        delay = retry_after if retry_after is not None else 2 ** job["attempts"]
+        chat_id = job["chat_id"]
+        with self._cond:
+            at = time.monotonic() + delay
+            if retry_after is not None:
+                self._chat_hold[chat_id] = max(
+                    at, self._chat_hold.get(chat_id, 0)
+                )
+                self._chat_next[chat_id] = max(
+                    at + SEND_CHAT_INTERVAL, self._chat_next.get(chat_id, 0)
+                )
+            self._push(at, job)
+
+
+OUTBOX = OutboundQueue(bot.send_message)
+
+
+def drop_blocked_auto_user(chat_id, e: Exception) -> None:
+    if "blocked" in str(e).lower():
+        remove_auto_user(chat_id)
+        for aid in ALERTS.for_chat(chat_id):
+            remove_alert(aid)
+        forget_keyboard(chat_id)
+
+
+# ============== ЛОГИ В КАНАЛ ==============
+
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "10"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "50"))
+LOG_QUEUE_LIMIT = int(os.getenv("LOG_QUEUE_LIMIT", "2000"))
+# лимит Telegram для каналов и групп — ~20 сообщений в минуту
+LOG_CHANNEL_RATE = float(os.getenv("LOG_CHANNEL_RATE", "20"))
+TG_MESSAGE_LIMIT = 4096
+
+
+def take_log_message(events: list, limit: int = TG_MESSAGE_LIMIT):
+    """
+    Склеивает начало events в одно сообщение не длиннее limit.
+    Возвращает (текст, сколько событий в него вошло).
+    """
+    cur = ""
+    taken = 0
+    for ev in events:
+        ev = ev[:limit]
+        if cur and len(cur) + 2 + len(ev) > limit:
+            break
+        cur = f"{cur}\n\n{ev}" if cur else ev
+        taken += 1
+    return cur, taken
+
+
+class ChannelLogSink:
+    """
+    Логи в админ-канал вне хендлеров: события копятся в ограниченной
+    очереди, фоновый поток раз в LOG_FLUSH_INTERVAL секунд (или по
+    LOG_BATCH_SIZE событий) отправляет их сводными сообщениями.
+    Сводки идут по одной и не чаще LOG_CHANNEL_RATE в минуту: пока
+    предыдущая не доставлена, события ждут здесь, а не в OUTBOX.
+    При переполнении новые события отбрасываются и считаются.
+    """
+
+    def __init__(self):
+        self._events = []
+        self._cond = threading.Condition()
+        self._idle = threading.Event()  # нет сводки в OUTBOX
+        self._idle.set()
+        self._next_at = 0.0
+        self.dropped = 0
+        self._dropped_unreported = 0
+
+    def emit(self, text: str) -> None:
+        with self._cond:
+            if len(self._events) >= LOG_QUEUE_LIMIT:
+                self.dropped += 1
+                self._dropped_unreported += 1
+                return
+            self._events.append(text)
+            if len(self._events) >= LOG_BATCH_SIZE:
+                self._cond.notify()
+
+    def depth(self) -> int:
+        return len(self._events)
+
+    def _take(self) -> str:
+        with self._cond:
+            if self._dropped_unreported:
+                self._events.insert(
+                    0, f"⚠️ Пропущено событий лога: {self._dropped_unreported}"
+                )
+                self._dropped_unreported = 0
+            text, taken = take_log_message(self._events)
+            del self._events[:taken]
+        return text
+
+    def _delivered(self, chat_id, e: Exception = None) -> None:
+        self._idle.set()
+
+    def flush(self) -> bool:
+        """
+        Отправляет одну сводку, если предыдущая уже доставлена и лимит
+        канала позволяет. True — в очереди остались события.
+        """
+        now = time.monotonic()
+        if self._idle.is_set() and now >= self._next_at:
+            text = self._take()
+            if text:
+                self._idle.clear()
+                self._next_at = now + 60 / LOG_CHANNEL_RATE
+                # обычный текст: имена пользователей могут содержать < и &
+                OUTBOX.send(
+                    ADMIN_LOG_CHAT_ID, text, parse_mode="",
+                    on_sent=self._delivered, on_error=self._delivered,
+                )
+        return bool(self._events)
+
+    def run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: len(self._events) >= LOG_BATCH_SIZE,
+                    timeout=LOG_FLUSH_INTERVAL,
+                )
+            try:
+                while self.flush():
+                    self._idle.wait()
+                    time.sleep(max(0.0, self._next_at - time.monotonic()))
+            except Exception:
+                logger.exception("Ошибка отправки логов в канал")
+
+
+LOG_SINK = ChannelLogSink()
+
+
+# ============== АВТО-ОБНОВЛЕНИЕ ==============
+
+# если курсов нет, отложенные рассылки пробуем снова через столько секунд
+AUTO_RETRY_DELAY = 60
+
+
+def is_quiet_hours(now: datetime) -> bool:
+    # не спамим ночью
+    return now.hour < 8 or now.hour >= 23
+
+
+def skip_quiet_hours(due: datetime) -> datetime:
+    """Переносит время, попавшее в тихие часы, на ближайшие 08:00 МСК."""
+    due = due.astimezone(MOSCOW_TZ)
+    if due.hour < 8:
+        return due.replace(hour=8, minute=0, second=0, microsecond=0)
+    if due.hour >= 23:
+        return (due + timedelta(days=1)).replace(
+            hour=8, minute=0, second=0, microsecond=0
+        )
+    return due
+
+
+def next_auto_due(cfg: AutoSub) -> datetime:
+    """Когда отправлять следующее обновление подписчику."""
+    if not cfg.last:
+        return skip_quiet_hours(now_msk())
+    return skip_quiet_hours(_dt(cfg.last + cfg.interval))
+
+
+class AutoScheduler:
+    """
+    Очередь подписчиков по времени следующей отправки (min-heap).
+    Устаревшие записи не удаляются из кучи, а пропускаются при извлечении:
+    актуальное время каждого чата хранится в _due.
+    """
+
+    def __init__(self):
+        self._heap = []  # (ts, chat_id)
+        self._due = {}  # chat_id -> ts
+        self._cond = threading.Condition()
+
+    def schedule(self, chat_id, due: datetime) -> None:
+        ts = due.timestamp()
+        with self._cond:
+            self._due[chat_id] = ts
+            heapq.heappush(self._heap, (ts, chat_id))
+            if len(self._heap) > 2 * len(self._due) + 1024:
+                self._compact()
+            self._cond.notify()
+
+    def schedule_many(self, items) -> None:
+        """Массовая загрузка (chat_id, ts) при старте: O(n) через heapify."""
+        with self._cond:
+            self._due.update(items)
+            self._compact()
+            self._cond.notify()
+
+    def cancel(self, chat_id) -> None:
+        with self._cond:
+            self._due.pop(chat_id, None)
+
+    def due_at(self, chat_id):
+        return self._due.get(chat_id)
+
+    def _compact(self) -> None:
+        self._heap = [(ts, cid) for cid, ts in self._due.items()]
+        heapq.heapify(self._heap)
+
+    def _drop_stale(self) -> None:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def seconds_until_next(self):
+        with self._cond:
+            self._drop_stale()
+            if not self._heap:
+                return None
+            return max(0.0, self._heap[0][0] - time.time())
+
+    def pop_due(self, now_ts: float = None) -> list:
+        now_ts = time.time() if now_ts is None else now_ts
+        due = []
+        with self._cond:
+            while True:
+                self._drop_stale()
+                if not self._heap or self._heap[0][0] > now_ts:
+                    return due
+                _, chat_id = heapq.heappop(self._heap)
+                del self._due[chat_id]
+                due.append(chat_id)
+
+    def wait_due(self) -> list:
+        """Спит ровно до ближайшего срока (или до нового расписания)."""
+        while True:
+            due = self.pop_due()
+            if due:
+                return due
+            with self._cond:
+                self._drop_stale()
+                timeout = self._heap[0][0] - time.time() if self._heap else None
+                self._cond.wait(timeout)
+
+
+AUTO_SCHEDULER = AutoScheduler()
+
+
+def set_auto_user(cid, interval: int, last: datetime) -> None:
+    AUTO_USERS[cid] = AutoSub(interval, int(last.timestamp()) if last else 0)
+    AUTO_SCHEDULER.schedule(cid, next_auto_due(AUTO_USERS[cid]))
+    save_auto_user(cid)
+
+
+def remove_auto_user(cid) -> None:
+    AUTO_USERS.pop(cid, None)
+    AUTO_SCHEDULER.cancel(cid)
+    save_auto_user(cid)
+
+
+def auto_update_log_text(now: datetime, sent: int) -> str:
+    st = OUTBOX.stats
+    return (
+        f"⏱ Автообновление ({sent} из {len(AUTO_USERS)} пользователей) – "
+        f"{now.strftime('%H:%M:%S')}\n"
+        f"📬 Очередь: {OUTBOX.depth()} | отправлено {st['sent']}, "
+        f"повторов {st['retried']}, 429: {st['rate_limited']}, "
+        f"ошибок {st['failed']}"
+    )
+
+
+def deliver_auto_updates(chat_ids: list):
+    """
+    Рассылает текущий снимок подписчикам, у которых подошёл срок,
+    и ставит их на следующий раз. Возвращает текст для лога или None.
+    """
+    if not CLUSTER.is_leader():
+        # рассылает только лидер; став лидером, реплика пересоберёт расписание
+        return None
+
+    now = now_msk()
+    chat_ids = [cid for cid in chat_ids if cid in AUTO_USERS]
+    if not chat_ids:
+        return None
+
+    txt = render_snapshot(get_rate_snapshot())
+    if is_quiet_hours(now) or txt is None:
+        retry = skip_quiet_hours(now + timedelta(seconds=AUTO_RETRY_DELAY))
+        for cid in chat_ids:
+            AUTO_SCHEDULER.schedule(cid, retry)
+        return None
+
+    # пачка уже снята с расписания: один сбойный чат не должен
+    # выбросить остальных
+    sent = 0
+    for cid in chat_ids:
+        cfg = AUTO_USERS.get(cid)
+        if cfg is None:
+            continue  # отписался, пока готовили текст
+        try:
+            cfg.last = int(now.timestamp())
+            OUTBOX.send(cid, txt, on_error=drop_blocked_auto_user)
+            sent += 1
+            AUTO_SCHEDULER.schedule(cid, next_auto_due(cfg))
+            save_auto_user(cid)
+        except Exception:
+            logger.exception(f"Ошибка автообновления для {cid}")
+            if AUTO_SCHEDULER.due_at(cid) is None:
+                retry = now + timedelta(seconds=AUTO_RETRY_DELAY)
+                AUTO_SCHEDULER.schedule(cid, skip_quiet_hours(retry))
+
+    return auto_update_log_text(now, sent) if sent else None
+
+
+def auto_update_loop():
+    while True:
+        try:
+            log_text = deliver_auto_updates(AUTO_SCHEDULER.wait_due())
+            if log_text:
+                log_to_channel(log_text)
+        except Exception:
+            logger.exception("Ошибка автообновления")
+
+
+# ============== ОПОВЕЩЕНИЯ ПО ПОРОГАМ ==============
+
+ALERTS_PER_CHAT = int(os.getenv("ALERTS_PER_CHAT", "20"))
+ALERT_COOLDOWN = float(os.getenv("ALERT_COOLDOWN", "600"))
+
+
+def _abcex_side(snap: RateSnapshot, i: int):
+    pair = snap.value("abcex")
+    return pair[i] if pair else None
+
+
+def _abcex_spread(snap: RateSnapshot):
+    buy, sell = (snap.value("abcex") or (None, None))[:2]
+    return sell - buy if buy and sell else None
+
+
+# метрика -> (подпись, единица, знаков после запятой, значение из снимка)
+ALERT_METRICS = {
+    "upbit": ("UPBIT USDT", "₩", 0, lambda s: s.value("upbit")),
+    "bithumb": ("BITHUMB USDT", "₩", 0, lambda s: s.value("bithumb")),
+    "abcex_buy": ("ABCEX покупка", "₽", 2, lambda s: _abcex_side(s, 0)),
+    "abcex_sell": ("ABCEX продажа", "₽", 2, lambda s: _abcex_side(s, 1)),
+    "spread": ("Спред ABCEX", "₽", 2, _abcex_spread),
+    "rub": ("1 000 000 ₩", "₽", 2, lambda s: s.value("rub")),
+}
+ALERT_ALIASES = {
+    "upbit": "upbit", "апбит": "upbit",
+    "bithumb": "bithumb", "битхамб": "bithumb",
+    "buy": "abcex_buy", "покупка": "abcex_buy",
+    "sell": "abcex_sell", "продажа": "abcex_sell",
+    "spread": "spread", "спред": "spread",
+    "rub": "rub", "krw": "rub", "рубль": "rub",
+}
+ALERT_RE = re.compile(r"^/alert(?:@\w+)?\s+(\S+?)\s*([<>])\s*([\d\s.,]+)$")
+
+
+class AlertBook:
+    """
+    Оповещения «метрика > порог» / «метрика < порог». На каждую пару
+    (метрика, знак) — отсортированный список порогов, так что при новом
+    снимке бинарным поиском находятся только пересечённые пороги.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.alerts = {}  # id -> (chat_id, метрика, знак, порог)
+        self._index = {}  # (метрика, знак) -> ([пороги], [id])
+        self._by_chat = defaultdict(set)
+        self._fired = {}  # id -> время последнего срабатывания
+
+    def __len__(self) -> int:
+        return len(self.alerts)
+
+    @staticmethod
+    def make_id(cid, metric: str, op: str, threshold: float) -> str:
+        # repr, а не :g — иначе 58123.45 и 58123.4 дают один id
+        return f"{cid}:{metric}:{op}:{float(threshold)!r}"
+
+    def restore(self, aid: str, alert: dict) -> None:
+        with self._lock:
+            self._add(aid, (
+                int(alert["chat_id"]), alert["metric"], alert["op"],
+                float(alert["threshold"]),
+            ))
+
+    def restore_many(self, items) -> None:
+        """Загрузка при старте: сначала всё в списки, потом одна сортировка."""
+        with self._lock:
+            for aid, alert in items:
+                if aid in self.alerts:
+                    continue
+                alert = (
+                    int(alert["chat_id"]), alert["metric"], alert["op"],
+                    float(alert["threshold"]),
+                )
+                keys, ids = self._index.setdefault(alert[1:3], ([], []))
+                keys.append(alert[3])
+                ids.append(aid)
+                self.alerts[aid] = alert
+                self._by_chat[alert[0]].add(aid)
+            for key, (keys, ids) in self._index.items():
+                order = sorted(range(len(keys)), key=keys.__getitem__)
+                self._index[key] = (
+                    [keys[i] for i in order], [ids[i] for i in order]
+                )
+
+    def _add(self, aid: str, alert: tuple) -> None:
+        if aid in self.alerts:
+            return
+        cid, metric, op, threshold = alert
+        keys, ids = self._index.setdefault((metric, op), ([], []))
+        i = bisect.bisect_right(keys, threshold)
+        keys.insert(i, threshold)
+        ids.insert(i, aid)
+        self.alerts[aid] = alert
+        self._by_chat[cid].add(aid)
+
+    def add(self, cid, metric: str, op: str, threshold: float):
+        """Новое оповещение: id или None, если у чата их слишком много."""
+        aid = self.make_id(cid, metric, op, threshold)
+        with self._lock:
+            if aid not in self.alerts and len(
+                self._by_chat.get(cid, ())
+            ) >= ALERTS_PER_CHAT:
+                return None
+            self._add(aid, (cid, metric, op, threshold))
+        return aid
+
+    def discard(self, aid: str) -> None:
+        with self._lock:
+            alert = self.alerts.pop(aid, None)
+            if alert is None:
+                return
+            cid, metric, op, threshold = alert
+            keys, ids = self._index[(metric, op)]
+            i = bisect.bisect_left(keys, threshold)
+            while ids[i] != aid:
+                i += 1
+            del keys[i], ids[i]
+            self._by_chat[cid].discard(aid)
+            if not self._by_chat[cid]:
+                del self._by_chat[cid]
+            self._fired.pop(aid, None)
+
+    def get(self, aid: str):
+        return self.alerts.get(aid)
+
+    def for_chat(self, cid) -> list:
+        with self._lock:
+            return sorted(self._by_chat.get(cid, ()))
+
+    def crossed(self, metric: str, prev, cur, now: float) -> list:
+        """Оповещения, чей порог лежит между прошлым и новым значением."""
+        if prev is None or cur is None or prev == cur:
+            return []
+        out = []
+        with self._lock:
+            if cur > prev:
+                # «>» срабатывает при prev <= порог < cur
+                keys, ids = self._index.get((metric, ">"), ((), ()))
+                lo = bisect.bisect_left(keys, prev)
+                hi = bisect.bisect_left(keys, cur)
+            else:
+                # «<» срабатывает при cur < порог <= prev
+                keys, ids = self._index.get((metric, "<"), ((), ()))
+                lo = bisect.bisect_right(keys, cur)
+                hi = bisect.bisect_right(keys, prev)
+            for aid in ids[lo:hi]:
+                if now - self._fired.get(aid, 0) >= ALERT_COOLDOWN:
+                    self._fired[aid] = now
+                    out.append(aid)
+        return out
+
+
+ALERTS = AlertBook()
+
+
+def add_alert(cid, metric: str, op: str, threshold: float):
+    aid = ALERTS.add(cid, metric, op, threshold)
+    if aid is not None:
+        STORE.put(KIND_ALERT, aid, {
+            "chat_id": cid, "metric": metric, "op": op,
+            "threshold": threshold,
+        })
+    return aid
+
+
+def remove_alert(aid: str) -> None:
+    ALERTS.discard(aid)
+    STORE.delete(KIND_ALERT, aid)
+
+
+def alert_label(alert: tuple) -> str:
+    _, metric, op, threshold = alert
+    label, unit, digits, _ = ALERT_METRICS[metric]
+    return f"{label} {op} {fmt_num(threshold, digits)} {unit}"
+
+
+def deliver_alerts(old: RateSnapshot, new: RateSnapshot) -> int:
+    """
+    Сравнивает два соседних снимка и ставит в OUTBOX сообщения
+    по пересечённым порогам. Возвращает число сообщений.
+    """
+    if not len(ALERTS):
+        return 0
+    now = time.time()
+    sent = 0
+    for metric, (_, unit, digits, value) in ALERT_METRICS.items():
+        cur = value(new)
+        for aid in ALERTS.crossed(metric, value(old), cur, now):
+            alert = ALERTS.get(aid)
+            if alert is None:
+                continue
+            OUTBOX.send(
+                alert[0],
+                f"🚨 <b>{alert_label(alert)}</b>\n"
+                f"Сейчас: <b>{fmt_num(cur, digits)} {unit}</b>",
+                on_error=drop_blocked_auto_user,
+            )
+            sent += 1
+    if sent:
+        log_to_channel(f"🚨 Оповещения по порогам: {sent} сообщений")
+    return sent
+
+
+ALERT_USAGE = (
+    "Использование: <code>/alert upbit > 1450</code>\n"
+    "Метрики: upbit, bithumb, buy, sell, spread, rub.\n"
+    "Список и удаление: /alerts"
+)
+
+
+def parse_alert(text: str):
+    """'/alert upbit > 1 450' -> ('upbit', '>', 1450.0) или None."""
+    match = ALERT_RE.match((text or "").strip())
+    if not match:
+        return None
+    metric = ALERT_ALIASES.get(match.group(1).lower())
+    try:
+        threshold = float(re.sub(r"\s", "", match.group(3)).replace(",", "."))
+    except ValueError:
+        return None
+    if metric is None:
+        return None
+    return metric, match.group(2), threshold
+
+
+def alerts_menu(cid):
+    ids = ALERTS.for_chat(cid)
+    if not ids:
+        return "У вас нет оповещений.\n\n" + ALERT_USAGE, None
+    kb = types.InlineKeyboardMarkup()
+    lines = ["🚨 <b>Ваши оповещения</b>\n"]
+    for aid in ids:
+        alert = ALERTS.get(aid)
+        if alert is None:
+            continue
+        lines.append(f"◾ {alert_label(alert)}")
+        kb.add(types.InlineKeyboardButton(
+            f"❌ {alert_label(alert)}", callback_data=f"alertdel:{aid}"
+        ))
+    return "\n".join(lines), kb
+
+
+# ============== КЛАВИАТУРА ==============
+
+def main_keyboard():
+    m = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    m.row(BTN_SHOW, BTN_ARB)
+    m.row(BTN_AUTO, BTN_PROFILE)
+    m.row(BTN_DISABLE)
+    return m
+
+
+# поднять при изменении кнопок — клавиатуру заново получат все чаты
+KEYBOARD_VERSION = 3
+# собирается один раз: в запросы уходит готовая JSON-строка
+MAIN_KEYBOARD_JSON = main_keyboard().to_json()
+KEYBOARD_CHATS = set()  # чаты, у которых уже текущая версия клавиатуры
+
+START_TEXT = "👋 Привет!\n\nВыбери нужный раздел ниже 👇"
+RATE_ERROR_TEXT = "⚠️ Не удалось получить курс.\nПопробуйте позже."
+KEYBOARD_UPDATED_TEXT = "🔄 Меню обновлено:"
+
+
+def mark_keyboard(cid) -> None:
+    if cid not in KEYBOARD_CHATS:
+        KEYBOARD_CHATS.add(cid)
+        STORE.put(KIND_KEYBOARD, cid, KEYBOARD_VERSION)
+
+
+def forget_keyboard(cid) -> None:
+    if cid in KEYBOARD_CHATS:
+        KEYBOARD_CHATS.discard(cid)
+        STORE.delete(KIND_KEYBOARD, cid)
+
+
+def reply_keyboard(cid):
+    """
+    Клавиатура для ответа, если у чата её ещё нет, иначе None.
+    Так новая клавиатура едет вместе с обычным ответом, без отдельного
+    сообщения.
+    """
+    if cid in KEYBOARD_CHATS:
+        return None
+    mark_keyboard(cid)
+    return MAIN_KEYBOARD_JSON
+
+
+def ensure_keyboard(m):
+    """Отдельное сообщение с клавиатурой — только если её у чата нет."""
+    if m.chat.id in KEYBOARD_CHATS:
+        return
+    try:
+        bot.send_message(
+            m.chat.id, KEYBOARD_UPDATED_TEXT, reply_markup=MAIN_KEYBOARD_JSON
+        )
+        mark_keyboard(m.chat.id)
+    except Exception:
+        pass
+
+
+# ============== МАРШРУТИЗАЦИЯ ==============
+
+# префикс callback_data до первого «_» или «:» включительно
+CALLBACK_PREFIX_RE = re.compile(r"[^_:]*[_:]")
+
+
+def message_route(m, text_routes: dict, command_routes: dict, fallback):
+    """Хендлер для сообщения: команда или точный текст кнопки."""
+    text = m.text or ""
+    if text.startswith("/"):
+        command = text.split(maxsplit=1)[0][1:].split("@", 1)[0]
+        return command_routes.get(command, fallback)
+    return text_routes.get(text, fallback)
+
+
+def callback_route(c, routes: dict):
+    match = CALLBACK_PREFIX_RE.match(c.data or "")
+    return routes.get(match.group()) if match else None
+
+
+def auto_menu(cid):
+    """Текст и инлайн-клавиатура настроек автообновления."""
+    kb = types.InlineKeyboardMarkup()
+    kb.row(
+        types.InlineKeyboardButton("⏱ Каждый 1 час", callback_data="auto_1h"),
+        types.InlineKeyboardButton("⏱ Каждые 5 часов", callback_data="auto_5h"),
+    )
+    kb.row(
+        types.InlineKeyboardButton(
+            "🕛 Раз в 24 часа (с 08:00 МСК)",
+            callback_data="auto_24h"
+        ),
+    )
+    if cid in AUTO_USERS:
+        kb.row(
+            types.InlineKeyboardButton(
+                "🔕 Выключить автообновление",
+                callback_data="auto_off"
+            )
+        )
+
+    text = "Выбери частоту автообновления курса:"
+    if cid in AUTO_USERS:
+        cur_int = AUTO_USERS[cid].interval
+        text += f"\nСейчас: {human_interval(cur_int)}."
+    return text, kb
+
+
+def auto_choice(data: str, now: datetime):
+    """callback_data -> (интервал, подпись, время «последней» отправки)."""
+    if data == "auto_1h":
+        return AUTO_INTERVAL_1H, "каждый 1 час", now
+    if data == "auto_5h":
+        return AUTO_INTERVAL_5H, "каждые 5 часов", now
+
+    interval = AUTO_INTERVAL_24H
+    next_run = now.replace(hour=8, minute=0, second=0, microsecond=0)
+    if now.hour >= 8:
+        next_run += timedelta(days=1)
+    return interval, "каждые 24 часа", next_run - timedelta(seconds=interval)
+
+
+def profile_text(user) -> str:
+    s = USER_STATS.get(user.id) or UserStats()
+    last = _dt(s.last).strftime("%d.%m.%Y %H:%M:%S") if s.last else "—"
+
+    nick = pretty_name(user)
+
+    return (
+        f"👤 <b>Профиль</b>\n\n"
+        f"Имя: {nick}\n"
+        f"ID: <code>{user.id}</code>\n\n"
+        f"Запросов курса: {s.requests}\n"
+        f"Последний запрос: {last} (МСК)"
+    )
+
+
+def rate_log_text(user, snap: RateSnapshot) -> str:
+    return (
+        f"📊 Курс {pretty_name(user)} (ID {user.id})\n"
+        f"🕒 {now_msk().strftime('%H:%M:%S')} МСК\n"
+        f"{render_snapshot(snap, 'log')}"
+    )
+
+
+# ============== АНИМАЦИЯ ЗАГРУЗКИ ==============
+
+LOADING_TEXT = "⏳ Загрузка курса, ожидайте..."
+PROGRESS_INTERVAL = 0.6
+
+
+def loading_frame(i: int) -> str:
+    dots = [".", "..", "..."]
+    return f"⏳ Загрузка курса{dots[i % 3]}..."
+
+
+class ProgressTicker:
+    """
+    Один поток на все сообщения «⏳ Загрузка курса»: раз в
+    PROGRESS_INTERVAL секунд перерисовывает каждое из них. После
+    remove() сообщение гарантированно больше не редактируется, так что
+    итоговый текст можно ставить сразу, без паузы.
+    """
+
+    def __init__(self):
+        self._frames = {}  # (chat_id, message_id) -> номер кадра
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def add(self, chat_id, message_id) -> None:
+        with self._lock:
+            self._frames[(chat_id, message_id)] = 1
+        self._wake.set()
+
+    def remove(self, chat_id, message_id) -> None:
+        with self._lock:
+            self._frames.pop((chat_id, message_id), None)
+
+    def run(self) -> None:
+        while True:
+            if not self._frames:
+                self._wake.wait()
+                self._wake.clear()
+            time.sleep(PROGRESS_INTERVAL)
+            for key in list(self._frames):
+                # правка идёт под замком, чтобы не обогнать итоговый текст
+                with self._lock:
+                    frame = self._frames.get(key)
+                    if frame is None:
+                        continue
+                    self._frames[key] = frame + 1
+                    try:
+                        bot.edit_message_text(loading_frame(frame), *key)
+                    except Exception:
+                        self._frames.pop(key, None)
+
+
+PROGRESS = ProgressTicker()
+
+
+# ============== ИНЛАЙН-РЕЖИМ ==============
+
+# «@бот», «@бот arb», «@бот 1000000 krw rub» в любом чате
+# (в @BotFather нужно включить /setinline)
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "10"))
+INLINE_CACHE_SIZE = 256
+INLINE_ARB_WORDS = {"arb", "арбитраж"}
+
+_INLINE_RESULTS = {}  # (версия снимка, курсы, запрос) -> результаты
+
+
+def _inline_article(rid: str, title: str, text: str, description: str = ""):
+    return types.InlineQueryResultArticle(
+        rid, title,
+        types.InputTextMessageContent(text, parse_mode="HTML"),
+        description=description,
+    )
+
+
+def inline_results(query: str, snap: RateSnapshot) -> list:
+    """
+    Ответ на инлайн-запрос только из снимка, без обращений к биржам.
+    Собирается один раз на версию снимка и запрос. Пустой список —
+    курсов ещё нет.
+    """
+    query = " ".join((query or "").lower().split())
+    rates = snap.rates()
+    key = (snap.version, rates, query)
+    results = _INLINE_RESULTS.get(key)
+    METRICS.inc(
+        "inline_cache_requests_total",
+        result="miss" if results is None else "hit",
+    )
+    if results is not None:
+        return results
+
+    text = render_snapshot(snap)
+    if text is None:
+        return []
+    rates_item = _inline_article(
+        "rates", "📊 Актуальные курсы", text, render_snapshot(snap, "log")
+    )
+    arb_item = _inline_article(
+        "arb", "💹 Арбитраж", arbitrage_text(snap),
+        "Премия к рублёвому маршруту",
+    )
+    parsed = parse_convert_args(f"/convert {query}")
+    if parsed is not None:
+        amount, src, dst = parsed
+        results = [_inline_article(
+            "convert",
+            f"💱 {fmt_num(amount, CURRENCY_DIGITS[src])} {src} → {dst}",
+            convert_text(f"/convert {query}", snap),
+            "Лучший маршрут с учётом комиссий",
+        ), rates_item]
+    elif query in INLINE_ARB_WORDS:
+        results = [arb_item, rates_item]
+    else:
+        results = [rates_item, arb_item]
+
+    if len(_INLINE_RESULTS) > INLINE_CACHE_SIZE:
+        _INLINE_RESULTS.clear()
+    _INLINE_RESULTS[key] = results
+    return results
+
+
+# ============== ХЕНдлеры ==============
+
+def start_handler(m):
+    remember_user(m.from_user)
+    bot.send_message(m.chat.id, START_TEXT, reply_markup=MAIN_KEYBOARD_JSON)
+    mark_keyboard(m.chat.id)
+    log_user_action(m.from_user, "нажал /start")
+
+
+def disable_notifications(m):
+    remember_user(m.from_user)
+    cid = m.chat.id
+    if cid in AUTO_USERS:
+        remove_auto_user(cid)
+        bot.send_message(
+            cid, "🔕 Уведомления отключены.", reply_markup=reply_keyboard(cid)
+        )
+        log_user_action(m.from_user, "отключил уведомления")
+    else:
+        bot.send_message(
+            cid, "Уведомления уже выключены.", reply_markup=reply_keyboard(cid)
+        )
+
+
+def show_rate(m):
+    remember_user(m.from_user)
+    log_user_action(m.from_user, "нажал «Показать курс»")
+    cid = m.chat.id
+
+    msg = None
+    if not _SNAPSHOT_READY.is_set():
+        # холодный старт: анимация, пока не придёт первый снимок
+        msg = bot.send_message(
+            cid, LOADING_TEXT, reply_markup=reply_keyboard(cid)
+        )
+        PROGRESS.add(cid, msg.message_id)
+        wait_rate_snapshot()
+        PROGRESS.remove(cid, msg.message_id)
+
+    snap = get_rate_snapshot()
+    txt = render_snapshot(snap)
+
+    if msg is None:
+        bot.send_message(
+            cid, txt or RATE_ERROR_TEXT, reply_markup=reply_keyboard(cid)
+        )
+    else:
+        bot.edit_message_text(txt or RATE_ERROR_TEXT, cid, msg.message_id)
+    if txt is None:
+        return
+
+    update_user_stats(m.from_user)
+
+    try:
+        log_to_channel(rate_log_text(m.from_user, snap))
+    except Exception:
+        pass
+
+
+def toggle_auto(m):
+    remember_user(m.from_user)
+    ensure_keyboard(m)
+    text, kb = auto_menu(m.chat.id)
+    bot.send_message(m.chat.id, text, reply_markup=kb)
+    log_user_action(m.from_user, "открыл настройки автообновления")
+
+
+def auto_callback(c):
+    cid = c.message.chat.id
+
+    if c.data == "auto_off":
+        remove_auto_user(cid)
+        bot.answer_callback_query(c.id, "Автообновление выключено")
+        bot.send_message(cid, "🔕 Автообновление выключено.")
+        log_user_action(c.from_user, "выключил автообновление")
+        return
+
+    interval, label, last = auto_choice(c.data, now_msk())
+    set_auto_user(cid, interval, last)
+    bot.answer_callback_query(c.id, "Настройки сохранены")
+    bot.send_message(cid, f"🔔 Автообновление включено: {label}.")
+    log_user_action(c.from_user, f"включил автообновление ({label})")
+
+
+def profile(m):
+    remember_user(m.from_user)
+    bot.send_message(
+        m.chat.id, profile_text(m.from_user),
+        reply_markup=reply_keyboard(m.chat.id),
+    )
+    log_user_action(m.from_user, "открыл профиль")
+
+
+def change_handler(m):
+    remember_user(m.from_user)
+    bot.send_message(m.chat.id, history_change_text())
+    log_user_action(m.from_user, "запросил /change")
+
+
+def arbitrage(m):
+    remember_user(m.from_user)
+    bot.send_message(
+        m.chat.id, arbitrage_text(wait_rate_snapshot()),
+        reply_markup=reply_keyboard(m.chat.id),
+    )
+    log_user_action(m.from_user, "открыл «Арбитраж»")
+
+
+def convert_handler(m):
+    remember_user(m.from_user)
+    bot.send_message(m.chat.id, convert_text(m.text, wait_rate_snapshot()))
+    log_user_action(m.from_user, f"запросил {m.text}")
+
+
+def alert_handler(m):
+    remember_user(m.from_user)
+    cid = m.chat.id
+    parsed = parse_alert(m.text)
+    if parsed is None:
+        bot.send_message(cid, ALERT_USAGE)
+        return
+    metric, op, threshold = parsed
+    aid = add_alert(cid, metric, op, threshold)
+    if aid is None:
+        bot.send_message(cid, f"Не больше {ALERTS_PER_CHAT} оповещений на чат.")
+        return
+    label = alert_label(ALERTS.get(aid))
+    bot.send_message(cid, f"🚨 Оповещение добавлено: {label}.")
+    log_user_action(m.from_user, f"добавил оповещение ({label})")
+
+
+def alerts_handler(m):
+    remember_user(m.from_user)
+    text, kb = alerts_menu(m.chat.id)
+    bot.send_message(m.chat.id, text, reply_markup=kb)
+
+
+def alert_delete_callback(c):
+    aid = c.data.split(":", 1)[1]
+    alert = ALERTS.get(aid)
+    if alert is None or alert[0] != c.message.chat.id:
+        bot.answer_callback_query(c.id, "Оповещение уже удалено")
+        return
+    remove_alert(aid)
+    bot.answer_callback_query(c.id, "Оповещение удалено")
+    text, kb = alerts_menu(c.message.chat.id)
+    bot.edit_message_text(
+        text, c.message.chat.id, c.message.message_id, reply_markup=kb
+    )
+    log_user_action(c.from_user, f"удалил оповещение ({alert_label(alert)})")
+
+
+def update_keyboard_global(m):
+    """
+    Любое другое сообщение — просто обновляем клавиатуру,
+    чтобы старые пользователи получили новые кнопки.
+    """
+    remember_user(m.from_user)
+    ensure_keyboard(m)
+
+
+TEXT_ROUTES = {
+    BTN_SHOW: show_rate,
+    BTN_AUTO: toggle_auto,
+    BTN_PROFILE: profile,
+    BTN_DISABLE: disable_notifications,
+    BTN_ARB: arbitrage,
+}
+COMMAND_ROUTES = {
+    "start": start_handler,
+    "help": start_handler,
+    "change": change_handler,
+    "convert": convert_handler,
+    "alert": alert_handler,
+    "alerts": alerts_handler,
+}
+CALLBACK_ROUTES = {
+    "auto_": auto_callback,
+    "alertdel:": alert_delete_callback,
+}
+
+
+@bot.message_handler()
+def dispatch_message(m):
+    """
+    Один хендлер на все сообщения: поиск по словарю вместо перебора
+    фильтров. Время считается по конечному хендлеру.
+    """
+    fn = message_route(m, TEXT_ROUTES, COMMAND_ROUTES, update_keyboard_global)
+    with METRICS.timer("handler", handler=fn.__name__):
+        fn(m)
+
+
+@bot.callback_query_handler(func=lambda c: True)
+def dispatch_callback(c):
+    fn = callback_route(c, CALLBACK_ROUTES)
+    if fn is None:
+        return
+    with METRICS.timer("handler", handler=fn.__name__):
+        fn(c)
+
+
+dispatch_message._instrumented = True
+dispatch_callback._instrumented = True
+
+
+@bot.inline_handler(func=lambda q: True)
+def inline_query(q):
+    results = inline_results(q.query, get_rate_snapshot())
+    # пустой ответ не кэшируем: курсы вот-вот появятся
+    bot.answer_inline_query(
+        q.id, results, cache_time=INLINE_CACHE_TIME if results else 0
+    )
+
+
+# ============== АНТИ-СОН ДЛЯ RENDER ==============
+
+def keep_awake():
+    url = "https://telegram-rate-bot-ooc6.onrender.com"
+    while True:
+        try:
+            http_get(url)
+            print(f"[keep_alive] Pinged {url}")
+        except Exception as e:
+            print(f"[keep_alive] Ошибка пинга: {e}")
+        time.sleep(600)
+
+
+# ============== FAKE WEB SERVER ДЛЯ RENDER ==============
+
+def home():
+    return "Bot is running OK", 200
+
+
+class UpdateWorkers:
+    """
+    Пул обработки вебхуков: Flask-роут только кладёт тело запроса
+    в ограниченную очередь и сразу отвечает, разбор и хендлеры — здесь.
+    """
+
+    def __init__(self, workers: int, limit: int):
+        self._queue = queue.Queue(maxsize=limit)
+        self._workers = workers
+
+    def start(self) -> None:
+        for i in range(self._workers):
+            threading.Thread(
+                target=self._worker, name=f"webhook-{i}", daemon=True
+            ).start()
+
+    def submit(self, body: str) -> bool:
+        try:
+            self._queue.put_nowait(body)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _worker(self) -> None:
+        while True:
+            body = self._queue.get()
             try:
-                bot.send_message(
-                    uid,
-                    "🔄 Меню обновлено:",
-                    reply_markup=main_keyboard()
-                )
+                bot.process_new_updates([types.Update.de_json(body)])
             except Exception:
+                logger.exception("Ошибка обработки обновления")
+
+
+WEBHOOK_UPDATES = UpdateWorkers(WEBHOOK_WORKERS, WEBHOOK_QUEUE_LIMIT)
+
+
+def telegram_webhook():
+    from flask import request
+
+    if UPDATE_MODE != "webhook":
+        return "not found", 404
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return "forbidden", 403
+    if not WEBHOOK_UPDATES.submit(request.get_data(as_text=True)):
+        # Telegram повторит доставку позже
+        METRICS.inc("webhook_rejected_total")
+        return "busy", 503
+    return "", 200
+
+
+def metrics():
+    from flask import request
+
+    if METRICS_TOKEN:
+        token = request.args.get("token") or request.headers.get(
+            "Authorization", ""
+        ).removeprefix("Bearer ")
+        if not hmac.compare_digest(token, METRICS_TOKEN):
+            return "forbidden", 403
+    return METRICS.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@METRICS.collector
+def _queue_metrics():
+    now = time.time()
+    snap = get_rate_snapshot()
+    samples = [
+        ("outbox_depth", "gauge", {}, OUTBOX.depth()),
+        ("log_sink_depth", "gauge", {}, LOG_SINK.depth()),
+        ("log_sink_dropped_total", "counter", {}, LOG_SINK.dropped),
+        ("webhook_queue_depth", "gauge", {}, WEBHOOK_UPDATES.depth()),
+        ("auto_users", "gauge", {}, len(AUTO_USERS)),
+        ("alerts", "gauge", {}, len(ALERTS)),
+        ("snapshot_version", "gauge", {}, snap.version),
+    ]
+    for key, n in list(OUTBOX.stats.items()):
+        samples.append(("outbox_messages_total", "counter", {"result": key}, n))
+    for name, ts in snap.fetched.items():
+        samples.append(("rate_age_seconds", "gauge", {"source": name}, now - ts))
+    return samples
+
+
+def create_app():
+    """
+    Flask импортируется только здесь: это самый тяжёлый импорт модуля,
+    а нужен он лишь веб-потоку, не приёму обновлений.
+    """
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.add_url_rule("/", view_func=home)
+    app.add_url_rule(WEBHOOK_PATH, view_func=telegram_webhook, methods=["POST"])
+    app.add_url_rule("/metrics", view_func=metrics)
+    return app
+
+
+def run_web():
+    port = int(os.environ.get("PORT", 10000))
+    print(f"[web] Using PORT={port}")
+    create_app().run(host="0.0.0.0", port=port, threaded=True)
+
+
+# ============== ASYNC-РЕЖИМ ==============
+
+async def _async_get(session, url: str, params=None, as_json: bool = True):
+    async with session.get(url, params=params) as r:
+        r.raise_for_status()
+        if as_json:
+            return await r.json(content_type=None)
+        return await r.text()
+
+
+async def async_fetch_upbit(session):
+    with upstream("upbit"):
+        data = await _async_get(
+            session, f"{UPBIT_API}/v1/ticker", params={"markets": "KRW-USDT"}
+        )
+        return _parse_upbit(data)
+
+
+async def async_fetch_bithumb(session):
+    with upstream("bithumb"):
+        data = await _async_get(
+            session, f"{BITHUMB_API}/public/ticker/USDT_KRW"
+        )
+        return _parse_bithumb(data)
+
+
+async def _async_fetch_google_rub(session):
+    with upstream("google"):
+        scanner = GoogleRateScanner()
+        async with session.get(
+            f"{GOOGLE_FINANCE_API}/finance/quote/RUB-KRW", params={"hl": "en"}
+        ) as r:
+            r.raise_for_status()
+            async for chunk in r.content.iter_chunked(16384):
+                if scanner.feed(chunk):
+                    break
+        if scanner.value is None:
+            # полный разбор HTML тяжёлый — уводим его с event loop
+            million_rub = await asyncio.to_thread(scanner.result)
+        else:
+            million_rub = scanner.result()
+        if not million_rub:
+            raise ValueError("курс не найден на странице")
+        return million_rub
+
+
+async def _async_fetch_er_api_rub(session):
+    with upstream("er_api"):
+        data = await _async_get(session, f"{ER_API}/v6/latest/RUB")
+        return _parse_er_api(data)
+
+
+async def async_fetch_krw_rub(session):
+    return await async_hedged(
+        lambda: _async_fetch_google_rub(session),
+        lambda: _async_fetch_er_api_rub(session),
+    )
+
+
+async def async_fetch_abcex(session):
+    with upstream("abcex"):
+        data = await _async_get(
+            session,
+            f"{ABCEX_API}/api/v2/exchange/public/orderbook/depth",
+            params={"instrumentCode": "USDTRUB", "lang": "ru"},
+        )
+        return _parse_abcex(data)
+
+
+ASYNC_FETCHERS = {
+    "upbit": async_fetch_upbit,
+    "bithumb": async_fetch_bithumb,
+    "rub": async_fetch_krw_rub,
+    "abcex": async_fetch_abcex,
+}
+
+
+async def async_rate_refresh_loop(session, ready: asyncio.Event):
+    """То же, что rate_refresh_loop, но корутинами на общем event loop."""
+    next_due = {name: 0.0 for name in RATE_SOURCES}
+    while True:
+        now = time.time()
+        due = []
+        for name, t in next_due.items():
+            if t > now:
+                continue
+            if stream_is_fresh(name):
+                next_due[name] = now + RATE_SOURCES[name][1]
+            else:
+                due.append(name)
+        results = await asyncio.gather(
+            *(
+                asyncio.wait_for(ASYNC_FETCHERS[name](session), FETCH_BUDGET)
+                for name in due
+            ),
+            return_exceptions=True,
+        )
+        updates = {}
+        for name, v in zip(due, results):
+            # кэш TTL в async-режиме заменяет период обновления
+            period = max(RATE_SOURCES[name][1], CACHE_POLICY[name][0])
+            next_due[name] = time.time() + period
+            if isinstance(v, Exception):
+                logger.warning(f"{name} error: {v!r}")
+                continue
+            if _valid_rate(v):
+                updates[name] = (v, time.time())
+
+        if updates:
+            _publish_snapshot(updates)
+        ready.set()
+
+        await asyncio.sleep(max(0.05, min(next_due.values()) - time.time()))
+
+
+async def async_auto_update_loop():
+    while True:
+        delay = AUTO_SCHEDULER.seconds_until_next()
+        # новые подписки не будят корутину, поэтому спим не дольше минуты
+        await asyncio.sleep(60 if delay is None else min(delay, 60))
+        try:
+            # отправка — через ту же очередь с лимитами, что и в потоковом режиме
+            log_text = deliver_auto_updates(AUTO_SCHEDULER.pop_due())
+            if log_text:
+                log_to_channel(log_text)
+        except Exception:
+            logger.exception("Ошибка автообновления")
+
+
+async def async_keep_awake(session):
+    url = "https://telegram-rate-bot-ooc6.onrender.com"
+    while True:
+        try:
+            async with session.get(url):
                 pass
+            print(f"[keep_alive] Pinged {url}")
+        except Exception as e:
+            print(f"[keep_alive] Ошибка пинга: {e}")
+        await asyncio.sleep(600)
 
-    broadcast_new_keyboard()
+
+def build_async_bot(ready: asyncio.Event):
+    """
+    AsyncTeleBot с теми же хендлерами, что и у потокового бота.
+    Импорт ленивый: aiohttp нужен только в этом режиме.
+    """
+    from telebot.async_telebot import AsyncTeleBot
+
+    abot = AsyncTeleBot(TELEGRAM_TOKEN, parse_mode="HTML")
+
+    async def aensure_keyboard(m) -> None:
+        if m.chat.id in KEYBOARD_CHATS:
+            return
+        try:
+            await abot.send_message(
+                m.chat.id, KEYBOARD_UPDATED_TEXT,
+                reply_markup=MAIN_KEYBOARD_JSON,
+            )
+            mark_keyboard(m.chat.id)
+        except Exception:
+            pass
+
+    async def start_handler(m):
+        remember_user(m.from_user)
+        await abot.send_message(
+            m.chat.id, START_TEXT, reply_markup=MAIN_KEYBOARD_JSON
+        )
+        mark_keyboard(m.chat.id)
+        log_user_action(m.from_user, "нажал /start")
+
+    async def disable_notifications(m):
+        remember_user(m.from_user)
+        cid = m.chat.id
+        if cid in AUTO_USERS:
+            remove_auto_user(cid)
+            await abot.send_message(
+                cid, "🔕 Уведомления отключены.",
+                reply_markup=reply_keyboard(cid),
+            )
+            log_user_action(m.from_user, "отключил уведомления")
+        else:
+            await abot.send_message(
+                cid, "Уведомления уже выключены.",
+                reply_markup=reply_keyboard(cid),
+            )
+
+    async def show_rate(m):
+        remember_user(m.from_user)
+        log_user_action(m.from_user, "нажал «Показать курс»")
+        cid = m.chat.id
+
+        msg = task = None
+        if not ready.is_set():
+            # холодный старт: анимация, пока не придёт первый снимок
+            msg = await abot.send_message(
+                cid, LOADING_TEXT, reply_markup=reply_keyboard(cid)
+            )
+
+            async def anim():
+                i = 1
+                while True:
+                    await asyncio.sleep(PROGRESS_INTERVAL)
+                    try:
+                        await abot.edit_message_text(
+                            loading_frame(i), cid, msg.message_id
+                        )
+                    except Exception:
+                        return
+                    i += 1
+
+            task = asyncio.create_task(anim())
+            try:
+                await asyncio.wait_for(ready.wait(), SNAPSHOT_COLD_WAIT)
+            except asyncio.TimeoutError:
+                pass
+            task.cancel()
+
+        snap = get_rate_snapshot()
+        txt = render_snapshot(snap)
+        if msg is None:
+            await abot.send_message(
+                cid, txt or RATE_ERROR_TEXT, reply_markup=reply_keyboard(cid)
+            )
+        else:
+            await abot.edit_message_text(
+                txt or RATE_ERROR_TEXT, cid, msg.message_id
+            )
+        if txt is None:
+            return
+
+        update_user_stats(m.from_user)
+        log_to_channel(rate_log_text(m.from_user, snap))
+
+    async def toggle_auto(m):
+        remember_user(m.from_user)
+        await aensure_keyboard(m)
+        text, kb = auto_menu(m.chat.id)
+        await abot.send_message(m.chat.id, text, reply_markup=kb)
+        log_user_action(m.from_user, "открыл настройки автообновления")
+
+    async def auto_callback(c):
+        cid = c.message.chat.id
+
+        if c.data == "auto_off":
+            remove_auto_user(cid)
+            await abot.answer_callback_query(c.id, "Автообновление выключено")
+            await abot.send_message(cid, "🔕 Автообновление выключено.")
+            log_user_action(c.from_user, "выключил автообновление")
+            return
+
+        interval, label, last = auto_choice(c.data, now_msk())
+        set_auto_user(cid, interval, last)
+        await abot.answer_callback_query(c.id, "Настройки сохранены")
+        await abot.send_message(cid, f"🔔 Автообновление включено: {label}.")
+        log_user_action(c.from_user, f"включил автообновление ({label})")
+
+    async def profile(m):
+        remember_user(m.from_user)
+        await abot.send_message(
+            m.chat.id, profile_text(m.from_user),
+            reply_markup=reply_keyboard(m.chat.id),
+        )
+        log_user_action(m.from_user, "открыл профиль")
+
+    async def change_handler(m):
+        remember_user(m.from_user)
+        await abot.send_message(m.chat.id, history_change_text())
+        log_user_action(m.from_user, "запросил /change")
+
+    async def arbitrage(m):
+        remember_user(m.from_user)
+        await abot.send_message(
+            m.chat.id, arbitrage_text(get_rate_snapshot()),
+            reply_markup=reply_keyboard(m.chat.id),
+        )
+        log_user_action(m.from_user, "открыл «Арбитраж»")
+
+    async def convert_handler(m):
+        remember_user(m.from_user)
+        text = convert_text(m.text, get_rate_snapshot())
+        await abot.send_message(m.chat.id, text)
+        log_user_action(m.from_user, f"запросил {m.text}")
+
+    async def alert_handler(m):
+        remember_user(m.from_user)
+        cid = m.chat.id
+        parsed = parse_alert(m.text)
+        if parsed is None:
+            await abot.send_message(cid, ALERT_USAGE)
+            return
+        metric, op, threshold = parsed
+        aid = add_alert(cid, metric, op, threshold)
+        if aid is None:
+            await abot.send_message(
+                cid, f"Не больше {ALERTS_PER_CHAT} оповещений на чат."
+            )
+            return
+        label = alert_label(ALERTS.get(aid))
+        await abot.send_message(cid, f"🚨 Оповещение добавлено: {label}.")
+        log_user_action(m.from_user, f"добавил оповещение ({label})")
+
+    async def alerts_handler(m):
+        remember_user(m.from_user)
+        text, kb = alerts_menu(m.chat.id)
+        await abot.send_message(m.chat.id, text, reply_markup=kb)
+
+    async def alert_delete_callback(c):
+        aid = c.data.split(":", 1)[1]
+        alert = ALERTS.get(aid)
+        if alert is None or alert[0] != c.message.chat.id:
+            await abot.answer_callback_query(c.id, "Оповещение уже удалено")
+            return
+        remove_alert(aid)
+        await abot.answer_callback_query(c.id, "Оповещение удалено")
+        text, kb = alerts_menu(c.message.chat.id)
+        await abot.edit_message_text(
+            text, c.message.chat.id, c.message.message_id, reply_markup=kb
+        )
+        log_user_action(c.from_user, f"удалил оповещение ({alert_label(alert)})")
+
+    async def update_keyboard_global(m):
+        remember_user(m.from_user)
+        await aensure_keyboard(m)
+
+    text_routes = {
+        BTN_SHOW: show_rate,
+        BTN_AUTO: toggle_auto,
+        BTN_PROFILE: profile,
+        BTN_DISABLE: disable_notifications,
+        BTN_ARB: arbitrage,
+    }
+    command_routes = {
+        "start": start_handler,
+        "help": start_handler,
+        "change": change_handler,
+        "convert": convert_handler,
+        "alert": alert_handler,
+        "alerts": alerts_handler,
+    }
+    callback_routes = {
+        "auto_": auto_callback,
+        "alertdel:": alert_delete_callback,
+    }
+
+    @abot.message_handler()
+    async def dispatch_message(m):
+        fn = message_route(
+            m, text_routes, command_routes, update_keyboard_global
+        )
+        with METRICS.timer("handler", handler=fn.__name__):
+            await fn(m)
+
+    @abot.callback_query_handler(func=lambda c: True)
+    async def dispatch_callback(c):
+        fn = callback_route(c, callback_routes)
+        if fn is None:
+            return
+        with METRICS.timer("handler", handler=fn.__name__):
+            await fn(c)
+
+    dispatch_message._instrumented = True
+    dispatch_callback._instrumented = True
+
+    @abot.inline_handler(func=lambda q: True)
+    async def inline_query(q):
+        results = inline_results(q.query, get_rate_snapshot())
+        await abot.answer_inline_query(
+            q.id, results, cache_time=INLINE_CACHE_TIME if results else 0
+        )
+
+    instrument_handlers(abot)
+    return abot
+
+
+async def async_main():
+    import aiohttp
+
+    ready = asyncio.Event()
+    abot = build_async_bot(ready)
+
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT
+    )
+    connector = aiohttp.TCPConnector(limit_per_host=HTTP_POOL_SIZE)
+    async with aiohttp.ClientSession(
+        timeout=timeout,
+        connector=connector,
+        headers={"User-Agent": "Mozilla/5.0"},
+    ) as session:
+        tasks = [
+            asyncio.create_task(async_rate_refresh_loop(session, ready)),
+            asyncio.create_task(async_auto_update_loop()),
+            asyncio.create_task(async_keep_awake(session)),
+        ]
+
+        logger.info("Бот запущен (async).")
+        log_to_channel("🚀 Бот перезапущен и готов к работе")
+
+        # если раньше стоял вебхук, getUpdates будет отвечать 409
+        try:
+            await abot.remove_webhook()
+        except Exception:
+            logger.exception("Не удалось снять вебхук")
+
+        try:
+            await abot.infinity_polling(timeout=60, skip_pending=False)
+        finally:
+            for t in tasks:
+                t.cancel()
+
+
+# ============== ЗАПУСК БОТА ==============
+
+def check_modes() -> None:
+    if BOT_MODE != "async":
+        return
+    if CLUSTER_MODE:
+        raise RuntimeError("CLUSTER_MODE поддерживается только в BOT_MODE=threads")
+    if UPDATE_MODE == "webhook":
+        # апдейты из вебхука разбирает пул потоков для синхронного bot,
+        # async-бот их бы не увидел, а очередь встала бы на 503
+        raise RuntimeError("UPDATE_MODE=webhook поддерживается только в BOT_MODE=threads")
+
+
+def main():
+    global HISTORY
+    check_modes()
+    load_state()
+    HISTORY = open_history()
+    instrument_telegram_api()
+    if BOT_MODE == "async":
+        instrument_async_telegram_api()
+    else:
+        instrument_handlers(bot)
+
+    if BOT_MODE == "async":
+        # веб-заглушка для Render остаётся отдельным потоком
+        threading.Thread(target=run_web, daemon=True).start()
+        OUTBOX.start()
+        threading.Thread(target=LOG_SINK.run, daemon=True).start()
+        start_streams()
+        asyncio.run(async_main())
+        return
+
+    # фоновые потоки
+    OUTBOX.start()
+    threading.Thread(target=LOG_SINK.run, daemon=True).start()
+    if CLUSTER_MODE:
+        threading.Thread(target=CLUSTER.run, daemon=True).start()
+    threading.Thread(target=rate_refresh_loop, daemon=True).start()
+    start_streams()
+    threading.Thread(target=auto_update_loop, daemon=True).start()
+    threading.Thread(target=PROGRESS.run, daemon=True).start()
 
     logger.info("Бот запущен.")
+    if UPDATE_MODE == "webhook":
+        run_webhook()
+    else:
+        threading.Thread(target=startup_tasks, daemon=True).start()
+        run_polling()
+
+
+def broadcast_new_keyboard() -> None:
+    """При старте — мягко обновим клавиатуру тем, у кого она устарела."""
+    for uid in list(ALL_USERS):
+        if uid in KEYBOARD_CHATS:
+            continue
+        mark_keyboard(uid)
+        OUTBOX.send(
+            uid, KEYBOARD_UPDATED_TEXT, reply_markup=MAIN_KEYBOARD_JSON,
+            on_error=lambda cid, e: forget_keyboard(cid),
+        )
+
+
+def startup_tasks() -> None:
+    """
+    Всё, что не нужно для первого ответа, идёт фоном, пока основной
+    поток уже принимает обновления.
+    """
+    if UPDATE_MODE != "webhook":
+        # входящие вебхуки и так будят сервис, самопинг не нужен
+        threading.Thread(target=keep_awake, daemon=True).start()
+        threading.Thread(target=run_web, daemon=True).start()
+    # рассылка и уведомление — от одной реплики, иначе каждый чат
+    # получит их по разу на реплику; не ставшая лидером пропускает
+    if CLUSTER_MODE and not CLUSTER.leader.wait(2 * LEASE_TTL):
+        return
     log_to_channel("🚀 Бот перезапущен и готов к работе")
+    broadcast_new_keyboard()
+
+
+def set_webhook() -> None:
+    try:
+        bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_WORKERS,
+        )
+        logger.info(f"Вебхук: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    except Exception:
+        logger.exception("Не удалось поставить вебхук")
+
+
+def run_webhook():
+    # хендлеры выполняет наш пул, а не внутренний пул TeleBot
+    bot.threaded = False
+    WEBHOOK_UPDATES.start()
+    # вебхук с прошлого запуска уже стоит: сразу поднимаем сервер,
+    # а адрес обновляем фоном
+    threading.Thread(target=set_webhook, daemon=True).start()
+    threading.Thread(target=startup_tasks, daemon=True).start()
+    run_web()
+
+
+def run_polling():
+    # если раньше стоял вебхук, getUpdates будет отвечать 409
+    try:
+        bot.remove_webhook()
+    except Exception:
+        logger.exception("Не удалось снять вебхук")
 
     while True:
+        if CLUSTER_MODE and not CLUSTER.leader.is_set():
+            CLUSTER.leader.wait()
         try:
-            bot.infinity_polling(
+            # не infinity_polling: после stop_polling (потеря лидерства)
+            # он сразу возвращается, а polling сам сбрасывает флаг остановки
+            bot.polling(
+                non_stop=True,
                 skip_pending=False,
                 timeout=60,              # увеличиваем время ожидания
                 long_polling_timeout=60  # Telegram держит соединение дольше
@@ -608,13 +4388,7 @@ def main():
 
 if __name__ == "__main__":
     try:
-        try:
-            bot.send_message(
-                ADMIN_LOG_CHAT_ID,
-                "♻️ Бот успешно перезапущен и готов к работе!"
-            )
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления администратору: {e}")
+        # об успешном запуске сообщает startup_tasks через LOG_SINK
         main()
     except Exception as e:
         logging.exception("❌ Фатальная ошибка при запуске бота")
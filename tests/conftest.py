@@ -0,0 +1,9 @@
+import os
+import sys
+
+# main.py читает настройки при импорте: без сети, файлов и токена
+os.environ.setdefault("TELEGRAM_TOKEN", "0:test")
+os.environ.setdefault("STORE_BACKEND", "none")
+os.environ.setdefault("HISTORY_DIR", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
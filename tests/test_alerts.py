@@ -0,0 +1,10 @@
+import main
+
+
+def test_close_thresholds_are_distinct_alerts():
+    book = main.AlertBook()
+    a = book.add(1, "rub", "<", 58123.45)
+    b = book.add(1, "rub", "<", 58123.4)
+    assert a != b
+    assert len(book.for_chat(1)) == 2
+    assert book.add(1, "rub", "<", 58123.45) == a
@@ -0,0 +1,48 @@
+import main
+
+
+def test_convert_rejects_non_finite_amounts():
+    for amount in ("nan", "inf", "-inf", "1e400"):
+        assert main.parse_convert_args(f"/convert {amount} krw rub") is None
+    assert main.parse_convert_args("/convert 1 000 000 krw rub") == (
+        1_000_000.0, "KRW", "RUB"
+    )
+
+
+def test_premium_range_computed_once_per_minute(monkeypatch):
+    calls = []
+
+    def series(name, hours=24):
+        calls.append(name)
+        return [(0, 0.01), (60, 0.03)]
+
+    monkeypatch.setattr(main, "premium_series", series)
+    monkeypatch.setattr(main, "_PREMIUM_RANGES", {})
+    for _ in range(5):
+        assert main.premium_range("upbit") == (0.01, 0.03)
+    assert calls == ["upbit"]
+
+
+def test_abcex_without_level_volume_keeps_best_prices(caplog):
+    book = {
+        "ask": [{"price": "91.5", "size": "10"}, {"price": "91.2", "size": "5"}],
+        "bid": [{"price": "90.1", "size": "7"}, {"price": "90.4", "size": "3"}],
+    }
+    best_buy, best_sell, depth = main._parse_abcex(book)
+    assert (best_buy, best_sell) == (90.4, 91.2)
+    assert all(buy is None and sell is None for _, buy, sell in depth)
+    assert "нет объёма уровня" in caplog.text
+    # о том же наборе полей второй раз не пишем
+    caplog.clear()
+    main._parse_abcex(book)
+    assert "нет объёма уровня" not in caplog.text
+
+
+def test_abcex_depth_from_level_volume():
+    book = {
+        "ask": [{"price": "91", "volume": "600"}, {"price": "92", "volume": "600"}],
+        "bid": [{"price": "90", "volume": "2000"}],
+    }
+    best_buy, best_sell, depth = main._parse_abcex(book)
+    size, buy, sell = depth[0]
+    assert size == 1000 and buy == 90 and sell == (600 * 91 + 400 * 92) / 1000
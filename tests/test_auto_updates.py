@@ -0,0 +1,44 @@
+import main
+
+
+class FailingOutbox:
+    """Отказывает одному чату; при отправке первому отписывает третий."""
+
+    stats = {"sent": 0, "failed": 0, "rate_limited": 0, "retried": 0}
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chat_id, text, on_error=None):
+        if chat_id == 2:
+            raise RuntimeError("boom")
+        if chat_id == 1:
+            main.AUTO_USERS.pop(3, None)
+        self.sent.append(chat_id)
+
+    def depth(self):
+        return 0
+
+
+def test_one_bad_chat_does_not_drop_the_batch(monkeypatch):
+    outbox = FailingOutbox()
+    scheduler = main.AutoScheduler()
+    users = {cid: main.AutoSub(3600) for cid in (1, 2, 3, 4)}
+    monkeypatch.setattr(main, "AUTO_USERS", users)
+    monkeypatch.setattr(main, "AUTO_SCHEDULER", scheduler)
+    monkeypatch.setattr(main, "OUTBOX", outbox)
+    monkeypatch.setattr(main.CLUSTER, "is_leader", lambda: True)
+    monkeypatch.setattr(main, "get_rate_snapshot", lambda: None)
+    monkeypatch.setattr(main, "render_snapshot", lambda snap: "rates")
+    monkeypatch.setattr(main, "is_quiet_hours", lambda now: False)
+    monkeypatch.setattr(main, "skip_quiet_hours", lambda due: due)
+    monkeypatch.setattr(main, "save_auto_user", lambda cid: None)
+
+    assert main.deliver_auto_updates([1, 2, 3, 4]) is not None
+
+    assert outbox.sent == [1, 4]
+    # доставленные — на следующий интервал, сбойный — на повтор
+    assert scheduler.due_at(1) is not None and scheduler.due_at(4) is not None
+    assert scheduler.due_at(2) is not None
+    assert scheduler.due_at(2) < scheduler.due_at(1)
+    assert scheduler.due_at(3) is None
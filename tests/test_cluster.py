@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+import pytest
+from telebot import apihelper
+
+import main
+
+
+class FakeLeaseStore:
+    def __init__(self):
+        self.ours = True
+
+    def acquire_lease(self, name, owner, ttl):
+        return self.ours
+
+    def prune_changes(self, older_than):
+        pass
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_polling_resumes_after_lease_regained(monkeypatch):
+    calls = {"getUpdates": 0}
+
+    def fake_request(token, method_name, method="get", params=None,
+                     files=None):
+        if method_name == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "t",
+                    "username": "t"}
+        if method_name == "getUpdates":
+            calls["getUpdates"] += 1
+            time.sleep(0.02)
+            return []
+        return True
+
+    monkeypatch.setattr(apihelper, "_make_request", fake_request)
+    monkeypatch.setattr(main, "CLUSTER_MODE", True)
+    monkeypatch.setattr(main, "UPDATE_MODE", "polling")
+    store = FakeLeaseStore()
+    cluster = main.Cluster()
+    cluster.store = store
+    monkeypatch.setattr(main, "CLUSTER", cluster)
+
+    cluster._renew()
+    assert cluster.leader.is_set()
+    # поток остаётся ждать лидерства после теста — он daemon
+    threading.Thread(target=main.run_polling, daemon=True).start()
+    assert _wait_for(lambda: calls["getUpdates"] >= 3)
+
+    store.ours = False
+    cluster._renew()
+    assert not cluster.leader.is_set()
+    time.sleep(0.3)  # текущий getUpdates доигрывает
+    stopped_at = calls["getUpdates"]
+    time.sleep(0.3)
+    assert calls["getUpdates"] == stopped_at
+
+    store.ours = True
+    cluster._renew()
+    assert cluster.leader.is_set()
+    assert _wait_for(lambda: calls["getUpdates"] >= stopped_at + 3)
+
+    store.ours = False
+    cluster._renew()
+    main.bot.stop_polling()
+
+
+def test_startup_side_effects_only_on_leader(monkeypatch):
+    sent = []
+    monkeypatch.setattr(main, "CLUSTER_MODE", True)
+    monkeypatch.setattr(main, "UPDATE_MODE", "webhook")  # без веб-сервера
+    monkeypatch.setattr(main, "LEASE_TTL", 0.05)
+    monkeypatch.setattr(main, "CLUSTER", main.Cluster())
+    monkeypatch.setattr(main, "log_to_channel", sent.append)
+    monkeypatch.setattr(
+        main, "broadcast_new_keyboard", lambda: sent.append("keyboard")
+    )
+
+    main.startup_tasks()
+    assert sent == []
+
+    main.CLUSTER.leader.set()
+    main.startup_tasks()
+    assert sent == ["🚀 Бот перезапущен и готов к работе", "keyboard"]
+
+
+def test_async_mode_rejects_cluster_and_webhook(monkeypatch):
+    monkeypatch.setattr(main, "BOT_MODE", "async")
+    monkeypatch.setattr(main, "CLUSTER_MODE", False)
+    monkeypatch.setattr(main, "UPDATE_MODE", "webhook")
+    with pytest.raises(RuntimeError, match="UPDATE_MODE=webhook"):
+        main.main()
+    monkeypatch.setattr(main, "UPDATE_MODE", "polling")
+    monkeypatch.setattr(main, "CLUSTER_MODE", True)
+    with pytest.raises(RuntimeError, match="CLUSTER_MODE"):
+        main.main()
+
+
+def test_cluster_history_needs_stable_replica_id(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "CLUSTER_MODE", True)
+    monkeypatch.setattr(main, "HISTORY_DIR", str(tmp_path))
+    monkeypatch.delenv("REPLICA_ID", raising=False)
+    with pytest.raises(RuntimeError, match="REPLICA_ID"):
+        main.open_history()
+
+    monkeypatch.setenv("REPLICA_ID", "web-1")
+    monkeypatch.setattr(main, "REPLICA_ID", "web-1")
+    main.open_history()
+    assert os.listdir(tmp_path) == ["web-1"]
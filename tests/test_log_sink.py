@@ -0,0 +1,58 @@
+import main
+
+
+class HeldOutbox:
+    """Складывает сводки и не подтверждает доставку, пока не попросят."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, chat_id, text, on_error=None, on_sent=None, **kwargs):
+        self.sent.append((text, on_sent))
+
+    def deliver(self):
+        on_sent = self.sent[-1][1]
+        on_sent(main.ADMIN_LOG_CHAT_ID)
+
+
+def test_one_digest_in_flight_and_paced(monkeypatch):
+    outbox = HeldOutbox()
+    monkeypatch.setattr(main, "OUTBOX", outbox)
+    monkeypatch.setattr(main, "LOG_QUEUE_LIMIT", 100)
+    sink = main.ChannelLogSink()
+    for i in range(150):
+        sink.emit(f"{i:04d}" + "x" * 400)
+
+    assert sink.flush() is True
+    assert len(outbox.sent) == 1
+    first = outbox.sent[0][0]
+    assert len(first) <= main.TG_MESSAGE_LIMIT
+    # сводка ещё в OUTBOX — события остаются в буфере синка
+    depth = sink.depth()
+    assert sink.flush() is True
+    assert len(outbox.sent) == 1 and sink.depth() == depth
+
+    outbox.deliver()
+    # доставлено, но минимальный интервал канала ещё не прошёл
+    assert sink.flush() is True
+    assert len(outbox.sent) == 1
+
+    sink._next_at = 0
+    sink.flush()
+    assert len(outbox.sent) == 2
+    second = outbox.sent[1][0]
+    # первой строкой — счётчик отброшенных, дальше ровно с места остановки
+    assert first.startswith("⚠️ Пропущено событий лога: 50")
+    assert second.startswith(f"{first.count(chr(10) * 2):04d}")
+    assert sink.dropped == 50
+
+
+def test_dropped_events_are_reported(monkeypatch):
+    outbox = HeldOutbox()
+    monkeypatch.setattr(main, "OUTBOX", outbox)
+    monkeypatch.setattr(main, "LOG_QUEUE_LIMIT", 2)
+    sink = main.ChannelLogSink()
+    for text in ("a", "b", "c", "d"):
+        sink.emit(text)
+    assert sink.flush() is False
+    assert outbox.sent[0][0] == "⚠️ Пропущено событий лога: 2\n\na\n\nb"
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import main
+
+
+def _too_many_requests(retry_after):
+    return ApiTelegramException(
+        "sendMessage", None,
+        {"error_code": 429, "description": "Too Many Requests",
+         "parameters": {"retry_after": retry_after}},
+    )
+
+
+def test_429_holds_only_that_chat(monkeypatch):
+    monkeypatch.setattr(main, "SEND_CHAT_INTERVAL", 0)
+    sent = []
+    limited = threading.Event()
+    done = threading.Event()
+
+    def send(chat_id, text):
+        if chat_id == 1 and not limited.is_set():
+            limited.set()
+            raise _too_many_requests(0.5)
+        sent.append((chat_id, text, time.monotonic()))
+        if len(sent) == 4:
+            done.set()
+
+    outbox = main.OutboundQueue(send, workers=2)
+    outbox.start()
+    t0 = time.monotonic()
+    outbox.send(1, "a1")
+    assert limited.wait(2)
+    outbox.send(1, "a2")
+    outbox.send(2, "b1")
+    outbox.send(2, "b2")
+    assert done.wait(5)
+
+    at = {text: ts - t0 for _, text, ts in sent}
+    # другой чат не ждёт retry_after
+    assert at["b1"] < 0.3 and at["b2"] < 0.3
+    # обе записи чата 1 — после паузы, в исходном порядке
+    assert at["a1"] >= 0.5 and at["a2"] >= 0.5
+    assert [t for c, t, _ in sent if c == 1] == ["a1", "a2"]
+    assert outbox.stats["rate_limited"] == 1
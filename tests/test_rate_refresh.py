@@ -0,0 +1,97 @@
+import itertools
+import threading
+import time
+
+import main
+
+
+def test_force_bypasses_stale_window():
+    cache = main.SingleFlightCache({"x": (5, 30, 10)})
+    counter = itertools.count(1)
+    assert cache.get("x", lambda: next(counter)) == 1
+    # в пределах ttl обычный вызов — из кэша, force — всегда свежий ответ
+    assert cache.get("x", lambda: next(counter)) == 1
+    assert cache.get("x", lambda: next(counter), force=True) == 2
+    assert cache.get("x", lambda: next(counter), force=True) == 3
+
+
+def test_snapshot_moves_forward_on_every_pass(monkeypatch):
+    counter = itertools.count(1)
+    monkeypatch.setattr(main, "_fetch_upbit", lambda: float(next(counter)))
+    # период опроса больше ttl кэша — как в проде (10 с против 5 с)
+    monkeypatch.setattr(main, "CACHE_POLICY", {"upbit": (0.05, 30, 10)})
+    monkeypatch.setattr(
+        main, "RATE_CACHE", main.SingleFlightCache(main.CACHE_POLICY)
+    )
+    monkeypatch.setattr(
+        main, "RATE_SOURCES", {"upbit": (main.get_upbit_usdt_krw, 0.1, 120)}
+    )
+    monkeypatch.setattr(main.CLUSTER, "share_snapshot", lambda updates: None)
+
+    published = []
+    monkeypatch.setattr(
+        main, "_publish_snapshot",
+        lambda updates: published.append(updates["upbit"]),
+    )
+
+    stop = threading.Event()
+    thread = threading.Thread(target=main.rate_refresh_loop, args=(stop,))
+    thread.start()
+    try:
+        deadline = time.time() + 5
+        while len(published) < 4 and time.time() < deadline:
+            time.sleep(0.02)
+    finally:
+        stop.set()
+        thread.join(5)
+
+    assert len(published) >= 4
+    values = [v for v, _ in published]
+    stamps = [ts for _, ts in published]
+    # каждый проход публикует ответ, полученный в этом же проходе
+    assert values == [float(i) for i in range(1, len(values) + 1)]
+    assert all(a < b for a, b in zip(stamps, stamps[1:]))
+
+
+def test_refresh_period_not_shorter_than_cache_ttl():
+    # refresher ходит с force=True, поэтому период задаёт частоту запросов;
+    # async-режим берёт max(период, ttl) — частоты должны совпадать
+    for name, (_, period, _) in main.RATE_SOURCES.items():
+        assert period >= main.CACHE_POLICY[name][0], name
+
+
+def test_hung_source_does_not_hold_back_the_others(monkeypatch):
+    release = threading.Event()
+    counter = itertools.count(1)
+
+    def hung(force=False):
+        release.wait(10)
+        return None
+
+    def fast(force=False):
+        return float(next(counter))
+
+    monkeypatch.setattr(main, "FETCH_BUDGET", 5)
+    monkeypatch.setattr(main, "RATE_SOURCES", {
+        "upbit": (fast, 0.05, 120), "rub": (hung, 0.05, 120),
+    })
+    monkeypatch.setattr(main.RATE_CACHE, "peek", lambda name: (None, 1.0))
+    monkeypatch.setattr(main.CLUSTER, "share_snapshot", lambda updates: None)
+    published = []
+    monkeypatch.setattr(
+        main, "_publish_snapshot", lambda updates: published.append(updates)
+    )
+
+    stop = threading.Event()
+    thread = threading.Thread(target=main.rate_refresh_loop, args=(stop,))
+    thread.start()
+    try:
+        time.sleep(1)
+    finally:
+        stop.set()
+        release.set()
+        thread.join(5)
+
+    # без ожидания FETCH_BUDGET: быстрый источник публикуется каждый период
+    assert len(published) >= 5
+    assert all(list(u) == ["upbit"] for u in published)
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import time
+import main
+main.load_state()
+main.STORE.put(main.KIND_USER, 777, True)
+print("ready", flush=True)
+time.sleep(30)
+"""
+
+
+def test_sigterm_flushes_pending_writes(tmp_path):
+    db = tmp_path / "state.db"
+    env = dict(os.environ, STORE_BACKEND="sqlite", STORE_PATH=str(db),
+               STORE_FLUSH_INTERVAL="60")
+    proc = subprocess.Popen(
+        [sys.executable, "-c", CHILD], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    )
+    try:
+        assert proc.stdout.readline().strip() == "ready"
+        proc.terminate()
+        assert proc.wait(10) == 0
+    finally:
+        proc.kill()
+
+    with sqlite3.connect(db) as conn:
+        users = [uid for (uid,) in conn.execute("SELECT user_id FROM users")]
+    assert users == [777]
+
+
+def test_replicas_add_to_shared_stats(tmp_path):
+    db = str(tmp_path / "state.db")
+    replicas = [main.WriteBehind(main.SqliteStore(db)) for _ in range(2)]
+    # каждая реплика видит только свои запросы: 3 и 2
+    for i in range(3):
+        replicas[0].add(main.KIND_STATS, 7, {"requests": i + 1, "last": 100}, 1)
+    for i in range(2):
+        replicas[1].add(main.KIND_STATS, 7, {"requests": i + 1, "last": 200}, 1)
+    for store in replicas:
+        store.flush()
+    assert replicas[0].backend.load_stats(7) == {"requests": 5, "last": 200}
+
+
+class FlakyBackend:
+    def __init__(self):
+        self.fail = True
+        self.written = []
+
+    def write(self, ops):
+        if self.fail:
+            self.fail = False
+            raise OSError("disk full")
+        self.written.append(ops)
+
+
+def test_failed_flush_keeps_counter_increments():
+    store = main.WriteBehind(FlakyBackend())
+    store.add(main.KIND_STATS, 7, {"requests": 1, "last": 1}, 1)
+    store.flush()  # запись не удалась — прибавка остаётся
+    store.add(main.KIND_STATS, 7, {"requests": 2, "last": 2}, 1)
+    store.flush()
+    assert store.backend.written == [
+        {(main.KIND_STATS, 7): {"requests": 2, "last": 2, "added": 2}}
+    ]
@@ -0,0 +1,24 @@
+import json
+
+import main
+
+
+def test_flat_price_keeps_snapshot_fresh(monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(main.time, "time", lambda: clock[0])
+    monkeypatch.setattr(main, "_SNAPSHOT", main.RateSnapshot())
+    monkeypatch.setattr(main.CLUSTER, "share_snapshot", lambda updates: None)
+    stream = main.PriceStream(
+        "upbit", "ws://test", main._upbit_subscribe, main._parse_upbit_tick
+    )
+    tick = json.dumps({"type": "ticker", "code": "KRW-USDT",
+                       "trade_price": 1450.0})
+
+    # цена не меняется 10 минут, тики раз в секунду
+    for _ in range(600):
+        stream._on_message(tick)
+        clock[0] += 1
+        assert main.get_rate_snapshot().value("upbit") == 1450.0
+
+    # но и не переиздаётся на каждый тик
+    assert main.get_rate_snapshot().version <= 600 / main.STREAM_REPUBLISH + 1
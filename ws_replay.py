@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная заглушка WebSocket-потоков Upbit/Bithumb для RATE_STREAM=1.
+Проигрывает записанные тики по кругу; без файла — генерирует свои.
+
+Запуск:
+    python ws_replay.py                      # порт 8765, синтетические тики
+    python ws_replay.py --port 9000 ticks.jsonl
+
+Бот направить на заглушку:
+    RATE_STREAM=1 UPBIT_WS=ws://127.0.0.1:8765/upbit \
+    BITHUMB_WS=ws://127.0.0.1:8765/bithumb python main.py
+
+Формат файла — JSON-строки: {"path": "/upbit", "delay": 0.5, "msg": {...}},
+где msg — сообщение биржи как есть.
+"""
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import random
+import socketserver
+import struct
+import time
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def synthetic_ticks(path: str):
+    price = 1450.0
+    while True:
+        price = round(price + random.uniform(-1.5, 1.5), 1)
+        if path == "/bithumb":
+            msg = {"type": "ticker", "content": {
+                "symbol": "USDT_KRW", "closePrice": str(price),
+            }}
+        else:
+            msg = {"type": "ticker", "code": "KRW-USDT", "trade_price": price}
+        yield 0.5, msg
+
+
+def recorded_ticks(records: list, path: str):
+    mine = [r for r in records if r.get("path", "/upbit") == path]
+    for r in itertools.cycle(mine):
+        yield r.get("delay", 0.5), r["msg"]
+
+
+def encode_frame(payload: bytes, opcode: int = 0x1) -> bytes:
+    """Кадр от сервера: без маски, FIN=1."""
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+
+def read_frame(rfile) -> bytes:
+    """Кадр от клиента (всегда с маской). Нужен только чтобы прочесть подписку."""
+    b1, b2 = rfile.read(2)
+    n = b2 & 0x7F
+    if n == 126:
+        n = struct.unpack("!H", rfile.read(2))[0]
+    elif n == 127:
+        n = struct.unpack("!Q", rfile.read(8))[0]
+    mask = rfile.read(4) if b2 & 0x80 else b"\0\0\0\0"
+    data = rfile.read(n)
+    return bytes(c ^ mask[i % 4] for i, c in enumerate(data))
+
+
+class ReplayHandler(socketserver.StreamRequestHandler):
+    records = None
+
+    def handle(self):
+        request_line = self.rfile.readline().decode()
+        path = request_line.split()[1] if request_line else "/"
+        headers = {}
+        for line in iter(self.rfile.readline, b"\r\n"):
+            key, _, value = line.decode().partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        accept = base64.b64encode(hashlib.sha1(
+            (headers["sec-websocket-key"] + WS_GUID).encode()
+        ).digest()).decode()
+        self.wfile.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode())
+
+        print(f"{path}: подписка {read_frame(self.rfile).decode()}")
+        ticks = (
+            recorded_ticks(self.records, path) if self.records
+            else synthetic_ticks(path)
+        )
+        try:
+            for delay, msg in ticks:
+                time.sleep(delay)
+                # Upbit шлёт бинарные кадры, Bithumb — текстовые
+                opcode = 0x2 if path == "/upbit" else 0x1
+                self.wfile.write(encode_frame(json.dumps(msg).encode(), opcode))
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"{path}: клиент отключился")
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ticks", nargs="?")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.ticks:
+        with open(args.ticks, encoding="utf-8") as fh:
+            ReplayHandler.records = [json.loads(line) for line in fh if line.strip()]
+
+    with Server(("127.0.0.1", args.port), ReplayHandler) as server:
+        print(f"ws://127.0.0.1:{args.port}/upbit, /bithumb")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()